@@ -0,0 +1,70 @@
+"""
+Parametric PyTorch models for the benchmarks
+"""
+import torch
+from torch import nn
+
+INT_RANGE = 8.0
+FRAC_RANGE = 1.0
+
+
+def set_weights(model: nn.Sequential, frac: bool, seed: int):
+    """
+    Replace the parameters of every Linear and Conv1d layer with random ones, small integers for
+    the integer Model and values in [-1, 1) for the fixed-point Model, so the designs are the same
+    on every run
+    """
+    generator = torch.Generator().manual_seed(seed)
+    for layer in model:
+        if not isinstance(layer, (nn.Linear, nn.Conv1d)):
+            continue
+        for name in ('weight', 'bias'):
+            shape = getattr(layer, name).shape
+            if frac:
+                values = torch.rand(shape, generator=generator) * 2 - 1
+            else:
+                values = torch.randint(-8, 8, shape, generator=generator).float()
+            setattr(layer, name, nn.Parameter(values, requires_grad=False))
+
+
+def mlp(width: int, depth: int, inputs: int = None, frac: bool = False, seed: int = 0) -> nn.Sequential:
+    """
+    :param width: Number of neurons of every layer
+    :param depth: Number of Linear layers, with a ReLU between every two of them
+    :param inputs: Number of inputs, width if None
+    :param frac: Weights for the fixed-point Model instead of the integer one
+    :param seed: Seed of the weights
+    :return: Multilayer perceptron
+    """
+    modules = [nn.Linear(inputs or width, width)]
+    for _ in range(depth - 1):
+        modules += [nn.ReLU(), nn.Linear(width, width)]
+    model = nn.Sequential(*modules)
+    set_weights(model, frac, seed)
+    return model
+
+
+def conv(length: int, channels: int = 4, depth: int = 2, kernel_size: int = 3, inputs: int = 8, outputs: int = 4,
+         frac: bool = False, seed: int = 0) -> nn.Sequential:
+    """
+    :param length: Number of positions of every channel
+    :param channels: Number of channels of every convolution
+    :param depth: Number of Conv1d layers, each followed by a ReLU
+    :param kernel_size: Kernel size of the convolutions, which are padded to keep the length
+    :param inputs: Number of inputs of the Linear layer that expands them into the channels,
+        since the first layer of a model is a Linear one
+    :param outputs: Number of outputs of the final Linear layer
+    :param frac: Weights for the fixed-point Model instead of the integer one
+    :param seed: Seed of the weights
+    :return: One-dimensional convolutional network
+    """
+    modules = [nn.Linear(inputs, channels * length), nn.ReLU(), nn.Unflatten(1, (channels, length))]
+    for _ in range(depth):
+        modules += [nn.Conv1d(channels, channels, kernel_size, padding=kernel_size // 2), nn.ReLU()]
+    modules += [nn.Flatten(1), nn.Linear(channels * length, outputs)]
+    model = nn.Sequential(*modules)
+    set_weights(model, frac, seed)
+    return model
+
+
+MODELS = {'mlp': mlp, 'conv': conv}
@@ -0,0 +1,861 @@
+"""
+Design metrics read back from the Verilog the transpiler emits: the number of multipliers, adders,
+comparators and multiplexers, the register and ROM bits, and an estimate of the logic depth.
+The parser covers the subset of Verilog-2001 the emitters produce, not the whole language.
+"""
+import re
+from typing import Dict, Iterator, List, Tuple
+
+TOKEN = re.compile(r"""
+    (?P<skip>\s+|//[^\n]*|/\*.*?\*/|`[^\n]*)
+  | (?P<token>"(?:[^"\\]|\\.)*"
+  | \d*'[sS]?[bodhBODH][0-9a-fA-FxXzZ_]+|\d+\.\d+(?:[eE][-+]?\d+)?|\d+
+  | [A-Za-z_$][\w$]*
+  | <<<|>>>|<<|>>|<=|>=|===|!==|==|!=|&&|\|\||\+:|-:|\*\*|[-+*/%<>!~&|^?:;,.()\[\]{}#@=])
+""", re.VERBOSE | re.DOTALL)
+
+# binary operators from the lowest to the highest precedence
+PRECEDENCE = [('||',), ('&&',), ('|',), ('^',), ('&',), ('==', '!=', '===', '!=='), ('<', '<=', '>', '>='),
+              ('<<', '>>', '<<<', '>>>'), ('+', '-'), ('*', '/', '%'), ('**',)]
+# operators that are one level of logic and the metric they are counted in
+COUNTED = {'*': 'multipliers', '/': 'multipliers', '%': 'multipliers', '+': 'adders', '-': 'adders',
+           '<': 'comparators', '<=': 'comparators', '>': 'comparators', '>=': 'comparators',
+           '==': 'comparators', '!=': 'comparators', '===': 'comparators', '!==': 'comparators'}
+SHIFTS = ('<<', '>>', '<<<', '>>>')
+METRICS = ('multipliers', 'adders', 'comparators', 'multiplexers', 'register_bits', 'rom_bits')
+DIRECTIONS = ('input', 'output', 'inout')
+DECLARATIONS = DIRECTIONS + ('wire', 'reg', 'integer', 'genvar')
+
+# the depth of a signal is a pair: the most levels of logic on a path from an input of the module,
+# and on a path from a register, -1 where there is no such path, for instance for constants
+Depth = Tuple[int, int]
+NONE = (-1, -1)
+
+
+def longest(a: Depth, b: Depth) -> Depth:
+    return max(a[0], b[0]), max(a[1], b[1])
+
+
+def deeper(depth: Depth, levels: int) -> Depth:
+    return tuple(d + levels if d >= 0 else d for d in depth)
+
+
+class Module:
+    """
+    The declarations, continuous assignments, always blocks and instances of one Verilog module.
+    Expressions are tuples: ('const', value), ('id', name), ('index', name, index),
+    ('chain', operators, operands) for a left to right sequence of binary operators of the same
+    precedence, ('unary', operator, operand), ('cond', condition, a, b), ('concat', items) and
+    ('call', name, arguments).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.ports: List[str] = []
+        self.directions: Dict[str, str] = {}
+        self.parameters: Dict[str, tuple] = {}
+        self.ranges: Dict[str, tuple] = {}
+        self.arrays: Dict[str, tuple] = {}
+        self.signals = set()
+        # (target, expression) of every assign statement and initialized wire
+        self.assigns: List[Tuple[str, tuple]] = []
+        # (clocked, statement) of every always block
+        self.blocks: List[Tuple[bool, tuple]] = []
+        # (module, connections) of every instance, a connection is a (port or None, expression) pair
+        self.instances: List[Tuple[str, List[Tuple[str, tuple]]]] = []
+
+
+class Parser:
+    """
+    Recursive descent parser of the modules in a Verilog file
+    """
+
+    def __init__(self, code: str):
+        self.tokens = [match.group('token') for match in TOKEN.finditer(code) if match.group('token')]
+        self.position = 0
+
+    def peek(self) -> str:
+        return self.tokens[self.position] if self.position < len(self.tokens) else ''
+
+    def next(self) -> str:
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, token: str):
+        found = self.next()
+        if found != token:
+            raise ValueError(f'Expected {token!r} but found {found!r} at token {self.position - 1}')
+
+    def accept(self, token: str) -> bool:
+        if self.peek() == token:
+            self.position += 1
+            return True
+        return False
+
+    def modules(self) -> Dict[str, Module]:
+        """
+        :return: Every module of the file by its name
+        """
+        modules = {}
+        while self.position < len(self.tokens):
+            if self.next() == 'module':
+                module = self.module()
+                modules[module.name] = module
+        return modules
+
+    def module(self) -> Module:
+        module = Module(self.next())
+        if self.accept('#'):
+            self.expect('(')
+            self.parameters(module, ')')
+        if self.accept('('):
+            while not self.accept(')'):
+                if self.peek() in DIRECTIONS:
+                    self.declaration(module, self.next(), header=True)
+                else:
+                    module.ports.append(self.next())
+                self.accept(',')
+        self.expect(';')
+
+        while not self.accept('endmodule'):
+            if not self.peek():
+                raise ValueError(f'Module {module.name} has no endmodule')
+            token = self.next()
+            if token in DECLARATIONS:
+                self.declaration(module, token)
+            elif token in ('parameter', 'localparam'):
+                self.parameters(module, ';')
+            elif token == 'assign':
+                while True:
+                    target, _ = self.lvalue()
+                    self.expect('=')
+                    module.assigns.append((target, self.expression()))
+                    if not self.accept(','):
+                        break
+                self.expect(';')
+            elif token == 'always':
+                self.expect('@')
+                clocked = False
+                if self.accept('('):
+                    depth = 1
+                    while depth:
+                        token = self.next()
+                        depth += {'(': 1, ')': -1}.get(token, 0)
+                        clocked |= token in ('posedge', 'negedge')
+                else:
+                    self.expect('*')
+                module.blocks.append((clocked, self.statement()))
+            elif token == 'initial':
+                # initial blocks only fill ROMs, they are not logic
+                self.statement()
+            elif token != ';':
+                self.instance(module, token)
+        return module
+
+    def parameters(self, module: Module, end: str):
+        while not self.accept(end):
+            if self.peek() in ('parameter', 'localparam', 'integer', 'signed'):
+                self.next()
+                continue
+            name = self.next()
+            self.expect('=')
+            module.parameters[name] = self.expression()
+            self.accept(',')
+
+    def declaration(self, module: Module, kind: str, header: bool = False):
+        """
+        Parse the rest of a declaration, up to the semicolon or, in the port list of the module
+        header, up to the next port
+        """
+        while self.peek() in ('reg', 'wire', 'signed', 'unsigned'):
+            self.next()
+        bits = self.range() if self.peek() == '[' else None
+        while True:
+            name = self.next()
+            module.signals.add(name)
+            if bits is not None:
+                module.ranges[name] = bits
+            if kind in DIRECTIONS:
+                module.directions[name] = kind
+                if header:
+                    module.ports.append(name)
+            if self.peek() == '[':
+                module.arrays[name] = self.range()
+            if self.accept('='):
+                module.assigns.append((name, self.expression()))
+            if header:
+                return
+            if not self.accept(','):
+                break
+        self.expect(';')
+
+    def range(self) -> Tuple[tuple, tuple]:
+        self.expect('[')
+        high = self.expression()
+        self.expect(':')
+        low = self.expression()
+        self.expect(']')
+        return high, low
+
+    def instance(self, module: Module, name: str):
+        if self.accept('#'):
+            self.expect('(')
+            while not self.accept(')'):
+                self.expression()
+                self.accept(',')
+        self.next()
+        self.expect('(')
+        connections = []
+        while not self.accept(')'):
+            if self.accept('.'):
+                port = self.next()
+                self.expect('(')
+                connections.append((port, self.expression() if self.peek() != ')' else ('const', None)))
+                self.expect(')')
+            else:
+                connections.append((None, self.expression()))
+            self.accept(',')
+        self.expect(';')
+        module.instances.append((name, connections))
+
+    def statement(self) -> tuple:
+        """
+        :return: ('block', statements), ('if', condition, then, otherwise), ('case', selector, statements),
+            ('assign', target, index, expression) or ('nop',)
+        """
+        token = self.peek()
+        if self.accept('begin'):
+            if self.accept(':'):
+                self.next()
+            statements = []
+            while not self.accept('end'):
+                statements.append(self.statement())
+            return ('block', statements)
+        if self.accept('if'):
+            self.expect('(')
+            condition = self.expression()
+            self.expect(')')
+            then = self.statement()
+            otherwise = self.statement() if self.accept('else') else ('nop',)
+            return ('if', condition, then, otherwise)
+        if token in ('case', 'casez', 'casex'):
+            self.next()
+            self.expect('(')
+            selector = self.expression()
+            self.expect(')')
+            statements = []
+            while not self.accept('endcase'):
+                if not self.accept('default'):
+                    self.expression()
+                    while self.accept(','):
+                        self.expression()
+                self.accept(':')
+                statements.append(self.statement())
+            return ('case', selector, statements)
+        if self.accept(';'):
+            return ('nop',)
+        if token.startswith('$'):
+            # system tasks such as $readmemh
+            self.next()
+            if self.accept('('):
+                while not self.accept(')'):
+                    self.expression()
+                    self.accept(',')
+            self.expect(';')
+            return ('nop',)
+
+        target, index = self.lvalue()
+        # blocking and nonblocking assignments are told apart by the kind of always block
+        self.next()
+        value = self.expression()
+        self.expect(';')
+        return ('assign', target, index, value)
+
+    def lvalue(self) -> Tuple[str, tuple]:
+        """
+        :return: Name of the target, and the expression of its index or None if the whole signal is written
+        """
+        if self.accept('{'):
+            # concatenated targets, treated as a write to the first one
+            targets = [self.lvalue()]
+            while self.accept(','):
+                targets.append(self.lvalue())
+            self.expect('}')
+            return targets[0][0], ('const', None)
+        name = self.next()
+        index = None
+        while self.accept('['):
+            index = self.expression()
+            if self.peek() in (':', '+:', '-:'):
+                self.next()
+                self.expression()
+            self.expect(']')
+        return name, index
+
+    def expression(self) -> tuple:
+        condition = self.binary(0)
+        if self.accept('?'):
+            a = self.expression()
+            self.expect(':')
+            return ('cond', condition, a, self.expression())
+        return condition
+
+    def binary(self, level: int) -> tuple:
+        if level == len(PRECEDENCE):
+            return self.unary()
+        operands = [self.binary(level + 1)]
+        operators = []
+        while self.peek() in PRECEDENCE[level]:
+            operators.append(self.next())
+            operands.append(self.binary(level + 1))
+        return ('chain', operators, operands) if operators else operands[0]
+
+    def unary(self) -> tuple:
+        if self.peek() in ('-', '+', '!', '~', '&', '|', '^'):
+            op = self.next()
+            return ('unary', op, self.unary())
+        return self.primary()
+
+    def primary(self) -> tuple:
+        token = self.next()
+        if token == '(':
+            value = self.expression()
+            self.expect(')')
+            return value
+        if token == '{':
+            first = self.expression()
+            if self.accept('{'):
+                # replication, {count{items}}
+                items = [self.expression()]
+                while self.accept(','):
+                    items.append(self.expression())
+                self.expect('}')
+                self.expect('}')
+                return ('concat', items)
+            items = [first]
+            while self.accept(','):
+                items.append(self.expression())
+            self.expect('}')
+            return ('concat', items)
+        if token[0].isdigit() or token[0] == "'":
+            return ('const', number(token))
+        if token[0] == '"':
+            return ('const', None)
+        if self.accept('('):
+            arguments = []
+            while not self.accept(')'):
+                arguments.append(self.expression())
+                self.accept(',')
+            return ('call', token, arguments)
+
+        value = ('id', token)
+        while self.accept('['):
+            index = self.expression()
+            if self.accept(':'):
+                # a constant part select reads the signal like the whole of it
+                self.expression()
+            else:
+                if self.peek() in ('+:', '-:'):
+                    self.next()
+                    self.expression()
+                value = ('index', token, index)
+            self.expect(']')
+        return value
+
+
+def number(token: str):
+    """
+    :return: Value of a Verilog number such as 12, 0.5 or 4'b0101, None if it has x or z digits
+    """
+    if '.' in token:
+        return float(token)
+    if "'" not in token:
+        return int(token)
+    digits = token.split("'")[1].lstrip('sS')
+    try:
+        return int(digits[1:].replace('_', ''), {'b': 2, 'o': 8, 'd': 10, 'h': 16}[digits[0].lower()])
+    except ValueError:
+        return None
+
+
+def constant_value(expression: tuple, parameters: Dict[str, tuple]) -> int:
+    """
+    Evaluate a constant expression, such as the bounds of a range
+    :param expression: Expression
+    :param parameters: Default value of every parameter of the module
+    :return: Integer value
+    :raise ValueError: If the expression is not a constant
+    """
+    kind = expression[0]
+    if kind == 'const' and expression[1] is not None:
+        return expression[1]
+    if kind == 'id' and expression[1] in parameters:
+        return constant_value(parameters[expression[1]], parameters)
+    if kind == 'unary' and expression[1] in '-+':
+        value = constant_value(expression[2], parameters)
+        return -value if expression[1] == '-' else value
+    if kind == 'chain':
+        operations = {'+': lambda a, b: a + b, '-': lambda a, b: a - b, '*': lambda a, b: a * b,
+                      '/': lambda a, b: a // b, '%': lambda a, b: a % b, '**': lambda a, b: a ** b,
+                      '<<': lambda a, b: a << b, '>>': lambda a, b: a >> b}
+        value = constant_value(expression[2][0], parameters)
+        for op, operand in zip(expression[1], expression[2][1:]):
+            if op not in operations:
+                break
+            value = operations[op](value, constant_value(operand, parameters))
+        else:
+            return value
+    raise ValueError(f'Not a constant expression: {expression}')
+
+
+def identifiers(expression: tuple) -> Iterator[str]:
+    """
+    :return: Iterator over the names an expression reads
+    """
+    kind = expression[0]
+    if kind == 'id':
+        yield expression[1]
+    elif kind == 'index':
+        yield expression[1]
+        yield from identifiers(expression[2])
+    elif kind == 'unary':
+        yield from identifiers(expression[2])
+    elif kind == 'cond':
+        for part in expression[1:]:
+            yield from identifiers(part)
+    elif kind != 'const':
+        for part in expression[-1]:
+            yield from identifiers(part)
+
+
+def statement_reads(statement: tuple) -> Iterator[str]:
+    """
+    :return: Iterator over the names a statement reads
+    """
+    kind = statement[0]
+    if kind == 'block':
+        for inner in statement[1]:
+            yield from statement_reads(inner)
+    elif kind == 'if':
+        yield from identifiers(statement[1])
+        yield from statement_reads(statement[2])
+        yield from statement_reads(statement[3])
+    elif kind == 'case':
+        yield from identifiers(statement[1])
+        for inner in statement[2]:
+            yield from statement_reads(inner)
+    elif kind == 'assign':
+        if statement[2] is not None:
+            yield from identifiers(statement[2])
+        yield from identifiers(statement[3])
+
+
+def statement_writes(statement: tuple) -> Iterator[str]:
+    """
+    :return: Iterator over the names a statement assigns to
+    """
+    kind = statement[0]
+    if kind == 'block':
+        for inner in statement[1]:
+            yield from statement_writes(inner)
+    elif kind == 'if':
+        yield from statement_writes(statement[2])
+        yield from statement_writes(statement[3])
+    elif kind == 'case':
+        for inner in statement[2]:
+            yield from statement_writes(inner)
+    elif kind == 'assign':
+        yield statement[1]
+
+
+def count_operators(expression: tuple, signals, counts: Dict[str, int]) -> bool:
+    """
+    Add the operators of an expression that read a signal to counts. Operators with constant
+    operands only are computed by synthesis and not counted.
+    :param expression: Expression
+    :param signals: Names of the signals of the module, any other name is a parameter
+    :param counts: Number of operators by metric
+    :return: Whether the expression is constant
+    """
+    kind = expression[0]
+    if kind == 'const':
+        return True
+    if kind == 'id':
+        return expression[1] not in signals
+    if kind == 'index':
+        constant_index = count_operators(expression[2], signals, counts)
+        if not constant_index:
+            counts['multiplexers'] += 1
+        return constant_index and expression[1] not in signals
+    if kind == 'chain':
+        constant = count_operators(expression[2][0], signals, counts)
+        for op, operand in zip(expression[1], expression[2][1:]):
+            constant_operand = count_operators(operand, signals, counts)
+            if op in COUNTED and not (constant and constant_operand):
+                counts[COUNTED[op]] += 1
+            elif op in SHIFTS and not constant_operand:
+                counts['multiplexers'] += 1
+            constant &= constant_operand
+        return constant
+    if kind == 'unary':
+        return count_operators(expression[2], signals, counts)
+    if kind == 'cond':
+        constant_condition = count_operators(expression[1], signals, counts)
+        if not constant_condition:
+            counts['multiplexers'] += 1
+        constant = [count_operators(part, signals, counts) for part in expression[2:]]
+        return constant_condition and all(constant)
+    return all([count_operators(part, signals, counts) for part in expression[-1]])
+
+
+def count_statement(statement: tuple, signals, counts: Dict[str, int], multiplexed: bool = False):
+    """
+    Add the operators of the expressions and conditions of a statement to counts
+    :param statement: Statement of an always block
+    :param signals: Names of the signals of the module
+    :param counts: Number of operators by metric
+    :param multiplexed: Whether the statement is in a branch of a combinational block, so that
+        every assignment selects between values with a multiplexer, None in a clocked block
+    """
+    kind = statement[0]
+    if kind == 'block':
+        for inner in statement[1]:
+            count_statement(inner, signals, counts, multiplexed)
+    elif kind == 'if':
+        count_operators(statement[1], signals, counts)
+        count_statement(statement[2], signals, counts, None if multiplexed is None else True)
+        count_statement(statement[3], signals, counts, None if multiplexed is None else True)
+    elif kind == 'case':
+        for inner in statement[2]:
+            count_statement(inner, signals, counts, None if multiplexed is None else True)
+    elif kind == 'assign':
+        count_operators(statement[3], signals, counts)
+        if multiplexed:
+            counts['multiplexers'] += 1
+
+
+def expression_depth(expression: tuple, lookup) -> Depth:
+    """
+    Levels of logic of an expression, every multiplier, adder, comparator and multiplexer being one
+    level. Shifts by a constant and logic operators are free.
+    :param expression: Expression
+    :param lookup: Function returning the depth of a signal by its name
+    :return: Depth of the result
+    """
+    kind = expression[0]
+    if kind == 'const':
+        return NONE
+    if kind == 'id':
+        return lookup(expression[1])
+    if kind == 'index':
+        value, index = lookup(expression[1]), expression_depth(expression[2], lookup)
+        return value if index == NONE else deeper(longest(value, index), 1)
+    if kind == 'chain':
+        depth = expression_depth(expression[2][0], lookup)
+        for op, operand in zip(expression[1], expression[2][1:]):
+            operand = expression_depth(operand, lookup)
+            levels = 1 if op in COUNTED or (op in SHIFTS and operand != NONE) else 0
+            depth = deeper(longest(depth, operand), levels)
+        return depth
+    if kind == 'unary':
+        return expression_depth(expression[2], lookup)
+    if kind == 'cond':
+        condition = expression_depth(expression[1], lookup)
+        depth = longest(expression_depth(expression[2], lookup), expression_depth(expression[3], lookup))
+        return depth if condition == NONE else deeper(longest(condition, depth), 1)
+    depth = NONE
+    for part in expression[-1]:
+        depth = longest(depth, expression_depth(part, lookup))
+    return depth
+
+
+class Summary:
+    """
+    Metrics of a module including the modules it instantiates
+    """
+
+    def __init__(self):
+        self.counts = dict.fromkeys(METRICS, 0)
+        # depth of every output port
+        self.outputs: Dict[str, Depth] = {}
+        # depth of the deepest path into a register
+        self.registers = NONE
+
+    def logic_depth(self) -> int:
+        """
+        :return: Levels of logic on the longest path from an input or register to an output or register
+        """
+        return max([0, *self.registers, *(d for depth in self.outputs.values() for d in depth)])
+
+    def metrics(self) -> dict:
+        return {**self.counts, 'logic_depth': self.logic_depth()}
+
+
+class Netlist:
+    """
+    Metrics of the modules of a Verilog file. Every module is summarized once, and an instance
+    adds the metrics of its module to the one it is in. The depth of an instance output is the
+    depth of the inputs of the instance plus the depth of the module output, so the depths of
+    the modules of a combinational top add up along the layers, while the registers of a
+    pipelined top cut the paths.
+    """
+
+    def __init__(self, code: str):
+        self.modules = Parser(code).modules()
+        self.summaries: Dict[str, Summary] = {}
+
+    def roots(self) -> List[str]:
+        """
+        :return: Names of the modules the design is made of: axis_top or top when they are not
+            instantiated, otherwise every module no other module instantiates
+        """
+        instantiated = {name for module in self.modules.values() for name, _ in module.instances}
+        roots = [name for name in self.modules if name not in instantiated]
+        # multiplier_module and adder_module are emitted even when no layer instantiates them
+        tops = [name for name in roots if name in ('axis_top', 'top')]
+        return tops or roots
+
+    def metrics(self) -> dict:
+        """
+        :return: Number of multipliers, adders, comparators and multiplexers, register and ROM
+            bits, and levels of logic on the longest path of the design made of the root
+            modules, and the same metrics for every module under 'modules'
+        """
+        design = dict.fromkeys(METRICS, 0)
+        design['logic_depth'] = 0
+        for root in self.roots():
+            metrics = self.summary(root).metrics()
+            for metric in METRICS:
+                design[metric] += metrics[metric]
+            design['logic_depth'] = max(design['logic_depth'], metrics['logic_depth'])
+        design['modules'] = {name: self.summary(name).metrics() for name in self.modules}
+        return design
+
+    def summary(self, name: str) -> Summary:
+        if name not in self.summaries:
+            self.summaries[name] = self.summarize(self.modules[name])
+        return self.summaries[name]
+
+    def bits(self, module: Module, name: str) -> int:
+        """
+        :return: Number of bits of a signal or memory, with the parameters at their defaults
+        """
+        bits = 1
+        for bounds in (module.ranges.get(name), module.arrays.get(name)):
+            if bounds is not None:
+                high, low = (constant_value(bound, module.parameters) for bound in bounds)
+                bits *= abs(high - low) + 1
+        return bits
+
+    def connections(self, module: Module) -> List[Tuple[Module, List[Tuple[str, tuple]]]]:
+        """
+        :return: For every instance of a module defined in the file, the module and its (port, expression) pairs
+        """
+        instances = []
+        for name, connections in module.instances:
+            if name not in self.modules:
+                continue
+            instance = self.modules[name]
+            instances.append((instance, [(port if port is not None else instance.ports[k], expression)
+                                         for k, (port, expression) in enumerate(connections)]))
+        return instances
+
+    def summarize(self, module: Module) -> Summary:
+        summary = Summary()
+        counts = summary.counts
+        instances = self.connections(module)
+
+        for _, expression in module.assigns:
+            count_operators(expression, module.signals, counts)
+        for clocked, statement in module.blocks:
+            # the conditions of a clocked block enable registers instead of selecting values
+            count_statement(statement, module.signals, counts, None if clocked else False)
+        for instance, ports in instances:
+            for _, expression in ports:
+                count_operators(expression, module.signals, counts)
+            for metric, value in self.summary(instance.name).counts.items():
+                counts[metric] += value
+
+        # every signal is driven by an assign, a combinational block, a register or an instance
+        registers, drivers = set(), {}
+        for target, _ in module.assigns:
+            drivers[target] = ('assign', target)
+        for k, (clocked, statement) in enumerate(module.blocks):
+            for target in statement_writes(statement):
+                if clocked:
+                    registers.add(target)
+                else:
+                    drivers[target] = ('block', k)
+        for k, (instance, ports) in enumerate(instances):
+            for port, expression in ports:
+                if instance.directions.get(port) == 'output':
+                    for target in identifiers(expression):
+                        drivers[target] = ('instance', k)
+
+        counts['register_bits'] += sum(self.bits(module, name) for name in registers)
+        counts['rom_bits'] += sum(self.bits(module, name) for name in module.arrays
+                                  if name not in registers and name not in drivers)
+
+        assigns = {}
+        for target, expression in module.assigns:
+            assigns.setdefault(target, []).append(expression)
+        reads = {}
+        for target in assigns:
+            reads[('assign', target)] = [name for expression in assigns[target] for name in identifiers(expression)]
+        for k, (clocked, statement) in enumerate(module.blocks):
+            reads[('block', k)] = list(statement_reads(statement))
+        for k, (instance, ports) in enumerate(instances):
+            reads[('instance', k)] = [name for port, expression in ports
+                                      if instance.directions.get(port) != 'output' for name in identifiers(expression)]
+
+        values: Dict[str, Depth] = {}
+
+        def lookup(name: str) -> Depth:
+            if module.directions.get(name) == 'input':
+                return 0, -1
+            if name in registers:
+                return -1, 0
+            return values.get(name, NONE)
+
+        for node in evaluation_order(reads, drivers):
+            kind, key = node
+            if kind == 'assign':
+                depth = NONE
+                for expression in assigns[key]:
+                    depth = longest(depth, expression_depth(expression, lookup))
+                values[key] = depth
+            elif kind == 'block':
+                clocked, statement = module.blocks[key]
+                if clocked:
+                    summary.registers = longest(summary.registers, register_depth(statement, lookup, None))
+                else:
+                    local = {}
+                    combinational_depth(statement, lambda name: local[name] if name in local else lookup(name),
+                                        local, None)
+                    values.update(local)
+            else:
+                instance, ports = instances[key]
+                inner = self.summary(instance.name)
+                arrival = NONE
+                for port, expression in ports:
+                    if instance.directions.get(port) != 'output':
+                        arrival = longest(arrival, expression_depth(expression, lookup))
+
+                def through(depth: Depth) -> Depth:
+                    """
+                    :return: Depth in this module of a path of the given depth in the instance
+                    """
+                    from_inputs = deeper(arrival, depth[0]) if depth[0] >= 0 else NONE
+                    return longest(from_inputs, (-1, depth[1]))
+
+                summary.registers = longest(summary.registers, through(inner.registers))
+                for port, expression in ports:
+                    if port in inner.outputs:
+                        for target in identifiers(expression):
+                            values[target] = longest(values.get(target, NONE), through(inner.outputs[port]))
+
+        summary.outputs = {name: lookup(name) for name in module.ports if module.directions.get(name) == 'output'}
+        return summary
+
+
+def evaluation_order(reads: Dict[tuple, List[str]], drivers: Dict[str, tuple]) -> List[tuple]:
+    """
+    Order the drivers of a module so that every one comes after the drivers of the signals it reads
+    :param reads: Names read by every driver
+    :param drivers: Driver of every signal that is not an input or register
+    :return: The drivers in evaluation order, combinational loops are cut anywhere
+    """
+    order, visited = [], set()
+    for start in reads:
+        if start in visited:
+            continue
+        visited.add(start)
+        stack = [(start, iter(reads[start]))]
+        while stack:
+            node, pending = stack[-1]
+            for name in pending:
+                driver = drivers.get(name)
+                if driver is not None and driver not in visited:
+                    visited.add(driver)
+                    stack.append((driver, iter(reads[driver])))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
+def combinational_depth(statement: tuple, lookup, values: Dict[str, Depth], guard):
+    """
+    Run a statement of a combinational always block. A later statement reads the values assigned
+    by an earlier one, and an assignment under a condition adds a multiplexer.
+    :param statement: Statement
+    :param lookup: Function returning the current depth of a signal
+    :param values: Depth of the signals assigned so far, updated in place
+    :param guard: Depth of the conditions the statement depends on, None if it always runs
+    """
+    kind = statement[0]
+    if kind == 'block':
+        for inner in statement[1]:
+            combinational_depth(inner, lookup, values, guard)
+    elif kind == 'if':
+        condition = expression_depth(statement[1], lookup)
+        condition = condition if guard is None else longest(guard, condition)
+        combinational_depth(statement[2], lookup, values, condition)
+        combinational_depth(statement[3], lookup, values, condition)
+    elif kind == 'case':
+        selector = expression_depth(statement[1], lookup)
+        selector = selector if guard is None else longest(guard, selector)
+        for inner in statement[2]:
+            combinational_depth(inner, lookup, values, selector)
+    elif kind == 'assign':
+        _, target, index, expression = statement
+        depth = expression_depth(expression, lookup)
+        if guard is not None:
+            depth = deeper(longest(depth, guard), 1)
+        if guard is not None or index is not None:
+            # the other bits or branches keep the previous value
+            depth = longest(depth, values.get(target, NONE))
+        values[target] = depth
+
+
+def register_depth(statement: tuple, lookup, guard) -> Depth:
+    """
+    :param statement: Statement of a clocked always block
+    :param lookup: Function returning the depth of a signal
+    :param guard: Depth of the conditions the statement depends on, which enable the registers it assigns
+    :return: Depth of the deepest path into a register the statement assigns
+    """
+    kind = statement[0]
+    if kind == 'block':
+        depth = NONE
+        for inner in statement[1]:
+            depth = longest(depth, register_depth(inner, lookup, guard))
+        return depth
+    if kind == 'if':
+        condition = expression_depth(statement[1], lookup)
+        condition = condition if guard is None else longest(guard, condition)
+        return longest(register_depth(statement[2], lookup, condition), register_depth(statement[3], lookup, condition))
+    if kind == 'case':
+        selector = expression_depth(statement[1], lookup)
+        selector = selector if guard is None else longest(guard, selector)
+        depth = NONE
+        for inner in statement[2]:
+            depth = longest(depth, register_depth(inner, lookup, selector))
+        return depth
+    if kind == 'assign':
+        _, _, index, expression = statement
+        depth = expression_depth(expression, lookup)
+        if index is not None:
+            depth = longest(depth, expression_depth(index, lookup))
+        return depth if guard is None else longest(depth, guard)
+    return NONE
+
+
+def netlist_metrics(code: str) -> dict:
+    """
+    :param code: Verilog code emitted by the transpiler
+    :return: See Netlist.metrics
+    """
+    return Netlist(code).metrics()
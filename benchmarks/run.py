@@ -0,0 +1,214 @@
+"""
+Benchmark suite of the transpiler. Every benchmark builds a parametric model, transpiles it and
+records the wall time of parse_layers and forward_range, the wall time of the emission, the peak
+memory of both and the size of the Verilog, together with the design metrics read back from the
+netlist: multipliers, adders, comparators, multiplexers, register and ROM bits and logic depth.
+The results are written as JSON, and comparing them with an earlier run flags the benchmarks
+whose design or performance got worse.
+
+Usage: python -m benchmarks.run [--quick] [--output FILE] [--baseline FILE] [--tolerance T] [name ...]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+import numpy as np
+import torch
+
+from benchmarks.models import FRAC_RANGE, INT_RANGE, MODELS
+from benchmarks.netlist import METRICS, netlist_metrics
+from model.cache import transpiler_digest
+from model.model import Model
+from model.model_frac import Model as FracModel
+
+# metrics of the emitted design, any change of them is reported
+DESIGN_METRICS = METRICS + ('logic_depth', 'latency', 'file_bytes')
+# measured metrics, only reported when they grow by more than the tolerance and the given amount
+PERFORMANCE_METRICS = {'transpile_s': 0.01, 'emit_s': 0.01, 'peak_mib': 0.5}
+
+
+class Benchmark:
+    """
+    One model transpiled with one set of options
+    """
+
+    def __init__(self, model: str, frac: bool = False, options: dict = None, **params):
+        """
+        :param model: Name of the model builder in benchmarks.models
+        :param frac: Transpile with the fixed-point Model instead of the integer one
+        :param options: Keyword arguments of the Model constructor
+        :param params: Keyword arguments of the model builder, such as width and depth
+        """
+        self.model = model
+        self.frac = frac
+        self.options = options or {}
+        self.params = params
+
+    @property
+    def name(self) -> str:
+        parts = [self.model] + [f'{key}{value}' for key, value in self.params.items()]
+        parts.append('frac' if self.frac else 'int')
+        parts += [key if value is True else f'{key}{value}' for key, value in self.options.items()]
+        return '_'.join(parts)
+
+    def build(self):
+        """
+        :return: Transpiler model and the input ranges to size it with
+        """
+        torch_model = MODELS[self.model](frac=self.frac, **self.params)
+        model = FracModel(torch_model, **self.options) if self.frac else Model(torch_model, **self.options)
+        bound = FRAC_RANGE if self.frac else INT_RANGE
+        return model, [[-bound, bound]] * model.num_in
+
+    def run(self, path: str) -> dict:
+        """
+        Transpile the model to a file, then read the design metrics back from it
+        :param path: File the Verilog is written to
+        :return: Dictionary of the results
+        """
+        start = time.perf_counter()
+        model, ranges = self.build()
+        model.forward_range(ranges)
+        transpile = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(path, 'w') as f:
+            model.emit_to(f)
+        emit = time.perf_counter() - start
+
+        # a second run for the peak memory, so the tracing overhead does not end up in the times
+        tracemalloc.start()
+        traced, ranges = self.build()
+        traced.forward_range(ranges)
+        with open(path, 'w') as f:
+            traced.emit_to(f)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        with open(path) as f:
+            design = netlist_metrics(f.read())
+        modules = design.pop('modules')
+        design['latency'] = model.latency() if hasattr(model, 'latency') else 0
+        design['file_bytes'] = os.path.getsize(path)
+        return {'name': self.name, 'model': self.model, 'params': self.params, 'frac': self.frac,
+                'options': self.options, 'transpile_s': round(transpile, 4), 'emit_s': round(emit, 4),
+                'peak_mib': round(peak / 2 ** 20, 2), **design, 'modules': modules}
+
+
+QUICK_SUITE = [
+    Benchmark('mlp', width=8, depth=2),
+    Benchmark('mlp', width=8, depth=2, options={'reduction': 'tree'}),
+    Benchmark('mlp', width=8, depth=2, options={'pipeline': True, 'stages': 2}),
+    Benchmark('conv', length=8, channels=2, depth=1),
+    Benchmark('mlp', frac=True, width=8, depth=2),
+]
+
+SUITE = [
+    Benchmark('mlp', width=16, depth=2),
+    Benchmark('mlp', width=64, depth=2),
+    Benchmark('mlp', width=128, depth=2),
+    Benchmark('mlp', width=64, depth=4),
+    Benchmark('mlp', width=64, depth=2, options={'reduction': 'tree'}),
+    Benchmark('mlp', width=64, depth=2, options={'shift_add': True}),
+    Benchmark('mlp', width=64, depth=2, options={'pipeline': True, 'stages': 4}),
+    Benchmark('mlp', width=64, depth=2, options={'pipeline': True, 'parallelism': 4}),
+    Benchmark('conv', length=32, channels=4, depth=2),
+    Benchmark('conv', length=128, channels=4, depth=2),
+    Benchmark('conv', length=128, channels=4, depth=2, options={'pipeline': True, 'streaming': True}),
+    Benchmark('mlp', frac=True, width=16, depth=2),
+    Benchmark('mlp', frac=True, width=32, depth=2),
+    Benchmark('mlp', frac=True, width=32, depth=2, options={'reduction': 'tree'}),
+    Benchmark('mlp', frac=True, width=32, depth=2, options={'shift_add': True}),
+]
+
+
+def environment() -> dict:
+    """
+    :return: Versions and machine the results were measured with
+    """
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'torch': torch.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'transpiler': transpiler_digest()}
+
+
+def run(benchmarks: List[Benchmark]) -> dict:
+    """
+    :param benchmarks: Benchmarks to run
+    :return: Environment and the results of every benchmark, as written to the JSON file
+    """
+    results = []
+    print(f"{'benchmark':<56}{'transpile':>10}{'emit':>8}{'peak MiB':>9}{'KiB':>8}"
+          f"{'mults':>8}{'adders':>8}{'reg bits':>9}{'depth':>6}")
+    with tempfile.TemporaryDirectory() as directory:
+        for benchmark in benchmarks:
+            result = benchmark.run(os.path.join(directory, 'test.v'))
+            results.append(result)
+            print(f"{result['name']:<56}{result['transpile_s']:>10.3f}{result['emit_s']:>8.3f}"
+                  f"{result['peak_mib']:>9.1f}{result['file_bytes'] / 1024:>8.0f}{result['multipliers']:>8}"
+                  f"{result['adders']:>8}{result['register_bits']:>9}{result['logic_depth']:>6}")
+    return {'environment': environment(), 'results': results}
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """
+    Compare two runs benchmark by benchmark and print every change
+    :param baseline: Results of an earlier run
+    :param current: Results of this run
+    :param tolerance: Relative growth of the times and the memory that is still not a regression
+    :return: Descriptions of the regressions: design metrics that grew, and performance metrics that
+        grew by more than the tolerance
+    """
+    regressions = []
+    before = {result['name']: result for result in baseline['results']}
+    for result in current['results']:
+        old = before.get(result['name'])
+        if old is None:
+            continue
+        for metric in DESIGN_METRICS:
+            if metric in old and old[metric] != result[metric]:
+                change = f"{result['name']}: {metric} {old[metric]} -> {result[metric]}"
+                print(change)
+                if result[metric] > old[metric]:
+                    regressions.append(change)
+        for metric, minimum in PERFORMANCE_METRICS.items():
+            if result[metric] > old[metric] * (1 + tolerance) and result[metric] - old[metric] > minimum:
+                change = f"{result['name']}: {metric} {old[metric]} -> {result[metric]}"
+                print(change)
+                regressions.append(change)
+    if baseline['environment'].get('platform') != current['environment']['platform']:
+        print('The baseline was measured on another platform, compare the times with care')
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the transpiler and the designs it emits')
+    parser.add_argument('names', nargs='*', help='Only run the benchmarks whose name contains one of these')
+    parser.add_argument('--quick', action='store_true', help='Run the small models only')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Relative growth of the times and the memory that is not a regression')
+    args = parser.parse_args(argv)
+
+    benchmarks = QUICK_SUITE if args.quick else SUITE
+    if args.names:
+        benchmarks = [benchmark for benchmark in benchmarks if any(name in benchmark.name for name in args.names)]
+    results = run(benchmarks)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        print(f'{len(regressions)} regressions against {args.baseline}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
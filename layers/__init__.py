@@ -1,4 +1,4 @@
-from layers import linear, relu, maxpool, conv, sigmoid, linear_frac
+from layers import linear, relu, maxpool, conv, sigmoid, linear_frac, requant
 
 Linear = linear.Linear
 LinearFrac = linear_frac.Linear
@@ -6,6 +6,8 @@ ReLU = relu.ReLU
 MaxPool = maxpool.MaxPool
 Conv1D = conv.Conv1D
 Sigmoid = sigmoid.Sigmoid
+Requant = requant.Requant
+Requantize = requant.Requantize
 
-__all__ = ["Linear", "ReLU", "MaxPool", "Conv1D", "Sigmoid", "LinearFrac"   ]
+__all__ = ["Linear", "ReLU", "MaxPool", "Conv1D", "Sigmoid", "LinearFrac", "Requant", "Requantize"]
 
@@ -0,0 +1,114 @@
+from typing import Iterator, List, Sequence, Tuple
+
+from layers.relu import relu_output
+from layers.shift_add import multiply
+from layers.utils import signed_range_to_bits, port_bounds
+
+
+def build_adder_tree(prefix: str, leaves: List[Tuple[str, int, int]]):
+    """
+    Pair up the leaves level by level into a balanced binary tree, so the adder depth is
+    log2 of the number of leaves instead of linear. An odd node out is passed on to the next level.
+    :param prefix: Prefix of the node names
+    :param leaves: (name, low, high) of every leaf, with the integer range of its value
+    :return: The adders as (name, left, right, low, high) in dependency order, and (name, low, high) of the root
+    """
+    nodes = []
+    level = list(leaves)
+    depth = 0
+
+    while len(level) > 1:
+        depth += 1
+        next_level = []
+        for k in range(0, len(level) - 1, 2):
+            (left, left_low, left_high), (right, right_low, right_high) = level[k], level[k + 1]
+            name = f"{prefix}_l{depth}_{k // 2}"
+            nodes.append((name, left, right, left_low + right_low, left_high + right_high))
+            next_level.append((name, left_low + right_low, left_high + right_high))
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+
+    return nodes, level[0]
+
+
+def node_bits(low: int, high: int, max_bits: int) -> int:
+    """
+    Width of a tree node: just wide enough for its range, but never wider than the result it
+    feeds, since two's complement sums are exact modulo the result width anyway
+    :param low: Lower bound of the node value
+    :param high: Upper bound of the node value
+    :param max_bits: Width of the result of the tree
+    :return: Number of bits
+    """
+    return min(signed_range_to_bits(low, high), max_bits)
+
+
+def balanced_sum(exprs: List[str]) -> str:
+    """
+    Parenthesize a sum as a balanced tree, so synthesis does not build a linear chain
+    :param exprs: Operands
+    :return: Verilog expression
+    """
+    if len(exprs) == 1:
+        return exprs[0]
+    middle = (len(exprs) + 1) // 2
+    return f"({balanced_sum(exprs[:middle])} + {balanced_sum(exprs[middle:])})"
+
+
+def emit_tree_mac(name: str, in_bits, out_bits, in_range, terms: Sequence[List[Tuple[int, int, str]]], bias,
+                  roms: str = '', shift_add=None, relu_bits=None, outputs: range = None) -> Iterator[str]:
+    """
+    Emit a combinational multiply-accumulate module whose products are summed by balanced adder
+    trees. Every product and every adder gets its own wire, sized from the input ranges found by
+    forward_range.
+    :param name: Module name
+    :param in_bits: Bit width of every input
+    :param out_bits: Bit width of the result of every dot product
+    :param in_range: Array of shape (num_inputs, 2) with the range of every input
+    :param terms: For every output, a list of (input index, weight, weight expression) triples
+    :param bias: For every output, the expression added at the root, or None
+    :param roms: Declarations of the ROMs the weight expressions read from
+    :param shift_add: ShiftAdd networks of the inputs to build the products from instead of multipliers
+    :param relu_bits: Bit width of every output of a ReLU fused into the module, None for the results
+    :param outputs: Only emit the logic of these outputs, see Emitter.split_outputs
+    :return: Iterator over the Verilog code, one chunk per output
+    """
+    num_in, num_out = len(in_bits), len(terms)
+    port_bits = out_bits if relu_bits is None else relu_bits
+    low, high = port_bounds(in_range, in_bits)
+    outputs = range(num_out) if outputs is None else outputs
+
+    if outputs.start == 0:
+        yield f"""
+module {name}({",".join(f"in{j}" for j in range(num_in))}, {",".join(f"out{i}" for i in range(num_out))});
+"""
+        yield ''.join(f"    input signed [{in_bits[j] - 1}:0] in{j};\n" for j in range(num_in))
+        yield ''.join(f"    output signed [{port_bits[i] - 1}:0] out{i};\n" for i in range(num_out))
+        yield f"    {roms}\n"
+        if shift_add is not None:
+            yield shift_add.declarations((j, f"in{j}", in_bits[j]) for j in sorted(shift_add.networks))
+
+    for i in outputs:
+        # the wires of an output are declared right before the logic that drives them
+        wire_definitions = []
+        tree_logic = []
+        leaves = []
+        for j, weight, literal in terms[i]:
+            products = (int(low[j]) * int(weight), int(high[j]) * int(weight))
+            leaf = (f"prod{i}_{j}", min(products), max(products))
+            wire_definitions.append(f"    wire signed [{node_bits(leaf[1], leaf[2], out_bits[i]) - 1}:0] {leaf[0]};\n")
+            tree_logic.append(f"    assign {leaf[0]} = {multiply(shift_add, j, f'in{j}', weight, literal)};\n")
+            leaves.append(leaf)
+
+        nodes, root = build_adder_tree(f"sum{i}", leaves) if leaves else ([], ("0", 0, 0))
+        for node, left, right, node_low, node_high in nodes:
+            wire_definitions.append(f"    wire signed [{node_bits(node_low, node_high, out_bits[i]) - 1}:0] {node};\n")
+            tree_logic.append(f"    assign {node} = {left} + {right};\n")
+
+        tree_logic.append(relu_output(i, f"{root[0]}{f' + {bias[i]}' if bias is not None else ''}", out_bits[i],
+                                      relu_bits is not None))
+        yield ''.join(wire_definitions) + ''.join(tree_logic)
+
+    if outputs.stop == num_out:
+        yield "endmodule\n"
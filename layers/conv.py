@@ -1,118 +1,368 @@
 import numpy as np
-from layers.utils import range_to_bits
+from layers.adder_tree import emit_tree_mac
+from layers.emitter import Emitter, LazyRows
+from layers.intervals import cached_map, dot_growth_bits, relu_range
+from layers.line_buffer import emit_line_buffer_conv, line_buffer_cycles, line_buffer_resources
+from layers.pipeline import emit_pipelined_mac, split_stages
+from layers.relu import relu_output
+from layers.rom import rom_bits, rom_declaration, write_rom
+from layers.shift_add import ShiftAdd, multiply
+from layers.utils import integral, signed_ranges_to_bits, wrap_signed
 
-class Conv1D:
+class Conv1D(Emitter):
     @classmethod
     def layer_from(cls, layer, index: int, num_inputs: int):
-        if layer.out_channels != 1 or layer.in_channels != 1:
-            raise ValueError('Only single-channel IO is supported at the moment.')
+        if layer.groups != 1:
+            raise ValueError('Grouped convolutions are not supported')
+        if layer.padding_mode != 'zeros':
+            raise ValueError(f'Unsupported padding mode {layer.padding_mode}')
+        padding = layer.padding
+        if isinstance(padding, str):
+            # 'same' pads both ends equally, which torch only does for an even number of zeros
+            total = layer.dilation[0] * (layer.kernel_size[0] - 1) if padding == 'same' else 0
+            if total % 2:
+                raise ValueError("Padding 'same' with an odd number of zeros is not supported")
+            padding = (total // 2,)
         return cls(
             in_channels=layer.in_channels,
+            out_channels=layer.out_channels,
             kernel_size=layer.kernel_size[0],
-            weight=layer.weight.detach().numpy()[0][0],
-            bias=layer.bias.detach().numpy()[0] if layer.bias is not None else None,
+            weight=integral(layer.weight.detach().numpy()),
+            bias=integral(layer.bias.detach().numpy()) if layer.bias is not None else None,
             index=index,
-            num_inputs=num_inputs
+            num_inputs=num_inputs,
+            stride=layer.stride[0],
+            padding=padding[0],
+            dilation=layer.dilation[0],
         )
 
-    def __init__(self, in_channels: int, kernel_size: int, 
-                 weight: np.ndarray, bias: float, index: int, num_inputs: int):
+    def __init__(self, in_channels: int, out_channels: int, kernel_size: int, weight: np.ndarray, bias: np.ndarray,
+                 index: int, num_inputs: int, stride: int = 1, padding: int = 0, dilation: int = 1):
+        """
+        Inputs and outputs are numbered channel by channel, like a flattened (channels, length) tensor
+        :param weight: Kernel of shape (out_channels, in_channels, kernel_size)
+        :param bias: Bias of shape (out_channels,), or None
+        :param num_inputs: Number of inputs, in_channels times the length of every channel
+        """
         self.in_channels = in_channels
+        self.out_channels = out_channels
         self.kernel_size = kernel_size
         self.num_inputs = num_inputs
+        self.stride = stride
+        self.padding = padding
+        self.dilation = dilation
         self.weight = weight
         self.bias = bias
-        self.name = f'layer_{index}_conv1d_{in_channels}_{kernel_size}'
-        
+        self.index = index
+        self.name = f'layer_{index}_conv1d_{in_channels}_{out_channels}_{kernel_size}'
+
+        self.in_length = num_inputs // in_channels
+        self.out_length = (self.in_length + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
         self.verify_weights()
         self.in_bits, self.out_bits = None, None
-        self.shape = (num_inputs - kernel_size + 1,)  # Output shape
+        # width of the result of every dot product, out_bits unless a ReLU is fused into the layer
+        self.mac_bits = None
+        # apply a ReLU to the results inside this module instead of in a layer of its own, not streaming
+        self.relu = False
+        # number of register stages the dot products are split into, 0 for a combinational layer
+        self.stages = 0
+        # feed the inputs through a line buffer one position per clock cycle and reuse one set of MACs
+        self.streaming = False
+        # 'chain' accumulates the products one after the other, 'tree' sums them in a balanced adder tree
+        self.reduction = 'chain'
+        self.in_range = None
+        # prepared weights for range propagation, rebuilt when the weights are replaced
+        self.weight_map = None
+        # path prefix of the .mem files the constants are read from, None to inline them as literals
+        self.rom_prefix = None
+        # build the products from shifts and adds of the inputs instead of multipliers
+        self.shift_add = False
+        self.shape = (out_channels * self.out_length,)  # Output shape
 
     def __str__(self):
-        return f'Conv1D({self.in_channels}->{1}, k={self.kernel_size})'
+        return (f'Conv1D({self.in_channels}->{self.out_channels}, k={self.kernel_size}, s={self.stride}, '
+                f'p={self.padding}, d={self.dilation}){" + ReLU" if self.relu else ""}')
 
     def verify_weights(self):
         if self.weight is None:
             raise ValueError('Weight is not defined')
-        
-        weight_shape = (self.kernel_size, )  # Only 1 output channel
+
+        if self.num_inputs != self.in_channels * self.in_length:
+            raise ValueError(f'{self.num_inputs} inputs can not be split into {self.in_channels} channels')
+        if self.out_length < 1:
+            raise ValueError(f'Kernel does not fit into the {self.in_length} positions of every channel')
+
+        weight_shape = (self.out_channels, self.in_channels, self.kernel_size)
         if self.weight.shape != weight_shape:
             raise ValueError(f'Weight shape is not correct, expected {weight_shape}, got {self.weight.shape}')
 
-    def forward_range(self, in_range: np.ndarray):
-        # Calculate worst-case ranges for convolution
-        weight_pos = np.maximum(self.weight, 0)
-        weight_neg = np.minimum(self.weight, 0)
-        
-        out_length = self.num_inputs - self.kernel_size + 1
-        out_range = np.zeros((out_length, 2))
-        
-        for i in range(out_length):
-            window_range = in_range[i:i + self.kernel_size]
-            min_val = np.sum(weight_pos * window_range[:, 0] + weight_neg * window_range[:, 1])
-            max_val = np.sum(weight_pos * window_range[:, 1] + weight_neg * window_range[:, 0])
-            
-            if self.bias is not None:
-                min_val += self.bias
-                max_val += self.bias
-                
-            out_range[i] = [min_val, max_val]
-        
-        self.in_bits = [range_to_bits(*r) for r in in_range]
-        self.out_bits = [range_to_bits(*r) for r in out_range]
-        
+        if self.bias is not None and self.bias.shape != (self.out_channels,):
+            raise ValueError(f'Bias shape is not correct, expected {(self.out_channels,)}, got {self.bias.shape}')
+
+    def windows(self):
+        """
+        :return: int64 array of shape (out_length, in_channels * kernel_size) with the input index
+            under every tap of every window, or num_inputs where the tap falls on the padding
+        """
+        taps = np.arange(self.out_length)[:, None] * self.stride - self.padding \
+            + np.arange(self.kernel_size)[None, :] * self.dilation
+        inside = (taps >= 0) & (taps < self.in_length)
+        index = np.arange(self.in_channels)[None, :, None] * self.in_length + taps[:, None, :]
+
+        return np.where(inside[:, None, :], index, self.num_inputs).reshape(self.out_length, -1)
+
+    def kernel_matrix(self):
+        """
+        :return: Kernel of shape (in_channels * kernel_size, out_channels), matching the columns of windows()
+        """
+        return self.weight.reshape(self.out_channels, -1).T
+
+    def dense_weight(self):
+        """
+        :return: The convolution as a matrix of shape (num_inputs, out_channels * out_length), laid
+            out like the weight of a Linear layer, with the taps on the padding left out
+        """
+        windows, kernel = self.windows(), self.kernel_matrix()
+        # the last row collects the taps on the padding
+        weight = np.zeros((self.num_inputs + 1, self.shape[0]), dtype=kernel.dtype)
+        for t in range(self.out_length):
+            outputs = np.arange(self.out_channels) * self.out_length + t
+            np.add.at(weight, (windows[t][:, None], outputs[None, :]), kernel)
+        return weight[:-1]
+
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        """
+        :param in_range: Array of shape (num_inputs, 2) with the range of every input
+        :param out_range: Observed ranges of the dot products, e.g. from Model.calibrate, used instead of
+            the propagated ones
+        :return: Array with the range of every output, after the fused ReLU if any
+        """
+        in_range = np.asarray(in_range, dtype=np.float64)[:self.num_inputs]
+        if out_range is None:
+            # the padding is an extra input that is always 0
+            padded = np.concatenate([in_range, np.zeros((1, 2))])[self.windows()]
+            self.weight_map = cached_map(self.weight_map, self.kernel_matrix())
+            out_range = self.weight_map.range(padded[..., 0], padded[..., 1], self.bias)
+            out_range = out_range.transpose(1, 0, 2).reshape(-1, 2)
+
+        self.in_range = in_range
+        self.in_bits = signed_ranges_to_bits(in_range)
+        self.mac_bits = signed_ranges_to_bits(out_range)
+        if self.relu:
+            out_range = relu_range(out_range)
+        self.out_bits = signed_ranges_to_bits(out_range)
+
         return out_range
 
-    def emit(self):
+    def growth_bits(self):
+        """
+        :return: Width of every output if it were sized by word growth instead of forward_range
+        """
+        growth = dot_growth_bits(self.in_bits, self.kernel_matrix(), self.bias)
+        return np.repeat(growth, self.out_length)
+
+    def simulate(self, batch: np.ndarray):
+        """
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once
+        :param batch: Integer array of shape (N, num_inputs) holding the values on the input nets
+        :return: int64 array of shape (N, out_channels * out_length) holding the values on the output ports
+        """
+        if np.any(self.weight != np.round(self.weight)):
+            raise ValueError('Integer simulation requires integer weights')
+
+        values = wrap_signed(batch, self.in_bits)
+        values = np.concatenate([values, np.zeros((len(values), 1), dtype=np.int64)], axis=1)
+        acc = values[:, self.windows()] @ self.kernel_matrix().astype(np.int64)
+        if self.bias is not None:
+            acc = acc + self.bias.astype(np.int64)
+
+        acc = wrap_signed(acc.transpose(0, 2, 1).reshape(len(values), -1), self.mac_bits)
+        return wrap_signed(np.maximum(acc, 0), self.out_bits) if self.relu else acc
+
+    def latency(self):
+        """
+        :return: Clock cycles between in_valid and out_valid, 0 for a combinational layer
+        """
+        if self.streaming:
+            return line_buffer_cycles(self.out_length, self.kernel_size, self.stride, self.dilation)
+        return self.stages
+
+    def interval(self):
+        """
+        :return: Minimum number of clock cycles between two vectors entering the layer
+        """
+        if self.streaming:
+            return line_buffer_cycles(self.out_length, self.kernel_size, self.stride, self.dilation)
+        return 1
+
+    def resources(self):
+        """
+        Estimate the hardware this layer is emitted as
+        :return: Dictionary with the number of multipliers and adders, the register bits and the ROM bits
+        """
+        weight = self.weight.astype(np.int64)
+        rom = weight.size * rom_bits(weight) if self.rom_prefix else 0
+        if self.streaming:
+            usage = line_buffer_resources(self.in_bits, self.mac_bits, weight, self.num_inputs, self.out_length,
+                                          self.stride, self.dilation)
+            if self.shift_add:
+                usage['multipliers'] = 0
+                usage['adders'] = int(np.count_nonzero(weight)) + self.tap_shift_add().adders()
+            return {**usage, 'rom_bits': rom}
+
+        # taps on the padding and zero weights are not emitted
+        taps = np.sum(self.windows() < self.num_inputs, axis=0)
+        products = int(taps @ np.count_nonzero(self.kernel_matrix(), axis=1))
+        register_bits = 0
+        if self.stages:
+            register_bits += self.stages * int(sum(self.mac_bits))
+            for s, chunk in enumerate(split_stages(list(range(self.num_inputs)), self.stages)):
+                register_bits += s * int(sum(self.in_bits[j] for j in chunk))
+
+        if self.shift_add:
+            return {'multipliers': 0, 'adders': products + ShiftAdd.from_terms(self.terms()).adders(),
+                    'register_bits': register_bits, 'rom_bits': rom}
+        return {'multipliers': products, 'adders': products, 'register_bits': register_bits, 'rom_bits': rom}
+
+    def weight_literal(self, o: int, r: int):
+        """
+        :param o: Output channel
+        :param r: Row of kernel_matrix(), input channel times kernel_size plus tap
+        :return: Verilog expression of the weight
+        """
+        if self.rom_prefix:
+            return f"weight_rom[{o * self.in_channels * self.kernel_size + r}]"
+        return str(self.kernel_matrix()[r, o])
+
+    def terms(self):
+        """
+        :return: For every output, the (input index, weight, weight expression) triples of its dot
+            product without the taps on the padding and the zero weights, built when the output is accessed
+        """
+        windows, kernel = self.windows(), self.kernel_matrix()
+
+        def output_terms(i):
+            o, t = divmod(i, self.out_length)
+            return [(j, kernel[r, o], self.weight_literal(o, r)) for r, j in enumerate(windows[t])
+                    if j < self.num_inputs and kernel[r, o] != 0]
+
+        return LazyRows(self.shape[0], output_terms)
+
+    def channel_terms(self):
+        """
+        :return: For every output channel, the (input channel, tap, weight, weight expression) tuples of
+            its kernel without the zero weights
+        """
+        kernel = self.kernel_matrix()
+        return [[(r // self.kernel_size, r % self.kernel_size, kernel[r, o], self.weight_literal(o, r))
+                 for r in np.flatnonzero(kernel[:, o])] for o in range(self.out_channels)]
+
+    def tap_shift_add(self):
+        """
+        :return: ShiftAdd networks of the line buffer, one per input channel and tap shared by all output channels
+        """
+        kernel = self.kernel_matrix()
+        return ShiftAdd({(r // self.kernel_size, r % self.kernel_size): kernel[r] for r in range(len(kernel))})
+
+    def bias_terms(self):
+        """
+        :return: Expression of the bias of every output channel, or None
+        """
+        if self.bias is None:
+            return None
+        return [f"bias_rom[{o}]" if self.rom_prefix else str(b) for o, b in enumerate(self.bias)]
+
+    def write_roms(self):
+        """
+        Write the kernel and the bias of this layer to the .mem files under rom_prefix
+        """
+        write_rom(f"{self.rom_prefix}_weights.mem", self.weight.astype(np.int64).ravel())
+        if self.bias is not None:
+            write_rom(f"{self.rom_prefix}_bias.mem", self.bias.astype(np.int64))
+
+    def rom_declarations(self):
+        """
+        :return: Verilog declarations of the ROMs written by write_roms, empty when the constants are inlined
+        """
+        if not self.rom_prefix:
+            return ''
+        weight = self.weight.astype(np.int64)
+        declarations = [rom_declaration("weight_rom", rom_bits(weight), weight.size,
+                                        f"{self.rom_prefix}_weights.mem")]
+        if self.bias is not None:
+            bias = self.bias.astype(np.int64)
+            declarations.append(rom_declaration("bias_rom", rom_bits(bias), self.out_channels,
+                                                f"{self.rom_prefix}_bias.mem"))
+        return '    '.join(declarations)
+
+    def split_outputs(self) -> int:
+        """
+        :return: Number of outputs emit_chunks can be split over, see Emitter.split_outputs. Line
+            buffers and shift-add networks are shared by all outputs, so they are emitted as a whole.
+        """
+        return 0 if self.streaming or self.shift_add else self.shape[0]
+
+    def emit_chunks(self, outputs: range = None):
         """
         Emit Verilog code for 1D convolution
+        :param outputs: Only emit the logic of these outputs, see Emitter.split_outputs
+        :return: Iterator over the Verilog code, one chunk per output for the dot products
         """
+        roms, channel_bias = self.rom_declarations(), self.bias_terms()
+        if self.streaming:
+            shift_add = self.tap_shift_add() if self.shift_add else None
+            yield from emit_line_buffer_conv(self.name, self.in_bits, self.mac_bits, self.in_channels,
+                                             self.out_channels, self.kernel_size, self.stride, self.padding,
+                                             self.dilation, self.channel_terms(), channel_bias, roms=roms,
+                                             shift_add=shift_add)
+            return
+
+        terms = self.terms()
+        bias = [b for b in channel_bias for _ in range(self.out_length)] if channel_bias is not None else None
+        shift_add = ShiftAdd.from_terms(terms) if self.shift_add else None
+        relu_bits = self.out_bits if self.relu else None
+        if self.stages:
+            yield from emit_pipelined_mac(self.name, self.in_bits, self.mac_bits, terms, bias, self.stages,
+                                          tree=self.reduction == 'tree', roms=roms, shift_add=shift_add,
+                                          relu_bits=relu_bits, outputs=outputs)
+            return
+        if self.reduction == 'tree':
+            yield from emit_tree_mac(self.name, self.in_bits, self.mac_bits, self.in_range, terms, bias, roms=roms,
+                                     shift_add=shift_add, relu_bits=relu_bits, outputs=outputs)
+            return
+
+        out_length = self.shape[0]
         in_params = [f"in{i}" for i in range(self.num_inputs)]
-        out_params = [f"out{i}" for i in range(self.num_inputs - self.kernel_size + 1)]
-
-        in_definitions = [
-            f"input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
-            for i in range(self.num_inputs)
-        ]
-
-        out_definitions = [
-            f"output signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
-            for i in range(self.num_inputs - self.kernel_size + 1)
-        ]
-
-        # Generate multiplication and accumulation logic
-        conv_logic = []
-        for i in range(self.num_inputs - self.kernel_size + 1):
-            conv_logic.append(f"mul{i} = 0;\n")
-            for k in range(self.kernel_size):
-                weight_val = self.weight[k]
-                conv_logic.append(f"mul{i} = mul{i} + {in_params[i + k]} * {weight_val};\n")
-            if self.bias is not None:
-                conv_logic.append(f"add{i} = mul{i} + {self.bias};\n")
-
-        mul_definitions = [
-            f"reg signed [{self.out_bits[i] - 1}:0] mul{i};\n"
-            for i in range(self.num_inputs - self.kernel_size + 1)
-        ]
-        add_definitions = [
-            f"reg signed [{self.out_bits[i] - 1}:0] add{i};\n"
-            for i in range(self.num_inputs - self.kernel_size + 1)
-        ]
-
-        assigns = [f"assign {out_params[i]} = add{i};\n" for i in range(self.num_inputs - self.kernel_size + 1)]
-
-        return f"""
+        out_params = [f"out{i}" for i in range(out_length)]
+        outputs = range(out_length) if outputs is None else outputs
+
+        if outputs.start == 0:
+            yield f"""
 module {self.name}({",".join(in_params)}, {",".join(out_params)});
-    {'    '.join(in_definitions)}
-    {'    '.join(out_definitions)}
-    
-    {'    '.join(mul_definitions)}
-    {'    '.join(add_definitions)}
-        
-    always @(*)
-    begin
-        {'        '.join(conv_logic)}
-    end
-    {'    '.join(assigns)}
-endmodule
-""" 
\ No newline at end of file
+"""
+            yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
+                          for i in range(self.num_inputs))
+            yield ''.join(f"    output signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
+                          for i in range(out_length))
+            yield ''.join(f"    reg signed [{self.mac_bits[i] - 1}:0] mul{i};\n" for i in range(out_length))
+            yield ''.join(f"    reg signed [{self.mac_bits[i] - 1}:0] add{i};\n" for i in range(out_length))
+            yield f"    {roms}\n"
+            if shift_add is not None:
+                yield shift_add.declarations((j, in_params[j], self.in_bits[j]) for j in sorted(shift_add.networks))
+
+            # Generate multiplication and accumulation logic
+            yield "    always @(*)\n    begin\n"
+        for i in outputs:
+            conv_logic = [f"        mul{i} = 0;\n"]
+            for j, weight, literal in terms[i]:
+                conv_logic.append(f"        mul{i} = mul{i} + {multiply(shift_add, j, in_params[j], weight, literal)};\n")
+            if bias is not None:
+                conv_logic.append(f"        add{i} = mul{i} + {bias[i]};\n")
+            else:
+                conv_logic.append(f"        add{i} = mul{i};\n")
+            yield ''.join(conv_logic)
+        if outputs.stop != out_length:
+            return
+        yield "    end\n"
+        yield ''.join(relu_output(i, f"add{i}", self.mac_bits[i], self.relu) for i in range(out_length))
+        yield "endmodule\n"
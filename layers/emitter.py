@@ -0,0 +1,61 @@
+from typing import Callable, Iterator, Sequence
+
+
+class Emitter:
+    """
+    Base class of everything that emits Verilog. Subclasses implement emit_chunks(), a generator
+    that yields the code piece by piece, so a design can be written to a file without ever
+    holding its whole text in memory.
+    """
+
+    def emit_chunks(self) -> Iterator[str]:
+        """
+        :return: Iterator over consecutive pieces of the Verilog code
+        """
+        raise NotImplementedError
+
+    def split_outputs(self) -> int:
+        """
+        Layers that emit their logic output by output can be emitted in parts: emit_chunks(outputs)
+        with a range of outputs only yields the logic of those outputs, the module header too if
+        the range starts at the first output and the end of the module if it ends at the last one,
+        so the parts of consecutive ranges add up to the whole module
+        :return: Number of outputs emit_chunks can be split over, 0 if the layer is emitted as a whole
+        """
+        return 0
+
+    def emit(self) -> str:
+        """
+        :return: Verilog code
+        """
+        return ''.join(self.emit_chunks())
+
+    def emit_to(self, fp):
+        """
+        Write the Verilog code to a file chunk by chunk
+        :param fp: Text file object
+        """
+        fp.writelines(self.emit_chunks())
+
+
+class LazyRows(Sequence):
+    """
+    Sequence whose rows are built when they are accessed and not kept, for per-output data such as
+    the terms of a dot product that would take a lot of memory for all outputs at once
+    """
+
+    def __init__(self, count: int, row: Callable[[int], list]):
+        """
+        :param count: Number of rows
+        :param row: Function building row i
+        """
+        self.count = count
+        self.row = row
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.row(i)
@@ -0,0 +1,167 @@
+import math
+from typing import Iterator
+
+import numpy as np
+
+from layers.rom import rom_declaration
+from layers.utils import signed_range_to_bits
+
+
+def counter_bits(count: int) -> int:
+    """
+    :param count: Number of values the counter has to hold
+    :return: Width of an unsigned counter for the values 0 .. count - 1
+    """
+    return max(1, math.ceil(math.log2(max(count, 2))))
+
+
+def folded_cycles(in_features: int, out_features: int, parallelism: int) -> int:
+    """
+    Cycles a folded layer needs per inference: one to capture the inputs and one per weight
+    handled by each MAC unit. A new vector is accepted once the previous one is done, so this is
+    both the latency and the initiation interval.
+    :param in_features: Number of inputs
+    :param out_features: Number of outputs
+    :param parallelism: Number of MAC units
+    :return: Number of clock cycles
+    """
+    return math.ceil(out_features / parallelism) * in_features + 1
+
+
+def folded_resources(in_bits, out_bits, weight: np.ndarray, parallelism: int):
+    """
+    Resource estimate of the module emitted by emit_folded_mac
+    :param in_bits: Bit width of every input
+    :param out_bits: Bit width of every output
+    :param weight: Integer weights of shape (in_features, out_features)
+    :param parallelism: Number of MAC units
+    :return: Dictionary with the number of multipliers and adders, the register bits and the ROM bits
+    """
+    in_features, out_features = weight.shape
+    groups = math.ceil(out_features / parallelism)
+    weight_bits = signed_range_to_bits(weight.min(), weight.max())
+    acc_bits = max(out_bits)
+
+    return {
+        'multipliers': parallelism,
+        'adders': parallelism,
+        'register_bits': in_features * max(in_bits) + parallelism * acc_bits + int(sum(out_bits))
+                         + counter_bits(in_features) + counter_bits(groups) + counter_bits(groups * in_features) + 2,
+        'rom_bits': parallelism * groups * in_features * weight_bits,
+    }
+
+
+def folded_rom(weight: np.ndarray, parallelism: int):
+    """
+    Lay the weights out for the MAC units of a folded layer
+    :param weight: Integer weights of shape (in_features, out_features)
+    :param parallelism: Number of MAC units
+    :return: Array of shape (parallelism, groups * in_features), where word g * in_features + j of
+        unit p is the weight of input j for output g * parallelism + p, or 0 past the last output
+    """
+    in_features, out_features = weight.shape
+    groups = math.ceil(out_features / parallelism)
+    padded = np.zeros((in_features, groups * parallelism), dtype=np.int64)
+    padded[:, :out_features] = weight
+
+    return padded.reshape(in_features, groups, parallelism).transpose(2, 1, 0).reshape(parallelism, -1)
+
+
+def emit_folded_mac(name: str, in_bits, out_bits, weight: np.ndarray, bias, parallelism: int, rom_prefix: str = None,
+                    roms: str = '') -> Iterator[str]:
+    """
+    Emit a time-multiplexed multiply-accumulate module that computes a layer with `parallelism`
+    MAC units. Unit p computes the outputs p, p + P, p + 2P, ... one after the other, consuming one
+    input per clock cycle, with its weights read from a ROM. The inputs are captured when in_valid
+    is high and the module is idle, and out_valid is high for one cycle when all outputs are ready.
+    :param name: Module name
+    :param in_bits: Bit width of every input
+    :param out_bits: Bit width of every output
+    :param weight: Integer weights of shape (in_features, out_features)
+    :param bias: Expression of the bias of every output, or None
+    :param parallelism: Number of MAC units
+    :param rom_prefix: Load the weights of unit p from {rom_prefix}_unit{p}.mem instead of inlining them
+    :param roms: Declarations of the ROMs the bias expressions read from
+    :return: Iterator over the Verilog code, one chunk per MAC unit for the inlined ROM contents
+    """
+    in_features, out_features = weight.shape
+    groups = math.ceil(out_features / parallelism)
+    weight_bits = signed_range_to_bits(weight.min(), weight.max())
+    acc_bits = max(out_bits)
+    in_word = max(in_bits)
+    j_bits, g_bits, addr_bits = counter_bits(in_features), counter_bits(groups), counter_bits(groups * in_features)
+
+    yield f"""
+module {name}(clk, rst, in_valid, {",".join(f"in{j}" for j in range(in_features))}, {",".join(f"out{i}" for i in range(out_features))}, out_valid);
+    input clk;
+    input rst;
+    input in_valid;
+    output reg out_valid;
+"""
+    yield ''.join(f"    input signed [{in_bits[j] - 1}:0] in{j};\n" for j in range(in_features))
+    yield ''.join(f"    output reg signed [{out_bits[i] - 1}:0] out{i};\n" for i in range(out_features))
+    yield f"\n    reg signed [{in_word - 1}:0] in_reg [0:{in_features - 1}];\n"
+
+    rom = folded_rom(weight, parallelism)
+    if rom_prefix is None:
+        yield ''.join(f"    reg signed [{weight_bits - 1}:0] rom{p} [0:{groups * in_features - 1}];\n"
+                      for p in range(parallelism))
+    else:
+        yield ''.join(f"    {rom_declaration(f'rom{p}', weight_bits, rom.shape[1], f'{rom_prefix}_unit{p}.mem')}"
+                      for p in range(parallelism))
+    yield f"    {roms}\n"
+    yield ''.join(f"    reg signed [{acc_bits - 1}:0] acc{p};\n" for p in range(parallelism))
+    yield ''.join(f"    wire signed [{acc_bits - 1}:0] next{p};\n" for p in range(parallelism))
+    yield f"""    reg busy;
+    reg [{j_bits - 1}:0] j;
+    reg [{g_bits - 1}:0] group;
+    reg [{addr_bits - 1}:0] addr;
+    wire last = j == {in_features - 1};
+
+"""
+    if rom_prefix is None:
+        # inline the contents in an initial block
+        yield "    initial\n    begin\n"
+        for p in range(parallelism):
+            yield ''.join(f"        rom{p}[{k}] = {value};\n" for k, value in enumerate(rom[p].tolist()))
+        yield "    end\n\n"
+
+    yield ''.join(f"    assign next{p} = acc{p} + in_reg[j] * rom{p}[addr];\n" for p in range(parallelism))
+
+    capture = ''.join(f"                in_reg[{j}] <= in{j};\n" for j in range(in_features))
+    clear = ''.join(f"                acc{p} <= 0;\n" for p in range(parallelism))
+    accumulate = ''.join(f"            acc{p} <= last ? 0 : next{p};\n" for p in range(parallelism))
+    yield f"""
+    always @(posedge clk)
+    begin
+        if (rst) begin
+            busy <= 1'b0;
+            out_valid <= 1'b0;
+        end else if (!busy) begin
+            out_valid <= 1'b0;
+            if (in_valid) begin
+{capture}{clear}                busy <= 1'b1;
+                j <= 0;
+                group <= 0;
+                addr <= 0;
+            end
+        end else begin
+{accumulate}            addr <= addr + 1;
+            j <= last ? 0 : j + 1;
+            if (last) begin
+                group <= group + 1;
+                busy <= group != {groups - 1};
+                out_valid <= group == {groups - 1};
+                case (group)
+"""
+    for g in range(groups):
+        outputs = [(g * parallelism + p, p) for p in range(parallelism) if g * parallelism + p < out_features]
+        body = ''.join(f"                        out{i} <= next{p}{f' + {bias[i]}' if bias is not None else ''};\n"
+                       for i, p in outputs)
+        yield f"                    {g}: begin\n{body}                    end\n"
+    yield """                endcase
+            end
+        end
+    end
+endmodule
+"""
@@ -0,0 +1,115 @@
+import numpy as np
+
+from layers.utils import to_fixed
+
+
+class AffineMap:
+    """
+    Interval arithmetic for x @ weight + bias. Positive weights map the lower bound of an input to
+    the lower bound of the output and negative weights its upper bound, which is computed as
+    center @ weight -/+ radius @ |weight|. The float64 weights, their magnitudes and the bounds of
+    every column are prepared once, so propagating ranges again costs two matrix-vector products.
+    """
+
+    def __init__(self, weight, fractional_bits: int = None):
+        """
+        :param weight: Weights of shape (N,) or (N, M)
+        :param fractional_bits: Use the fixed-point values of the weights with this many fractional
+            bits, in LSBs, instead of the weights themselves
+        """
+        self.source = weight
+        self.fractional_bits = fractional_bits
+        self.weight = np.asarray(weight if fractional_bits is None else to_fixed(weight, fractional_bits),
+                                 dtype=np.float64)
+        self.abs_weight = np.abs(self.weight)
+        self.column_low, self.column_high = self.weight.min(axis=0), self.weight.max(axis=0)
+
+    def range(self, low, high, bias=None) -> np.ndarray:
+        """
+        :param low: Lower bounds of shape (..., N); windows of a convolution can be passed as strided views
+        :param high: Upper bounds of the same shape
+        :param bias: Bias of shape () or (M,), or None
+        :return: Array of shape (..., 2) or (..., M, 2) with the lower and upper bound of every output
+        """
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+
+        center = (high + low) / 2 @ self.weight
+        radius = (high - low) / 2 @ self.abs_weight
+        if bias is not None:
+            center = center + np.asarray(bias, dtype=np.float64)
+
+        return np.stack([center - radius, center + radius], axis=-1)
+
+
+def cached_map(cache, weight, fractional_bits: int = None) -> AffineMap:
+    """
+    :param cache: AffineMap kept by a layer from an earlier call, or None
+    :param weight: Current weights of the layer
+    :param fractional_bits: Fractional bits of the fixed-point weights, None for the weights themselves
+    :return: The cached map if it was built from the same weight array and format, otherwise a new one
+    """
+    if cache is not None and cache.source is weight and cache.fractional_bits == fractional_bits:
+        return cache
+    return AffineMap(weight, fractional_bits)
+
+
+def affine_range(low, high, weight, bias=None) -> np.ndarray:
+    """
+    Range of x @ weight + bias for every x with low <= x <= high elementwise, see AffineMap
+    :param low: Lower bounds of shape (..., N)
+    :param high: Upper bounds of the same shape
+    :param weight: Weights of shape (N,) or (N, M)
+    :param bias: Bias of shape () or (M,), or None
+    :return: Array of shape (..., 2) or (..., M, 2) with the lower and upper bound of every output
+    """
+    return AffineMap(weight).range(low, high, bias)
+
+
+def relu_range(in_range) -> np.ndarray:
+    """
+    :param in_range: Array of shape (N, 2)
+    :return: Range of max(x, 0) for every input
+    """
+    return np.maximum(np.asarray(in_range, dtype=np.float64), 0)
+
+
+def max_range(in_range, pool_size: int) -> np.ndarray:
+    """
+    Range of the maximum over consecutive groups of inputs, whose bounds are the maxima of the
+    lower and of the upper bounds. Inputs past the last complete group are dropped.
+    :param in_range: Array of shape (N, 2)
+    :param pool_size: Number of inputs per group
+    :return: Array of shape (N // pool_size, 2)
+    """
+    in_range = np.asarray(in_range, dtype=np.float64)
+    groups = len(in_range) // pool_size
+
+    return in_range[:groups * pool_size].reshape(groups, pool_size, 2).max(axis=1)
+
+
+def data_range(data) -> np.ndarray:
+    """
+    Ranges of the inputs observed in a dataset, to be used instead of worst-case bounds
+    :param data: Array of shape (num_samples, N)
+    :return: Array of shape (N, 2) with the minimum and maximum of every input
+    """
+    data = np.asarray(data, dtype=np.float64).reshape(len(data), -1)
+
+    return np.stack([data.min(axis=0), data.max(axis=0)], axis=1)
+
+
+def dot_growth_bits(in_bits, weight, bias=None) -> np.ndarray:
+    """
+    Output widths of dot products sized by word growth alone, without range analysis: the widest
+    input plus the width of the weights plus one bit per doubling of the number of terms
+    :param in_bits: Bit width of every input
+    :param weight: Integer weights of shape (N,) or (N, M)
+    :param bias: Bias of shape () or (M,), or None
+    :return: int64 array with the width of every output
+    """
+    weight = np.asarray(weight, dtype=np.float64)
+    magnitude = np.abs(weight).max(axis=0)
+    weight_bits = np.floor(np.log2(np.maximum(magnitude, 1))).astype(np.int64) + 2
+    terms = weight.shape[0] + (bias is not None)
+
+    return int(np.max(in_bits)) + weight_bits + int(np.ceil(np.log2(terms)))
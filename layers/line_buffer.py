@@ -0,0 +1,218 @@
+import numpy as np
+
+from typing import Iterator
+
+from layers.folded import counter_bits
+from layers.shift_add import multiply
+
+
+def line_buffer_span(kernel_size: int, dilation: int) -> int:
+    """
+    :param kernel_size: Number of taps of the kernel
+    :param dilation: Distance between two taps
+    :return: Number of consecutive samples a window covers, which is the depth of the line buffer
+    """
+    return dilation * (kernel_size - 1) + 1
+
+
+def line_buffer_feed(out_length: int, kernel_size: int, stride: int, dilation: int) -> int:
+    """
+    :param out_length: Number of output positions per channel
+    :param kernel_size: Number of taps of the kernel
+    :param stride: Distance between two output positions
+    :param dilation: Distance between two taps
+    :return: Number of padded samples the line buffer consumes until the last window is complete
+    """
+    return (out_length - 1) * stride + line_buffer_span(kernel_size, dilation)
+
+
+def line_buffer_cycles(out_length: int, kernel_size: int, stride: int, dilation: int) -> int:
+    """
+    Cycles the vector wrapper of a streaming convolution needs per inference: one to capture the
+    inputs, one per sample fed to the line buffer, one to register the last window and one to
+    collect it. A new vector is accepted once the previous one is done, so this is both the
+    latency and the initiation interval.
+    :return: Number of clock cycles
+    """
+    return line_buffer_feed(out_length, kernel_size, stride, dilation) + 3
+
+
+def line_buffer_resources(in_bits, out_bits, weight: np.ndarray, num_inputs: int, out_length: int, stride: int,
+                          dilation: int):
+    """
+    Resource estimate of the modules emitted by emit_line_buffer_conv
+    :param in_bits: Bit width of every input
+    :param out_bits: Bit width of every output
+    :param weight: Integer kernel of shape (out_channels, in_channels, kernel_size)
+    :param num_inputs: Number of inputs of the layer, in_channels samples per position
+    :param out_length: Number of output positions per channel
+    :param stride: Distance between two output positions
+    :param dilation: Distance between two taps
+    :return: Dictionary with the number of multipliers and adders, the register bits and the ROM bits
+    """
+    out_channels, in_channels, kernel_size = weight.shape
+    span = line_buffer_span(kernel_size, dilation)
+    feed = line_buffer_feed(out_length, kernel_size, stride, dilation)
+    in_word = max(in_bits)
+
+    return {
+        'multipliers': int(np.count_nonzero(weight)),
+        'adders': int(np.count_nonzero(weight)),
+        'register_bits': in_channels * (span + feed) * in_word + out_channels * max(out_bits) + int(sum(out_bits))
+                         + counter_bits(span) + counter_bits(stride) + counter_bits(feed + 1)
+                         + counter_bits(out_length) + 4,
+        'rom_bits': 0,
+    }
+
+
+def emit_line_buffer_conv(name: str, in_bits, out_bits, in_channels: int, out_channels: int, kernel_size: int,
+                          stride: int, padding: int, dilation: int, terms, bias, roms: str = '',
+                          shift_add=None) -> Iterator[str]:
+    """
+    Emit a convolution that reuses one set of MACs for every output position. {name}_stream
+    consumes one sample of in_channels values per clock cycle into a line buffer of the last
+    span samples, and one cycle after every complete window it outputs the out_channels values of
+    that position, so a continuous stream gets one output position per stride cycles. {name}
+    wraps it for the vectors of the other layers: the inputs are captured when in_valid is high and
+    the module is idle, then fed position by position with the zero padding, and out_valid is high
+    for one cycle when all positions are collected.
+    Inputs and outputs are numbered channel by channel like a flattened (channels, length) tensor.
+    :param name: Module name
+    :param in_bits: Bit width of every input
+    :param out_bits: Bit width of every output
+    :param in_channels: Number of input channels
+    :param out_channels: Number of output channels
+    :param kernel_size: Number of taps of the kernel
+    :param stride: Distance between two output positions
+    :param padding: Number of zeros on both ends of every input channel
+    :param dilation: Distance between two taps
+    :param terms: For every output channel, the (input channel, tap, weight, weight expression) tuples of its dot product
+    :param bias: Expression of the bias of every output channel, or None
+    :param roms: Declarations of the ROMs the weight and bias expressions read from
+    :param shift_add: ShiftAdd networks keyed by (input channel, tap) to build the products from
+        instead of multipliers
+    :return: Iterator over the Verilog code of both modules
+    """
+    in_length = len(in_bits) // in_channels
+    out_length = len(out_bits) // out_channels
+    span = line_buffer_span(kernel_size, dilation)
+    feed = line_buffer_feed(out_length, kernel_size, stride, dilation)
+    in_word = [int(max(in_bits[c * in_length:(c + 1) * in_length])) for c in range(in_channels)]
+    out_word = [int(max(out_bits[o * out_length:(o + 1) * out_length])) for o in range(out_channels)]
+    samples = ",".join(f"sample{c}" for c in range(in_channels))
+    results = ",".join(f"result{o}" for o in range(out_channels))
+
+    yield f"""
+module {name}_stream(clk, rst, in_valid, {samples}, {results}, out_valid);
+    input clk;
+    input rst;
+    input in_valid;
+    output reg out_valid;
+"""
+    yield ''.join(f"    input signed [{in_word[c] - 1}:0] sample{c};\n" for c in range(in_channels))
+    yield ''.join(f"    output reg signed [{out_word[o] - 1}:0] result{o};\n" for o in range(out_channels))
+    # line{c}[m] holds the sample m positions before the newest one
+    yield ''.join(f"    reg signed [{in_word[c] - 1}:0] line{c} [0:{span - 1}];\n" for c in range(in_channels))
+    yield f"""    reg [{counter_bits(span) - 1}:0] filled;
+    reg [{counter_bits(stride) - 1}:0] phase;
+    reg window_valid;
+    {roms}
+"""
+    if shift_add is not None:
+        yield shift_add.declarations(((c, k), f"line{c}[{span - 1 - k * dilation}]", in_word[c])
+                                     for c, k in sorted(shift_add.networks))
+    shift = ''.join(f"            line{c}[{m}] <= line{c}[{m - 1}];\n" for c in range(in_channels) for m in range(1, span))
+    push = ''.join(f"            line{c}[0] <= sample{c};\n" for c in range(in_channels))
+    yield f"""
+    always @(posedge clk)
+    begin
+        if (rst) begin
+            filled <= 0;
+            phase <= 0;
+            window_valid <= 1'b0;
+        end else if (in_valid) begin
+{shift}{push}            if (filled != {span - 1})
+                filled <= filled + 1;
+            else
+                phase <= phase == {stride - 1} ? 0 : phase + 1;
+            window_valid <= filled == {span - 1} && phase == 0;
+        end else begin
+            window_valid <= 1'b0;
+        end
+    end
+
+    always @(posedge clk)
+    begin
+        out_valid <= rst ? 1'b0 : window_valid;
+"""
+    for o in range(out_channels):
+        # tap k of the window is the sample span - 1 - k * dilation positions before the newest one
+        products = [multiply(shift_add, (c, k), f"line{c}[{span - 1 - k * dilation}]", weight, literal)
+                    for c, k, weight, literal in terms[o]]
+        if bias is not None:
+            products.append(f"{bias[o]}")
+        yield f"        result{o} <= {' + '.join(products) if products else '0'};\n"
+    yield "    end\nendmodule\n"
+
+    in_params = [f"in{j}" for j in range(len(in_bits))]
+    out_params = [f"out{i}" for i in range(len(out_bits))]
+    yield f"""
+module {name}(clk, rst, in_valid, {",".join(in_params)}, {",".join(out_params)}, out_valid);
+    input clk;
+    input rst;
+    input in_valid;
+    output reg out_valid;
+"""
+    yield ''.join(f"    input signed [{in_bits[j] - 1}:0] {in_params[j]};\n" for j in range(len(in_bits)))
+    yield ''.join(f"    output reg signed [{out_bits[i] - 1}:0] {out_params[i]};\n" for i in range(len(out_bits)))
+    # the padded input sequence of every channel, fed one position per cycle
+    yield ''.join(f"    reg signed [{in_word[c] - 1}:0] padded{c} [0:{feed - 1}];\n" for c in range(in_channels))
+    yield ''.join(f"    wire signed [{out_word[o] - 1}:0] result{o};\n" for o in range(out_channels))
+    yield f"""    reg busy;
+    reg [{counter_bits(feed + 1) - 1}:0] n;
+    reg [{counter_bits(out_length) - 1}:0] position;
+    wire feeding = busy && n != {feed};
+    wire result_valid;
+    wire capture = !busy && in_valid;
+
+    {name}_stream stream(clk, rst || capture, feeding, {",".join(f"padded{c}[n]" for c in range(in_channels))}, {results}, result_valid);
+"""
+    capture = []
+    for c in range(in_channels):
+        for n in range(feed):
+            position = n - padding
+            value = in_params[c * in_length + position] if 0 <= position < in_length else "0"
+            capture.append(f"                padded{c}[{n}] <= {value};\n")
+    collect = []
+    for o in range(out_channels):
+        # shift every channel towards position 0, so the first result ends up there
+        for t in range(out_length - 1):
+            collect.append(f"                {out_params[o * out_length + t]} <= {out_params[o * out_length + t + 1]};\n")
+        collect.append(f"                {out_params[o * out_length + out_length - 1]} <= result{o};\n")
+    yield f"""
+    always @(posedge clk)
+    begin
+        if (rst) begin
+            busy <= 1'b0;
+            out_valid <= 1'b0;
+        end else if (!busy) begin
+            out_valid <= 1'b0;
+            if (in_valid) begin
+{''.join(capture)}                busy <= 1'b1;
+                n <= 0;
+                position <= 0;
+            end
+        end else begin
+            if (feeding)
+                n <= n + 1;
+            if (result_valid) begin
+{''.join(collect)}                position <= position + 1;
+                if (position == {out_length - 1}) begin
+                    busy <= 1'b0;
+                    out_valid <= 1'b1;
+                end
+            end
+        end
+    end
+endmodule
+"""
@@ -1,13 +1,21 @@
 import numpy as np
 
-from layers.utils import range_to_bits
+from layers.adder_tree import emit_tree_mac
+from layers.emitter import Emitter, LazyRows
+from layers.folded import emit_folded_mac, folded_cycles, folded_resources, folded_rom
+from layers.pipeline import emit_pipelined_mac, split_stages
+from layers.rom import rom_bits, rom_declaration, write_rom
+from layers.shift_add import ShiftAdd, multiply
+from layers.intervals import cached_map, dot_growth_bits, relu_range
+from layers.relu import relu_output
+from layers.utils import integral, signed_ranges_to_bits, wrap_signed
 
 
-class Linear:
+class Linear(Emitter):
     @classmethod
     def layer_from(cls, layer, index: int):
-        return cls(layer.in_features, layer.out_features, layer.weight.detach().numpy().T, layer.bias.detach().numpy(),
-                   index)
+        return cls(layer.in_features, layer.out_features, integral(layer.weight.detach().numpy().T),
+                   integral(layer.bias.detach().numpy()), index)
 
     def __init__(self, in_features: int, out_features: int, weight: np.ndarray, bias: np.ndarray, index: int):
         self.in_features = in_features
@@ -18,13 +26,71 @@ class Linear:
 
         self.verify_weights()
 
+        self.index = index
         self.name = f'layer_{index}_linear_{str(self.in_features)}_{str(self.out_features)}'
         self.shape = (self.in_features, self.out_features)
 
         self.in_bits, self.out_bits = None, None
+        # width of the result of every dot product, out_bits unless a ReLU is fused into the layer
+        self.mac_bits = None
+        # apply a ReLU to the results inside this module instead of in a layer of its own
+        self.relu = False
+        # number of register stages the dot products are split into, 0 for a combinational layer
+        self.stages = 0
+        # number of MAC units the layer is folded onto, 0 for one multiplier per weight
+        self.parallelism = 0
+        # 'chain' accumulates the products one after the other, 'tree' sums them in a balanced adder tree
+        self.reduction = 'chain'
+        self.in_range = None
+        # prepared weights for range propagation, rebuilt when the weights are replaced
+        self.weight_map = None
+        # path prefix of the .mem files the constants are read from, None to inline them as literals
+        self.rom_prefix = None
+        # build the products from shifts and adds of the inputs instead of multipliers
+        self.shift_add = False
 
     def __str__(self):
-        return f'Linear({self.in_features} -> {self.out_features})'
+        return f'Linear({self.in_features} -> {self.out_features}){" + ReLU" if self.relu else ""}'
+
+    def keep_outputs(self, keep):
+        """
+        Remove the outputs that no later layer reads, keeping the widths found by forward_range
+        :param keep: Indices of the outputs to keep, in order
+        """
+        self.weight = self.weight[:, keep]
+        self.bias = self.bias[keep] if self.bias is not None else None
+        self.out_features = len(keep)
+        self.shape = (self.in_features, self.out_features)
+        self.name = f'layer_{self.index}_linear_{self.in_features}_{self.out_features}'
+        self.mac_bits, self.out_bits = self.mac_bits[keep], self.out_bits[keep]
+        self.weight_map = None
+
+    def keep_inputs(self, keep, constants):
+        """
+        Remove the inputs that are constant or that no output reads, keeping the widths found by
+        forward_range. The constant value of every removed input times its weights is added to the
+        biases, so the outputs do not change.
+        :param keep: Indices of the inputs to keep, in order
+        :param constants: Value of every input, only used for the removed ones
+        """
+        removed = np.setdiff1d(np.arange(self.in_features), keep)
+        offset = integral(np.asarray(constants)[removed] @ self.weight[removed])
+        if np.any(offset != 0):
+            self.bias = offset if self.bias is None else integral(self.bias + offset)
+        self.weight = self.weight[keep]
+        self.in_features = len(keep)
+        self.shape = (self.in_features, self.out_features)
+        self.name = f'layer_{self.index}_linear_{self.in_features}_{self.out_features}'
+        self.in_bits = self.in_bits[keep]
+        self.in_range = self.in_range[keep]
+        self.weight_map = None
+
+    def dead_inputs(self):
+        """
+        :return: Boolean mask of the inputs keep_inputs can remove: the inputs whose range from
+            forward_range is a single value, and the inputs all weights of which are zero
+        """
+        return (self.in_range[:, 0] == self.in_range[:, 1]) | ~np.any(self.weight, axis=1)
 
     def verify_weights(self):
         if self.weight is None:
@@ -39,56 +105,197 @@ class Linear:
         if self.bias is not None and self.bias.shape != bias_shape:
             raise ValueError(f'Bias shape is not correct, expected {bias_shape}, got {self.bias.shape}')
 
-    def forward_range(self, in_range: np.ndarray):
-        out_range = np.array([in_range.T[0] @ self.weight, in_range.T[1] @ self.weight])
-        out_range = (out_range + self.bias).T
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        """
+        :param in_range: Array of shape (in_features, 2) with the range of every input
+        :param out_range: Observed ranges of the dot products, e.g. from Model.calibrate, used instead of
+            the propagated ones
+        :return: Array of shape (out_features, 2) with the range of every output, after the fused ReLU if any
+        """
+        if out_range is None:
+            self.weight_map = cached_map(self.weight_map, self.weight)
+            out_range = self.weight_map.range(in_range[:, 0], in_range[:, 1], self.bias)
 
-        self.in_bits = [range_to_bits(*r) for r in in_range]
-        self.out_bits = [range_to_bits(*r) for r in out_range]
+        self.in_range = in_range
+        self.in_bits = signed_ranges_to_bits(in_range)
+        self.mac_bits = signed_ranges_to_bits(out_range)
+        if self.relu:
+            out_range = relu_range(out_range)
+        self.out_bits = signed_ranges_to_bits(out_range)
 
         return out_range
 
-    def emit(self):
+    def growth_bits(self):
         """
-        Emit Verilog code for this layer
-        :return: Verilog code
+        :return: Width of every output if it were sized by word growth instead of forward_range
+        """
+        return dot_growth_bits(self.in_bits, self.weight, self.bias)
+
+    def simulate(self, batch: np.ndarray):
         """
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once
+        :param batch: Integer array of shape (N, in_features) holding the values on the input nets
+        :return: int64 array of shape (N, out_features) holding the values on the output ports
+        """
+        if np.any(self.weight != np.round(self.weight)):
+            raise ValueError('Integer simulation requires integer weights')
 
-        add_bias = [f'add{i} = mul{i} + {self.bias[i]};\n' for i in range(self.out_features)]
-        multiply_weight = []
+        values = wrap_signed(batch, self.in_bits)
+        acc = values @ self.weight.astype(np.int64)
+        if self.bias is not None:
+            acc = acc + self.bias.astype(np.int64)
 
-        for i in range(self.out_features):
-            multiply_weight.append(f"mul{i} = 0;\n")
-            for j in range(self.in_features):
-                multiply_weight.append(f"mul{i} = mul{i} + in{j} * {self.weight[j][i]};\n")
+        acc = wrap_signed(acc, self.mac_bits)
+        return wrap_signed(np.maximum(acc, 0), self.out_bits) if self.relu else acc
 
-        in_params = [f"in{i}" for i in range(self.in_features)]
-        out_params = [f"out{i}" for i in range(self.out_features)]
+    def latency(self):
+        """
+        :return: Clock cycles between in_valid and out_valid, 0 for a combinational layer
+        """
+        if self.parallelism:
+            return folded_cycles(self.in_features, self.out_features, self.parallelism)
+        return self.stages
+
+    def interval(self):
+        """
+        :return: Minimum number of clock cycles between two vectors entering the layer
+        """
+        if self.parallelism:
+            return folded_cycles(self.in_features, self.out_features, self.parallelism)
+        return 1
+
+    def resources(self):
+        """
+        Estimate the hardware this layer is emitted as
+        :return: Dictionary with the number of multipliers and adders, the register bits and the ROM bits
+        """
+        if self.parallelism:
+            return folded_resources(self.in_bits, self.mac_bits, self.weight.astype(np.int64), self.parallelism)
 
-        in_definitions = [f"input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
-                          for i in range(self.in_features)]
+        register_bits = 0
+        if self.stages:
+            register_bits += self.stages * int(sum(self.mac_bits))
+            for s, chunk in enumerate(split_stages(list(range(self.in_features)), self.stages)):
+                register_bits += s * int(sum(self.in_bits[j] for j in chunk))
 
-        out_definitions = [f"output signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
-                           for i in range(self.out_features)]
+        rom = self.weight.size * rom_bits(self.weight.astype(np.int64)) if self.rom_prefix else 0
+        # zero weights are not emitted
+        products = int(np.count_nonzero(self.weight))
+        if self.shift_add:
+            adders = products + ShiftAdd.from_terms(self.terms()).adders()
+            return {'multipliers': 0, 'adders': adders, 'register_bits': register_bits, 'rom_bits': rom}
 
-        mul_definition = [f"reg signed [{self.out_bits[i] - 1}:0] mul{i};\n" for i in range(self.out_features)]
-        add_definition = [f"reg signed [{self.out_bits[i] - 1}:0] add{i};\n" for i in range(self.out_features)]
+        return {'multipliers': products, 'adders': products, 'register_bits': register_bits, 'rom_bits': rom}
 
-        assigns = [f"assign out{i} = add{i};\n" for i in range(self.out_features)]
+    def terms(self):
+        """
+        :return: For every output, the (input index, weight, weight expression) triples of its dot
+            product without the zero weights, built when the output is accessed
+        """
+        def output_terms(i):
+            column = self.weight[:, i]
+            if self.rom_prefix:
+                return [(j, column[j], f"weight_rom[{i * self.in_features + j}]") for j in np.flatnonzero(column)]
+            return [(j, column[j], str(column[j])) for j in np.flatnonzero(column)]
 
-        return f"""
+        return LazyRows(self.out_features, output_terms)
+
+    def bias_terms(self):
+        """
+        :return: Expression of the bias of every output, or None
+        """
+        if self.bias is None:
+            return None
+        if self.rom_prefix:
+            return [f"bias_rom[{i}]" for i in range(self.out_features)]
+        return list(self.bias)
+
+    def write_roms(self):
+        """
+        Write the constants of this layer to the .mem files under rom_prefix: the weights of output i
+        at words i * in_features .. (i + 1) * in_features - 1, or one file per MAC unit when folded
+        """
+        weight = self.weight.astype(np.int64)
+        if self.parallelism:
+            for p, rom in enumerate(folded_rom(weight, self.parallelism)):
+                write_rom(f"{self.rom_prefix}_unit{p}.mem", rom, rom_bits(weight))
+        else:
+            write_rom(f"{self.rom_prefix}_weights.mem", weight.T.ravel())
+        if self.bias is not None:
+            write_rom(f"{self.rom_prefix}_bias.mem", self.bias.astype(np.int64))
+
+    def rom_declarations(self):
+        """
+        :return: Verilog declarations of the ROMs written by write_roms, empty when the constants are inlined
+        """
+        if not self.rom_prefix:
+            return ''
+        declarations = []
+        if not self.parallelism:
+            weight = self.weight.astype(np.int64)
+            declarations.append(rom_declaration("weight_rom", rom_bits(weight), weight.size,
+                                                f"{self.rom_prefix}_weights.mem"))
+        if self.bias is not None:
+            bias = self.bias.astype(np.int64)
+            declarations.append(rom_declaration("bias_rom", rom_bits(bias), bias.size, f"{self.rom_prefix}_bias.mem"))
+        return '    '.join(declarations)
+
+    def split_outputs(self) -> int:
+        """
+        :return: Number of outputs emit_chunks can be split over, see Emitter.split_outputs. Folded
+            layers and shift-add networks are shared by all outputs, so they are emitted as a whole.
+        """
+        return 0 if self.parallelism or self.shift_add else self.out_features
+
+    def emit_chunks(self, outputs: range = None):
+        """
+        Emit Verilog code for this layer
+        :param outputs: Only emit the logic of these outputs, see Emitter.split_outputs
+        :return: Iterator over the Verilog code, one chunk per output for the dot products
+        """
+        terms, bias, roms = self.terms(), self.bias_terms(), self.rom_declarations()
+        if self.parallelism:
+            yield from emit_folded_mac(self.name, self.in_bits, self.mac_bits, self.weight.astype(np.int64), bias,
+                                       self.parallelism, rom_prefix=self.rom_prefix, roms=roms)
+            return
+        shift_add = ShiftAdd.from_terms(terms) if self.shift_add else None
+        relu_bits = self.out_bits if self.relu else None
+        if self.stages:
+            yield from emit_pipelined_mac(self.name, self.in_bits, self.mac_bits, terms, bias, self.stages,
+                                          tree=self.reduction == 'tree', roms=roms, shift_add=shift_add,
+                                          relu_bits=relu_bits, outputs=outputs)
+            return
+        if self.reduction == 'tree':
+            yield from emit_tree_mac(self.name, self.in_bits, self.mac_bits, self.in_range, terms, bias, roms=roms,
+                                     shift_add=shift_add, relu_bits=relu_bits, outputs=outputs)
+            return
+
+        in_params = [f"in{i}" for i in range(self.in_features)]
+        out_params = [f"out{i}" for i in range(self.out_features)]
+        outputs = range(self.out_features) if outputs is None else outputs
+
+        if outputs.start == 0:
+            yield f"""
 module {self.name}({",".join(in_params)}, {",".join(out_params)});
-    {'    '.join(in_definitions)}
-    {'    '.join(out_definitions)}
-    
-    {'    '.join(mul_definition)}
-    {'    '.join(add_definition)}
-        
-    always @(*)
-    begin
-        {'        '.join(multiply_weight)}
-        {'        '.join(add_bias)}
-    end
-    {'  '.join(assigns)}
-endmodule
 """
+            yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
+                          for i in range(self.in_features))
+            yield ''.join(f"    output signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
+                          for i in range(self.out_features))
+            yield ''.join(f"    reg signed [{self.mac_bits[i] - 1}:0] mul{i};\n" for i in range(self.out_features))
+            yield ''.join(f"    reg signed [{self.mac_bits[i] - 1}:0] add{i};\n" for i in range(self.out_features))
+            yield f"    {roms}\n"
+            if shift_add is not None:
+                yield shift_add.declarations((j, f"in{j}", self.in_bits[j]) for j in sorted(shift_add.networks))
+
+            yield "    always @(*)\n    begin\n"
+        for i in outputs:
+            yield f"        mul{i} = 0;\n" + ''.join(
+                f"        mul{i} = mul{i} + {multiply(shift_add, j, f'in{j}', weight, literal)};\n"
+                for j, weight, literal in terms[i])
+        if outputs.stop != self.out_features:
+            return
+        yield ''.join(f"        add{i} = mul{i} + {bias[i]};\n" for i in range(self.out_features))
+        yield "    end\n"
+        yield ''.join(relu_output(i, f"add{i}", self.mac_bits[i], self.relu) for i in range(self.out_features))
+        yield "endmodule\n"
@@ -1,13 +1,20 @@
 import numpy as np
 
-from layers.utils import range_to_bits, ftfp
+from layers.adder_tree import build_adder_tree, node_bits
+from layers.emitter import Emitter
+from layers.rom import rom_bits, rom_declaration, write_rom
+from layers.shift_add import ShiftAdd
+from layers.intervals import cached_map, dot_growth_bits, relu_range
+from layers.relu import relu_output
+from layers.utils import signed_ranges_to_bits, ftfp, to_fixed, wrap_signed, port_bounds
 
 
-class Linear:
+class Linear(Emitter):
     @classmethod
     def layer_from(cls, layer, index: int, FW: int):
-        return cls(layer.in_features, layer.out_features, layer.weight.detach().numpy().T, layer.bias.detach().numpy(),
-                   index, FW)
+        # copies, so the layer does not share memory with the tensors, e.g. when the model is sent to a process
+        return cls(layer.in_features, layer.out_features, layer.weight.detach().numpy().T.copy(),
+                   layer.bias.detach().numpy().copy(), index, FW)
 
     def __init__(self, in_features: int, out_features: int, weight: np.ndarray, bias: np.ndarray, index: int, FW: int):
         self.in_features = in_features
@@ -18,15 +25,107 @@ class Linear:
 
         self.verify_weights()
 
+        self.index = index
         self.name = f'layer_{index}_linear_{str(self.in_features)}_{str(self.out_features)}'
         self.shape = (self.in_features, self.out_features)
 
         self.in_bits, self.out_bits = None, None
+        # width of the result of every dot product, out_bits unless a ReLU is fused into the layer
+        self.mac_bits = None
+        # apply a ReLU to the results inside this module instead of in a layer of its own
+        self.relu = False
+        # fractional bits of the outputs and the bias
         self.fractional_bits = FW
+        # fractional bits of the values on the inputs, set by the model to those of the layer before
+        self.in_fractional_bits = FW
+        # fractional bits of the fixed-point weights
+        self.weight_fractional_bits = FW
         self.integer_bits = None
+        # width every neuron computes at, enough for its inputs, weights, bias and result
+        self.neuron_bits = None
+        # 'chain' accumulates the products one after the other, 'tree' sums them in a balanced adder tree
+        self.reduction = 'chain'
+        self.in_range = None
+        # prepared fixed-point weights for range propagation, rebuilt when the weights or FW change
+        self.weight_map = None
+        # path prefix of the .mem files the constants are read from, None to inline them as literals
+        self.rom_prefix = None
+        # build the products from shifts and adds of the inputs instead of multiplier_module instances
+        self.shift_add = False
 
     def __str__(self):
-        return f'Linear({self.in_features} -> {self.out_features})'
+        return f'Linear({self.in_features} -> {self.out_features}){" + ReLU" if self.relu else ""}'
+
+    def set_fractional_bits(self, fractional_bits: int, weight_fractional_bits: int = None,
+                            in_fractional_bits: int = None):
+        """
+        Choose the fixed-point formats of the layer, forward_range has to be run again afterwards
+        :param fractional_bits: Fractional bits of the outputs and the bias
+        :param weight_fractional_bits: Fractional bits of the weights, the same as the outputs if None
+        :param in_fractional_bits: Fractional bits of the inputs, unchanged if None
+        """
+        weight_fractional_bits = fractional_bits if weight_fractional_bits is None else weight_fractional_bits
+        in_fractional_bits = self.in_fractional_bits if in_fractional_bits is None else in_fractional_bits
+        if min(fractional_bits, weight_fractional_bits, in_fractional_bits) < 0:
+            raise ValueError('Fractional bits must not be negative')
+        if in_fractional_bits + weight_fractional_bits < fractional_bits:
+            raise ValueError(f'{self.name}: the products have {in_fractional_bits + weight_fractional_bits} '
+                             f'fractional bits, fewer than the {fractional_bits} of the outputs')
+
+        self.fractional_bits = fractional_bits
+        self.weight_fractional_bits = weight_fractional_bits
+        self.in_fractional_bits = in_fractional_bits
+
+    def product_shift(self) -> int:
+        """
+        :return: Number of fractional bits the multipliers drop to bring a product of an input and
+            a weight to the format of the outputs
+        """
+        return self.in_fractional_bits + self.weight_fractional_bits - self.fractional_bits
+
+    def keep_outputs(self, keep):
+        """
+        Remove the outputs that no later layer reads, keeping the widths found by forward_range
+        :param keep: Indices of the outputs to keep, in order
+        """
+        self.weight = self.weight[:, keep]
+        self.bias = self.bias[keep] if self.bias is not None else None
+        self.out_features = len(keep)
+        self.shape = (self.in_features, self.out_features)
+        self.name = f'layer_{self.index}_linear_{self.in_features}_{self.out_features}'
+        self.mac_bits, self.out_bits = self.mac_bits[keep], self.out_bits[keep]
+        self.neuron_bits = self.neuron_bits[keep]
+        self.set_integer_bits()
+        self.weight_map = None
+
+    def keep_inputs(self, keep, constants):
+        """
+        Remove the inputs that are constant or that no output reads, keeping the widths found by
+        forward_range. The constant value of every removed input times its weights is added to the
+        biases, so the outputs do not change.
+        :param keep: Indices of the inputs to keep, in order
+        :param constants: Value of every input, only used for the removed ones
+        """
+        removed = np.setdiff1d(np.arange(self.in_features), keep)
+        used = np.any(self.fixed_constants()[0][:, removed], axis=0)
+        if np.any(np.asarray(constants)[removed][used] != 0):
+            # folding a constant into the bias would round it differently than the products
+            raise ValueError('Only inputs that are constant zero can be removed from a fixed-point layer')
+        self.weight = self.weight[keep]
+        self.in_features = len(keep)
+        self.shape = (self.in_features, self.out_features)
+        self.name = f'layer_{self.index}_linear_{self.in_features}_{self.out_features}'
+        self.in_bits = self.in_bits[keep]
+        self.in_range = self.in_range[keep]
+        self.weight_map = None
+
+    def dead_inputs(self):
+        """
+        :return: Boolean mask of the inputs keep_inputs can remove: the inputs whose range from
+            forward_range is zero, and the inputs all weights of which truncate to zero
+        """
+        constant_zero = (self.in_range[:, 0] == 0) & (self.in_range[:, 1] == 0)
+        return constant_zero | ~np.any(self.fixed_constants()[0], axis=0)
 
     def verify_weights(self):
         if self.weight is None:
@@ -41,77 +140,280 @@ class Linear:
         if self.bias is not None and self.bias.shape != bias_shape:
             raise ValueError(f'Bias shape is not correct, expected {bias_shape}, got {self.bias.shape}')
 
-    def forward_range(self, in_range: np.ndarray):
-        out_range = np.array([in_range.T[0] @ self.weight, in_range.T[1] @ self.weight])
-        out_range = (out_range + self.bias).T
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        """
+        Propagate the ranges in fixed-point units (LSBs) through the quantized weights, so the widths
+        cover what the hardware computes: every product is rounded down by the multiplier, which
+        can lower the sum by up to one LSB per input.
+        :param in_range: Array of shape (in_features, 2) with the real-valued range of every input
+        :param out_range: Observed real-valued ranges of the outputs of the float model, e.g. from
+            Model.calibrate, used instead of the propagated ones. They are widened by how far the
+            truncated inputs, weights, bias and products can move the fixed-point result.
+        :return: Array of shape (out_features, 2) with the real-valued range of every output, after
+            the fused ReLU if any
+        """
+        scale, in_scale = 2 ** self.fractional_bits, 2 ** self.in_fractional_bits
+        in_fixed = np.stack([np.floor(in_range.min(axis=1) * in_scale), np.ceil(in_range.max(axis=1) * in_scale)],
+                            axis=1)
+        self.weight_map = cached_map(self.weight_map, self.weight, self.weight_fractional_bits)
+        bias = to_fixed(self.bias, self.fractional_bits)
+        shift = self.product_shift()
 
-        self.in_bits = [range_to_bits(*r) + self.fractional_bits for r in in_range]
-        self.out_bits = [range_to_bits(*r) + self.fractional_bits for r in out_range]
+        if out_range is None:
+            products = self.weight_map.range(in_fixed[:, 0], in_fixed[:, 1]) / 2 ** shift
+            out_fixed = np.stack([np.floor(products[:, 0]) - self.in_features, np.floor(products[:, 1])], axis=1)
+            out_fixed = out_fixed + bias[:, None]
+        else:
+            # each truncation is below one LSB of the value it multiplies, in LSBs of the output
+            error = np.ceil(np.abs(in_range).max(axis=1).sum() * 2.0 ** (self.fractional_bits - self.weight_fractional_bits)
+                            + np.abs(self.weight).sum(axis=0) * 2.0 ** (self.fractional_bits - self.in_fractional_bits)
+                            ) + self.in_features + 1
+            out_fixed = np.stack([np.floor(out_range[:, 0] * scale) - error, np.ceil(out_range[:, 1] * scale) + error],
+                                 axis=1)
+
+        self.in_range = in_range
+        self.in_bits = signed_ranges_to_bits(in_fixed)
+        self.mac_bits = signed_ranges_to_bits(out_fixed)
+        if self.relu:
+            out_fixed = relu_range(out_fixed)
+        self.out_bits = signed_ranges_to_bits(out_fixed)
+        self.neuron_bits = np.maximum.reduce([
+            self.mac_bits,
+            np.full(self.out_features, self.in_bits.max()),
+            signed_ranges_to_bits(np.stack([self.weight_map.column_low, self.weight_map.column_high], axis=1)),
+            signed_ranges_to_bits(np.stack([bias, bias], axis=1)),
+            # the multipliers select the bits above the shift from a product twice their width
+            np.full(self.out_features, shift),
+        ])
 
         self.set_integer_bits()
 
-        return out_range
-    
+        return out_fixed / scale
+
     def set_integer_bits(self):
-        self.integer_bits = [bits - self.fractional_bits for bits in self.in_bits]
+        self.integer_bits = self.neuron_bits - self.fractional_bits
         return self.integer_bits
-    
+
+    def growth_bits(self):
+        """
+        :return: Width of every output if it were sized by word growth instead of forward_range
+        """
+        weight, bias = to_fixed(self.weight, self.weight_fractional_bits), to_fixed(self.bias, self.fractional_bits)
+        return dot_growth_bits(self.in_bits, weight, bias) - self.product_shift()
+
+    def simulate(self, batch: np.ndarray):
+        """
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once.
+        Neuron i runs at neuron_bits[i] bits and every product is truncated to the Q-format of
+        multiplier_module, so results match the simulator rather than the float model.
+        :param batch: Fixed-point integer array of shape (N, in_features) holding the values on the input nets
+        :return: int64 array of shape (N, out_features) holding the values on the output ports
+        """
+        fw = self.fractional_bits
+        width = self.neuron_bits
+        shift = self.product_shift()
+
+        values = wrap_signed(batch, self.in_bits)
+        weight = wrap_signed(to_fixed(self.weight, self.weight_fractional_bits), width)
+        acc = np.zeros((values.shape[0], self.out_features), dtype=np.int64)
+
+        for j in range(self.in_features):
+            product = wrap_signed(values[:, j:j + 1], width) * weight[j]
+            acc += wrap_signed(product >> shift, width)
+
+        acc = wrap_signed(wrap_signed(acc + wrap_signed(to_fixed(self.bias, fw), width), width), self.mac_bits)
+        return wrap_signed(np.maximum(acc, 0), self.out_bits) if self.relu else acc
+
+    def fixed_constants(self):
+        """
+        :return: Weights of shape (out_features, in_features) and biases in the fixed-point format of
+            their neuron, as the signed values the multiplier and adder ports see
+        """
+        width = self.neuron_bits
+        weight = wrap_signed(to_fixed(self.weight, self.weight_fractional_bits), width).T
+        bias = wrap_signed(to_fixed(self.bias, self.fractional_bits), width)
+        return weight, bias
+
+    def weight_term(self, i: int, j: int) -> str:
+        """
+        :return: Expression of the fixed-point weight of input j for neuron i
+        """
+        if self.rom_prefix:
+            return f"weight_rom[{i * self.in_features + j}]"
+        return ftfp(self.weight[j][i], self.neuron_bits[i] - self.weight_fractional_bits, self.weight_fractional_bits)
+
+    def bias_term(self, i: int) -> str:
+        """
+        :return: Expression of the fixed-point bias of neuron i
+        """
+        if self.rom_prefix:
+            return f"bias_rom[{i}]"
+        return ftfp(self.bias[i], self.integer_bits[i], self.fractional_bits)
+
+    def write_roms(self):
+        """
+        Write the fixed-point weights, neuron by neuron, and the biases to the .mem files under rom_prefix
+        """
+        weight, bias = self.fixed_constants()
+        write_rom(f"{self.rom_prefix}_weights.mem", weight.ravel())
+        write_rom(f"{self.rom_prefix}_bias.mem", bias)
+
+    def rom_declarations(self):
+        """
+        :return: Verilog declarations of the ROMs written by write_roms, empty when the constants are inlined
+        """
+        if not self.rom_prefix:
+            return ''
+        weight, bias = self.fixed_constants()
+        return '    '.join([
+            rom_declaration("weight_rom", rom_bits(weight), weight.size, f"{self.rom_prefix}_weights.mem"),
+            rom_declaration("bias_rom", rom_bits(bias), bias.size, f"{self.rom_prefix}_bias.mem"),
+        ])
+
     def get_adder(self, IW:int, FW:int, in1:str, in2:str, sum:str):
         return f"""
         adder_module #({IW}, {FW}) add_inst_{sum} (.in1({in1}), .in2({in2}), .out({sum}));
         """
     
+    def shift_add_networks(self):
+        """
+        :return: ShiftAdd networks of the inputs, multiplied by the fixed-point weights of every neuron
+        """
+        weight, _ = self.fixed_constants()
+        return ShiftAdd({j: weight[:, j] for j in range(self.in_features)})
+
+    def get_product(self, shift_add, weight, i: int, j: int, product: str) -> str:
+        """
+        :param shift_add: ShiftAdd networks of the inputs, or None for a multiplier_module instance
+        :param weight: Fixed-point weights from fixed_constants when shift_add is given
+        :param i: Neuron
+        :param j: Input
+        :param product: Wire the product is assigned to
+        :return: Verilog code computing input j times the weight of neuron i, with the fractional
+            bits of the outputs
+        """
+        if shift_add is None:
+            return self.get_multiplier(self.integer_bits[i], self.fractional_bits, f"in{j}", self.weight_term(i, j),
+                                       product)
+        # the full product is as wide as the one of multiplier_module, so the same bits are selected
+        width, shift = self.neuron_bits[i], self.product_shift()
+        return (f"    wire signed [{2 * width - 1}:0] {product}_full;\n"
+                f"    assign {product}_full = {shift_add.product(j, f'in{j}', weight[i, j])};\n"
+                f"    assign {product} = {product}_full[{width + shift - 1}:{shift}];\n")
+
     def get_multiplier(self, IW:int, FW:int, in1:str, in2:str, product:str):
+        # the shift only has to be passed when the inputs and weights are not in the format of the outputs
+        shift = self.product_shift()
+        params = f"{IW}, {FW}" if shift == FW else f"{IW}, {FW}, {shift}"
         return f"""
-        multiplier_module #({IW}, {FW}) mult_inst_{product} (.in1({in1}), .in2({in2}), .out({product}));
+        multiplier_module #({params}) mult_inst_{product} (.in1({in1}), .in2({in2}), .out({product}));
         """
 
-    def emit(self):
+    def split_outputs(self) -> int:
         """
-        Emit Verilog code for this layer
-        :return: Verilog code
+        :return: Number of outputs emit_chunks can be split over, see Emitter.split_outputs. Shift-add
+            networks are shared by all outputs, so they are emitted as a whole.
         """
+        return 0 if self.shift_add else self.out_features
 
-        # add_bias = [f'add{i} = mul{i} + {self.bias[i]};\n' for i in range(self.out_features)]
-        add_bias = [self.get_adder(self.integer_bits[i], self.fractional_bits, f"add{self.out_features-1}_term{self.in_features}", f"{ftfp(self.bias[i], self.integer_bits[i], self.fractional_bits) }", f"add_bias{i}") for i in range(self.out_features)]
-        multiply_weight = []
+    def emit_chunks(self, outputs: range = None):
+        """
+        Emit Verilog code for this layer
+        :param outputs: Only emit the logic of these neurons, see Emitter.split_outputs
+        :return: Iterator over the Verilog code, one chunk per neuron
+        """
+        outputs = range(self.out_features) if outputs is None else outputs
+        if self.reduction == 'tree':
+            yield from self.emit_tree(outputs)
+            return
 
-        for i in range(self.out_features):
-            # multiply_weight.append(f"mul{i} = 0;\n")
-            multiply_weight.append(f"assign add{i}_term{0} = {ftfp(0.0, self.integer_bits[i], self.fractional_bits)};\n")
-            for j in range(self.in_features):
-                mult_term = self.get_multiplier(self.integer_bits[i], self.fractional_bits, f"in{j}", f"{ftfp(self.weight[j][i], self.integer_bits[i], self.fractional_bits)}", f"mul{i}_term{j}")
-                add_term = self.get_adder(self.integer_bits[i], self.fractional_bits, f"mul{i}_term{j}", f"add{i}_term{j}", f"add{i}_term{j+1}")
-                multiply_weight.append(mult_term)
-                multiply_weight.append(add_term)
-                # multiply_weight.append(f"mul{i} = mul{i} + in{j} * {self.weight[j][i]};\n")
+        fw = self.fractional_bits
+        shift_add = self.shift_add_networks() if self.shift_add else None
+        weight_fixed = self.fixed_constants()[0]
+        if outputs.start == 0:
+            yield from self.emit_header()
+            if shift_add is not None:
+                yield shift_add.declarations((j, f"in{j}", self.in_bits[j]) for j in range(self.in_features))
+        for i in outputs:
+            # the wires of a neuron are declared right before the instances that drive them
+            width = self.neuron_bits[i]
+            # weights that are zero in fixed point contribute nothing and get no multiplier
+            inputs = np.flatnonzero(weight_fixed[i])
+            neuron = [f"    wire signed [{width - 1}:0] mul{i}_term{j};\n" for j in inputs]
+            neuron += [f"    wire signed [{width - 1}:0] add{i}_term{k};\n" for k in range(len(inputs) + 1)]
+            neuron.append(f"    wire signed [{width - 1}:0] add_bias{i};\n")
+            neuron.append(f"    assign add{i}_term{0} = {ftfp(0.0, self.integer_bits[i], fw)};\n")
+            for k, j in enumerate(inputs):
+                neuron.append(self.get_product(shift_add, weight_fixed, i, j, f"mul{i}_term{j}"))
+                neuron.append(self.get_adder(self.integer_bits[i], fw, f"mul{i}_term{j}", f"add{i}_term{k}",
+                                             f"add{i}_term{k + 1}"))
+            neuron.append(self.get_adder(self.integer_bits[i], fw, f"add{i}_term{len(inputs)}",
+                                         self.bias_term(i), f"add_bias{i}"))
+            neuron.append(relu_output(i, f"add_bias{i}", self.mac_bits[i], self.relu))
+            yield ''.join(neuron)
+        if outputs.stop == self.out_features:
+            yield "endmodule\n"
 
+    def emit_header(self):
+        """
+        :return: Iterator over the module header, the port declarations and the ROM declarations
+        """
         in_params = [f"in{i}" for i in range(self.in_features)]
         out_params = [f"out{i}" for i in range(self.out_features)]
 
-        in_definitions = [f"input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
-                          for i in range(self.in_features)]
+        yield f"""
+module {self.name}({",".join(in_params)}, {",".join(out_params)});
+"""
+        yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n" for i in range(self.in_features))
+        yield ''.join(f"    output signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
+                      for i in range(self.out_features))
+        yield f"    {self.rom_declarations()}\n"
 
-        out_definitions = [f"output signed [{self.in_bits[i] - 1}:0] {out_params[i]};\n"
-                           for i in range(self.out_features)]
+    def emit_tree(self, outputs: range):
+        """
+        Emit Verilog code for this layer, summing the products of every neuron with a balanced tree
+        of adder_module instances. Every product and adder is only as wide as the range of its value,
+        derived from the input ranges found by forward_range.
+        :param outputs: Only emit the logic of these neurons, see Emitter.split_outputs
+        :return: Iterator over the Verilog code, one chunk per neuron
+        """
+        fw = self.fractional_bits
+        shift = self.product_shift()
+        in_low, in_high = port_bounds(self.in_range, self.in_bits, 2 ** self.in_fractional_bits)
+        shift_add = self.shift_add_networks() if self.shift_add else None
+        weight_fixed = self.fixed_constants()[0]
 
-        mul_definition = [f"wire signed [{self.in_bits[i] - 1}:0] mul{i}_term{j};\n" for i in range(self.out_features) for j in range(self.in_features)]
-        add_definition = [f"wire signed [{self.in_bits[i] - 1}:0] add{i}_term{j};\n" for i in range(self.out_features) for j in range(self.in_features+1)]
-        bias_definition = [f"wire signed [{self.in_bits[i] - 1}:0] add_bias{i};\n" for i in range(self.out_features)]
+        if outputs.start == 0:
+            yield from self.emit_header()
+            if shift_add is not None:
+                yield shift_add.declarations((j, f"in{j}", self.in_bits[j]) for j in range(self.in_features))
+        for i in outputs:
+            definitions = []
+            instances = []
+            width = self.neuron_bits[i]
+            # the inputs and weights of neuron i are resized to its width by the multiplier ports
+            low, high = port_bounds(np.stack([in_low, in_high], axis=1), [width] * self.in_features)
+            weight = wrap_signed(to_fixed(self.weight[:, i], self.weight_fractional_bits), width)
 
-        assigns = [f"assign out{i} = add_bias{i};\n" for i in range(self.out_features)]
+            leaves = []
+            for j in np.flatnonzero(weight):
+                products = (int(low[j]) * int(weight[j]), int(high[j]) * int(weight[j]))
+                leaf = (f"mul{i}_term{j}", min(products) >> shift, max(products) >> shift)
+                bits = node_bits(leaf[1], leaf[2], width)
+                definitions.append(f"    wire signed [{bits - 1}:0] {leaf[0]};\n")
+                instances.append(self.get_product(shift_add, weight_fixed, i, j, leaf[0]))
+                leaves.append(leaf)
 
-        return f"""
-module {self.name}({",".join(in_params)}, {",".join(out_params)});
-    {'    '.join(in_definitions)}
-    {'    '.join(out_definitions)}
-    {'    '.join(mul_definition)}
-    {'    '.join(add_definition)}
-    {'    '.join(bias_definition)}
-    {'    '.join(multiply_weight)}
-    {'    '.join(add_bias)}
-        
-    
-    {'  '.join(assigns)}
-endmodule
-"""
+            nodes, root = build_adder_tree(f"add{i}", leaves) if leaves else ([], ("0", 0, 0))
+            for node, left, right, node_low, node_high in nodes:
+                # keep at least one integer bit so the adder_module parameters stay meaningful
+                bits = max(node_bits(node_low, node_high, width), min(fw + 1, width))
+                definitions.append(f"    wire signed [{bits - 1}:0] {node};\n")
+                instances.append(self.get_adder(bits - fw, fw, left, right, node))
+
+            definitions.append(f"    wire signed [{width - 1}:0] add_bias{i};\n")
+            instances.append(self.get_adder(self.integer_bits[i], fw, root[0], self.bias_term(i), f"add_bias{i}"))
+            instances.append(relu_output(i, f"add_bias{i}", self.mac_bits[i], self.relu))
+            yield ''.join(definitions) + ''.join(instances)
+        if outputs.stop == self.out_features:
+            yield "endmodule\n"
@@ -1,7 +1,9 @@
 import numpy as np
-from layers.utils import range_to_bits
+from layers.emitter import Emitter
+from layers.intervals import max_range
+from layers.utils import signed_ranges_to_bits, wrap_signed
 
-class MaxPool:
+class MaxPool(Emitter):
     def __init__(self, shape: int, index: int, pool_size: int = 2):
         self.input_shape = shape
         # Output shape is half the input shape (with pool_size=2)
@@ -13,48 +15,51 @@ class MaxPool:
     def __str__(self):
         return f'MaxPool({self.input_shape} -> {self.shape})'
 
-    def forward_range(self, in_range: np.ndarray):
-        # Output range will be the same as input range since we're just taking max values
-        out_range = np.array([[in_range[i][0], in_range[i][1]] 
-                             for i in range(0, self.input_shape, self.pool_size)])
-        
-        self.in_bits = [range_to_bits(*in_range[i]) for i in range(self.input_shape)]
-        # Output bits will be the same as input bits since we're just selecting values
-        self.out_bits = [range_to_bits(*out_range[i]) for i in range(self.shape[0])]
-        
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        if out_range is None:
+            # The maximum of a group is at least the largest lower bound and at most the largest upper bound
+            out_range = max_range(in_range[:self.input_shape], self.pool_size)
+
+        self.in_bits = signed_ranges_to_bits(in_range[:self.input_shape])
+        self.out_bits = signed_ranges_to_bits(out_range)
+
         return out_range
 
-    def emit(self):
+    def simulate(self, batch: np.ndarray):
+        """
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once
+        :param batch: Integer array of shape (N, input_shape) holding the values on the input nets
+        :return: int64 array of shape (N, input_shape // pool_size) holding the values on the output ports
+        """
+        values = wrap_signed(batch, self.in_bits)
+        first = values[:, 0:self.shape[0] * self.pool_size:self.pool_size]
+        second = values[:, 1:self.shape[0] * self.pool_size:self.pool_size]
+
+        return wrap_signed(np.where(first > second, first, second), self.out_bits)
+
+    def emit_chunks(self):
         """
         Emit the Verilog code for max pooling layer
+        :return: Iterator over the Verilog code
         """
         in_params = [f"in{i}" for i in range(self.input_shape)]
         out_params = [f"out{i}" for i in range(self.shape[0])]
 
-        in_definitions = [f"input [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
-                          for i in range(self.input_shape)]
-        out_definitions = [f"output reg [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
-                           for i in range(self.shape[0])]
+        yield f"""
+module {self.name}({",".join(in_params)}, {",".join(out_params)});
+"""
+        yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n" for i in range(self.input_shape))
+        yield ''.join(f"    output reg signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n" for i in range(self.shape[0]))
+        yield "\n    always @(*)\n    begin\n"
 
         # Generate max pooling logic
-        maxpool_code = []
         for i in range(0, self.input_shape, self.pool_size):
             out_idx = i // self.pool_size
-            maxpool_code.append(f"""
+            yield f"""
         // Max pooling for output {out_idx}
         if (in{i} > in{i+1})
             out{out_idx} = in{i};
         else
-            out{out_idx} = in{i+1};\n""")
-
-        return f"""
-module {self.name}({",".join(in_params)}, {",".join(out_params)});
-    {'    '.join(in_definitions)}
-    {'    '.join(out_definitions)}
-                
-    always @(*) 
-    begin
-        {"        ".join(maxpool_code)}
-    end
-endmodule
-""" 
\ No newline at end of file
+            out{out_idx} = in{i+1};
+"""
+        yield "    end\nendmodule\n"
@@ -0,0 +1,120 @@
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from layers.adder_tree import balanced_sum
+from layers.relu import relu_output
+from layers.shift_add import multiply
+
+
+def split_stages(terms: list, stages: int) -> List[list]:
+    """
+    Split the terms of one dot product into consecutive, evenly sized chunks
+    :param terms: Terms of the dot product
+    :param stages: Number of chunks
+    :return: List of stages chunks, some of them empty if there are fewer terms than stages
+    """
+    bounds = np.linspace(0, len(terms), stages + 1).round().astype(int)
+    return [terms[bounds[s]:bounds[s + 1]] for s in range(stages)]
+
+
+def emit_pipelined_mac(name: str, in_bits, out_bits, terms: Sequence[List[Tuple[int, int, str]]], bias, stages: int,
+                       tree: bool = False, roms: str = '', shift_add=None, relu_bits=None,
+                       outputs: range = None) -> Iterator[str]:
+    """
+    Emit a registered multiply-accumulate module.
+    The terms of every output are split into `stages` chunks, and stage s adds its chunk to the
+    partial sum registered by stage s - 1, so the longest combinational path is one chunk
+    instead of the whole dot product. Inputs consumed by later stages are delayed in shift
+    registers so that every stage works on the same vector.
+    :param name: Module name
+    :param in_bits: Bit width of every input
+    :param out_bits: Bit width of the result of every dot product, also used for the partial sums
+    :param terms: For every output, a list of (input index, weight, weight expression) triples.
+        It is read twice, once to find the delays and once to emit the stages.
+    :param bias: For every output, the expression added in the first stage, or None
+    :param stages: Number of register stages, which is also the latency in cycles
+    :param tree: Sum the terms of every stage as a balanced tree instead of left to right
+    :param roms: Declarations of the ROMs the weight expressions read from
+    :param shift_add: ShiftAdd networks of the inputs to build the products from instead of
+        multipliers, for every stage from the delayed inputs it reads
+    :param relu_bits: Bit width of every output of a ReLU fused into the module, None for the results
+    :param outputs: Only emit the logic of these outputs, see Emitter.split_outputs
+    :return: Iterator over the Verilog code, one chunk per output for the stage logic
+    """
+    num_in, num_out = len(in_bits), len(terms)
+    port_bits = out_bits if relu_bits is None else relu_bits
+    outputs = range(num_out) if outputs is None else outputs
+
+    if outputs.start == 0:
+        yield from emit_pipeline_header(name, in_bits, port_bits, out_bits, terms, stages, roms, shift_add)
+    for i in outputs:
+        stage_logic = []
+        for s, chunk in enumerate(split_stages(terms[i], stages)):
+            start = f"acc{i}_s{s}" if s > 0 else str(bias[i] if bias is not None else 0)
+            operands = [start] + [multiply(shift_add, j, tap(j, s), weight, literal) for j, weight, literal in chunk]
+            total = balanced_sum(operands) if tree else ' + '.join(operands)
+            stage_logic.append(f"        acc{i}_s{s + 1} <= {total};\n")
+        yield ''.join(stage_logic)
+    if outputs.stop != num_out:
+        return
+    yield "    end\n"
+
+    valid_reset = ''.join(f"            valid_s{s} <= 1'b0;\n" for s in range(1, stages + 1))
+    valid_logic = ''.join(f"            valid_s{s} <= {'in_valid' if s == 1 else f'valid_s{s - 1}'};\n"
+                          for s in range(1, stages + 1))
+    yield f"""
+    always @(posedge clk)
+    begin
+        if (rst) begin
+{valid_reset}        end else begin
+{valid_logic}        end
+    end
+
+"""
+    yield ''.join(relu_output(i, f"acc{i}_s{stages}", out_bits[i], relu_bits is not None) for i in range(num_out))
+    yield f"    assign out_valid = valid_s{stages};\nendmodule\n"
+
+
+def tap(j: int, s: int) -> str:
+    """
+    :return: Name of input j delayed for stage s
+    """
+    return f"in{j}" if s == 0 else f"in{j}_d{s}"
+
+
+def emit_pipeline_header(name: str, in_bits, port_bits, out_bits, terms, stages: int, roms: str,
+                         shift_add) -> Iterator[str]:
+    """
+    :return: Iterator over the declarations of emit_pipelined_mac and the delay registers of its inputs
+    """
+    num_in, num_out = len(in_bits), len(terms)
+    delay = [0] * num_in
+    # the inputs every stage multiplies
+    taps = set()
+    for output_terms in terms:
+        for s, chunk in enumerate(split_stages(output_terms, stages)):
+            for j, _, _ in chunk:
+                delay[j] = max(delay[j], s)
+                taps.add((j, s))
+
+    yield f"""
+module {name}(clk, rst, in_valid, {",".join(f"in{j}" for j in range(num_in))}, {",".join(f"out{i}" for i in range(num_out))}, out_valid);
+    input clk;
+    input rst;
+    input in_valid;
+    output out_valid;
+"""
+    yield ''.join(f"    input signed [{in_bits[j] - 1}:0] in{j};\n" for j in range(num_in))
+    yield ''.join(f"    output signed [{port_bits[i] - 1}:0] out{i};\n" for i in range(num_out))
+    yield ''.join(f"    reg signed [{in_bits[j] - 1}:0] in{j}_d{s};\n"
+                  for j in range(num_in) for s in range(1, delay[j] + 1))
+    yield ''.join(f"    reg signed [{out_bits[i] - 1}:0] acc{i}_s{s};\n"
+                  for i in range(num_out) for s in range(1, stages + 1))
+    yield ''.join(f"    reg valid_s{s};\n" for s in range(1, stages + 1))
+    yield f"    {roms}\n"
+    if shift_add is not None:
+        yield shift_add.declarations((j, tap(j, s), in_bits[j]) for j, s in sorted(taps))
+
+    yield "    always @(posedge clk)\n    begin\n"
+    yield ''.join(f"        {tap(j, s)} <= {tap(j, s - 1)};\n" for j in range(num_in) for s in range(1, delay[j] + 1))
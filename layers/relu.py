@@ -1,51 +1,77 @@
 import numpy as np
 
-from layers.utils import range_to_bits
+from layers.emitter import Emitter
+from layers.intervals import relu_range
+from layers.utils import signed_ranges_to_bits, wrap_signed
 
 
-class ReLU:
+def relu_output(i: int, expression: str, bits: int, relu: bool) -> str:
+    """
+    :param i: Index of the output
+    :param expression: Verilog expression of the result of a dot product
+    :param bits: Width of the result
+    :param relu: Whether a ReLU is fused into the layer
+    :return: Verilog driving out{i} with the result, or with the ReLU of the result wrapped to
+        bits like the input port of a separate ReLU layer
+    """
+    if not relu:
+        return f"    assign out{i} = {expression};\n"
+    return (f"    wire signed [{bits - 1}:0] mac{i} = {expression};\n"
+            f"    assign out{i} = mac{i} > 0 ? mac{i} : 0;\n")
+
+
+class ReLU(Emitter):
 
     def __init__(self, shape: int, index: int):
         self.shape = (shape,)
+        self.index = index
         self.name = f'layer_{index}_relu_{shape}'
         self.in_bits, self.out_bits = None, None
 
     def __str__(self):
         return f'ReLU({self.shape})'
 
-    def forward_range(self, in_range: np.ndarray):
-        out_range = np.maximum(in_range, 0)
+    def keep_outputs(self, keep):
+        """
+        Remove the values that no later layer reads, keeping the widths found by forward_range
+        :param keep: Indices of the values to keep, in order
+        """
+        self.shape = (len(keep),)
+        self.name = f'layer_{self.index}_relu_{self.shape[0]}'
+        self.in_bits, self.out_bits = self.in_bits[keep], self.out_bits[keep]
+
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        if out_range is None:
+            out_range = relu_range(in_range)
 
-        self.in_bits = [range_to_bits(*in_range[i]) for i in range(self.shape[0])]
-        self.out_bits = [range_to_bits(*out_range[i]) for i in range(self.shape[0])]
+        self.in_bits = signed_ranges_to_bits(in_range[:self.shape[0]])
+        self.out_bits = signed_ranges_to_bits(out_range[:self.shape[0]])
 
         return out_range
 
-    def emit(self):
+    def simulate(self, batch: np.ndarray):
         """
-        Emit the Verilog code for this layer
-        :return:
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once
+        :param batch: Integer array of shape (N, shape) holding the values on the input nets
+        :return: int64 array of the same shape holding the values on the output ports
         """
+        values = wrap_signed(batch, self.in_bits)
+        return wrap_signed(np.maximum(values, 0), self.out_bits)
 
-        relu_code = [f'out{i} = in{i} > 0 ? in{i} : 0;\n' for i in range(self.shape[0])]
-
+    def emit_chunks(self):
+        """
+        Emit the Verilog code for this layer
+        :return: Iterator over the Verilog code
+        """
         in_params = [f"in{i}" for i in range(self.shape[0])]
         out_params = [f"out{i}" for i in range(self.shape[0])]
 
-        in_definitions = [f"input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
-                          for i in range(self.shape[0])]
-
-        out_definitions = [f"output reg signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
-                           for i in range(self.shape[0])]
-
-        return f"""
+        yield f"""
 module {self.name}({",".join(in_params)}, {",".join(out_params)});
-    {'    '.join(in_definitions)}
-    {'    '.join(out_definitions)}
-                
-    always @(*) 
-    begin
-        {"        ".join(relu_code)}
-    end
-endmodule
 """
+        yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n" for i in range(self.shape[0]))
+        yield ''.join(f"    output reg signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
+                      for i in range(self.shape[0]))
+        yield "\n    always @(*)\n    begin\n"
+        yield ''.join(f'        out{i} = in{i} > 0 ? in{i} : 0;\n' for i in range(self.shape[0]))
+        yield "    end\nendmodule\n"
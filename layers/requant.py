@@ -0,0 +1,150 @@
+import numpy as np
+import torch
+from torch import nn
+
+from layers.emitter import Emitter
+from layers.utils import signed_range_to_bits, signed_ranges_to_bits, wrap_signed
+
+
+def requantize(values, multiplier, shift: int, bits: int):
+    """
+    Rescale integers by multiplier / 2^shift, rounding half up, and saturate them to signed bits
+    :param values: Integer array of shape (..., N)
+    :param multiplier: Positive integer factor of every value, shape (N,)
+    :param shift: Number of bits the products are shifted right by
+    :param bits: Bit width of the results
+    :return: int64 array of the same shape
+    """
+    scaled = np.asarray(values, dtype=np.int64) * np.asarray(multiplier, dtype=np.int64)
+    if shift:
+        scaled = (scaled + (1 << (shift - 1))) >> shift
+
+    return np.clip(scaled, -(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+
+
+class Requantize(nn.Module):
+    """
+    Torch counterpart of Requant, so a quantized model runs in torch with exactly the
+    integer arithmetic of the hardware. Values are integers held in float64 tensors.
+    """
+
+    def __init__(self, multiplier: np.ndarray, shift: int, bits: int):
+        """
+        :param multiplier: Positive integer factor of every feature, or of every channel for (N, C, L) inputs
+        :param shift: Number of bits the products are shifted right by
+        :param bits: Bit width the results are saturated to
+        """
+        super().__init__()
+        self.multiplier = np.asarray(multiplier, dtype=np.int64)
+        self.shift = shift
+        self.bits = bits
+
+    def extra_repr(self):
+        return f'channels={len(self.multiplier)}, shift={self.shift}, bits={self.bits}'
+
+    def forward(self, x):
+        values = x.detach().numpy().astype(np.int64)
+        # the multiplier runs along dimension 1, like the channels of a convolution
+        multiplier = self.multiplier.reshape((-1,) + (1,) * (values.ndim - 2))
+        scaled = np.moveaxis(requantize(np.moveaxis(values * multiplier, 1, -1), 1, self.shift, self.bits), -1, 1)
+        return torch.from_numpy(scaled.astype(np.float64))
+
+
+class Requant(Emitter):
+    """
+    Requantization between two integer layers: every value is multiplied by a constant, shifted
+    right with rounding and saturated, which maps an accumulator at one scale onto the narrow
+    integers the next layer expects at another
+    """
+    @classmethod
+    def layer_from(cls, layer, index: int, shape: int):
+        # a multiplier per channel covers all positions of that channel
+        return cls(shape, index, np.repeat(layer.multiplier, shape // len(layer.multiplier)), layer.shift, layer.bits)
+
+    def __init__(self, shape: int, index: int, multiplier: np.ndarray, shift: int, bits: int):
+        """
+        :param shape: Number of values
+        :param index: Index of the layer
+        :param multiplier: Positive integer factor of every value
+        :param shift: Number of bits the products are shifted right by
+        :param bits: Bit width the results are saturated to
+        """
+        self.shape = (shape,)
+        self.index = index
+        self.name = f'layer_{index}_requant_{shape}'
+        self.multiplier = np.broadcast_to(np.asarray(multiplier, dtype=np.int64), (shape,))
+        self.shift = shift
+        self.bits = bits
+        self.in_bits, self.out_bits = None, None
+        # whether any value can leave the range of bits, otherwise the comparisons are not emitted
+        self.saturate = True
+
+        if np.any(self.multiplier <= 0):
+            raise ValueError('Requantization multipliers must be positive')
+
+    def __str__(self):
+        return f'Requant({self.shape[0]}, >> {self.shift}, {self.bits} bits)'
+
+    def keep_outputs(self, keep):
+        """
+        Remove the values that no later layer reads, keeping the widths found by forward_range
+        :param keep: Indices of the values to keep, in order
+        """
+        self.shape = (len(keep),)
+        self.name = f'layer_{self.index}_requant_{self.shape[0]}'
+        self.multiplier = self.multiplier[keep]
+        self.in_bits, self.out_bits = self.in_bits[keep], self.out_bits[keep]
+
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        # positive multipliers keep the order of the values, so the bounds map onto the bounds
+        in_range = np.asarray(in_range, dtype=np.float64)[:self.shape[0]]
+        unclipped = requantize(np.stack([np.floor(in_range[:, 0]), np.ceil(in_range[:, 1])], axis=1).T,
+                               self.multiplier, self.shift, 64).T
+        self.saturate = bool(np.any(unclipped[:, 0] < -(1 << (self.bits - 1)))
+                             or np.any(unclipped[:, 1] > (1 << (self.bits - 1)) - 1))
+        if out_range is None:
+            out_range = requantize(unclipped.T, 1, 0, self.bits).T
+
+        self.in_bits = signed_ranges_to_bits(in_range)
+        self.out_bits = np.minimum(signed_ranges_to_bits(out_range), self.bits)
+
+        return out_range
+
+    def simulate(self, batch: np.ndarray):
+        """
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once
+        :param batch: Integer array of shape (N, shape) holding the values on the input nets
+        :return: int64 array of the same shape holding the values on the output ports
+        """
+        values = wrap_signed(batch, self.in_bits)
+        return wrap_signed(requantize(values, self.multiplier, self.shift, self.bits), self.out_bits)
+
+    def emit_chunks(self):
+        """
+        Emit the Verilog code for this layer
+        :return: Iterator over the Verilog code
+        """
+        in_params = [f"in{i}" for i in range(self.shape[0])]
+        out_params = [f"out{i}" for i in range(self.shape[0])]
+        low, high = -(1 << (self.bits - 1)), (1 << (self.bits - 1)) - 1
+
+        yield f"""
+module {self.name}({",".join(in_params)}, {",".join(out_params)});
+"""
+        yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n" for i in range(self.shape[0]))
+        yield ''.join(f"    output signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n" for i in range(self.shape[0]))
+
+        for i in range(self.shape[0]):
+            multiplier = int(self.multiplier[i])
+            # the product and the rounding constant need the input width plus the multiplier width
+            width = max(int(self.in_bits[i]) + signed_range_to_bits(0, multiplier) + 1, self.shift + 2)
+            rounding = f" + {1 << (self.shift - 1)}" if self.shift else ''
+            yield f"    wire signed [{width - 1}:0] scaled{i} = {in_params[i]} * {multiplier}{rounding};\n"
+            # an arithmetic shift right is the slice above the dropped bits
+            yield f"    wire signed [{width - self.shift - 1}:0] shifted{i} = scaled{i}[{width - 1}:{self.shift}];\n"
+            if self.saturate:
+                yield (f"    assign {out_params[i]} = shifted{i} > {high} ? {high} : "
+                       f"shifted{i} < {low} ? {low} : shifted{i};\n")
+            else:
+                yield f"    assign {out_params[i]} = shifted{i};\n"
+        yield "endmodule\n"
@@ -0,0 +1,38 @@
+import numpy as np
+
+from layers.utils import signed_range_to_bits, write_hex
+
+
+def rom_bits(values) -> int:
+    """
+    :param values: Integer contents of a ROM
+    :return: Word width that holds every value in two's complement
+    """
+    values = np.asarray(values)
+    return signed_range_to_bits(int(values.min()), int(values.max())) if values.size else 1
+
+
+def write_rom(path: str, values, bits: int = None) -> int:
+    """
+    Write the contents of a ROM as a $readmemh file in one bulk write
+    :param path: Output file
+    :param values: Integer contents, flattened in row-major order
+    :param bits: Word width, derived from the values if not given
+    :return: Word width
+    """
+    bits = bits or rom_bits(values)
+    write_hex(path, np.asarray(values, dtype=np.int64), bits)
+    return bits
+
+
+def rom_declaration(name: str, bits: int, depth: int, path: str) -> str:
+    """
+    Declare a ROM array and load it from a file written by write_rom
+    :param name: Array name
+    :param bits: Word width
+    :param depth: Number of words
+    :param path: File the simulator or synthesis tool reads the contents from
+    :return: Verilog code
+    """
+    return (f"reg signed [{bits - 1}:0] {name} [0:{depth - 1}];\n"
+            f"    initial $readmemh(\"{path}\", {name});\n")
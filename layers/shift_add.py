@@ -0,0 +1,234 @@
+import re
+from collections import Counter
+from typing import Dict, Hashable, Iterable, List, Tuple
+
+
+def csd_digits(value: int) -> List[Tuple[int, int]]:
+    """
+    Canonical signed digit representation of an integer: digits of -1, 0 and 1 of which no two
+    neighbours are both non-zero, so it has the fewest non-zero digits of any signed binary form
+    :param value: Integer
+    :return: (shift, sign) of every non-zero digit, value = sum(sign << shift), lowest first
+    """
+    digits = []
+    shift = 0
+    while value:
+        if value & 1:
+            # a run of ones ends in ...11, which is cheaper as a subtraction and a carry
+            sign = 2 - (value & 3)
+            digits.append((shift, sign))
+            value -= sign
+        value >>= 1
+        shift += 1
+    return digits
+
+
+def split_power(value: int) -> Tuple[int, int]:
+    """
+    :param value: Non-zero integer
+    :return: The odd part and the number of trailing zero bits of the magnitude
+    """
+    value = abs(int(value))
+    shift = (value & -value).bit_length() - 1
+    return value >> shift, shift
+
+
+class ShiftAddNetwork:
+    """
+    Multiplications of one value by a set of constants as shifts and adds. The constants are split
+    into their canonical signed digits, and pairs of digits that occur in several constants are
+    computed once as a subexpression and reused (Hartley's common subexpression elimination).
+    Only the odd parts of the constants are built, the powers of two are shifts of the products.
+    """
+
+    def __init__(self, constants: Iterable[int]):
+        """
+        :param constants: Integers the value is multiplied with
+        """
+        odd = sorted({split_power(c)[0] for c in constants if c} - {1})
+        # node 0 is the value itself, node k the subexpression value(left) + sign * (value(right) << shift)
+        self.values = [1]
+        self.nodes = [None]
+        # every odd constant as (shift, sign, node) digits whose sum is the constant times the value
+        self.digits = {c: [(shift, sign, 0) for shift, sign in csd_digits(c)] for c in odd}
+
+        while True:
+            counts = Counter()
+            for digits in self.digits.values():
+                counts.update(self.pairs(digits))
+            pattern = min((pattern for pattern in counts if counts[pattern] > 1),
+                          key=lambda pattern: (-counts[pattern], pattern), default=None)
+            if pattern is None:
+                break
+            left, right, distance, sign = pattern
+            self.nodes.append(pattern)
+            self.values.append(self.values[left] + sign * (self.values[right] << distance))
+            self.digits = {c: self.replace(digits, pattern, len(self.nodes) - 1) for c, digits in self.digits.items()}
+
+    @staticmethod
+    def pairs(digits):
+        """
+        :param digits: (shift, sign, node) digits of a constant
+        :return: Pattern (left node, right node, distance, sign) of every pair of digits, a pattern
+            only counted as often as it occurs without overlapping
+        """
+        found = []
+        used = set()
+        ordered = sorted(digits)
+        for a in range(len(ordered)):
+            for b in range(a + 1, len(ordered)):
+                (low, low_sign, left), (high, high_sign, right) = ordered[a], ordered[b]
+                pattern = (left, right, high - low, low_sign * high_sign)
+                if (pattern, a) not in used and (pattern, b) not in used:
+                    used.update({(pattern, a), (pattern, b)})
+                    found.append(pattern)
+        return found
+
+    @staticmethod
+    def replace(digits, pattern, node: int):
+        """
+        :param digits: (shift, sign, node) digits of a constant
+        :param pattern: Pattern (left node, right node, distance, sign) computed by node
+        :param node: Index of the subexpression
+        :return: The digits with every non-overlapping occurrence of the pattern replaced by one digit of node
+        """
+        left, right, distance, sign = pattern
+        remaining = sorted(digits)
+        result = []
+        while remaining:
+            low, low_sign, low_node = remaining.pop(0)
+            match = next((k for k, (high, high_sign, high_node) in enumerate(remaining)
+                          if low_node == left and high_node == right and high - low == distance
+                          and low_sign * high_sign == sign), None)
+            if match is None:
+                result.append((low, low_sign, low_node))
+            else:
+                remaining.pop(match)
+                result.append((low, low_sign, node))
+        return result
+
+    def adders(self) -> int:
+        """
+        :return: Number of adders and subtractors of the network
+        """
+        return len(self.nodes) - 1 + sum(len(digits) - 1 for digits in self.digits.values())
+
+    def declarations(self, expression: str, bits: int) -> str:
+        """
+        :param expression: Verilog expression of the value, an input or a register
+        :param bits: Bit width of the value
+        :return: Wires and assignments of the subexpressions and the odd multiples of the value
+        """
+        prefix = wire_prefix(expression)
+
+        def reference(node):
+            return expression if node == 0 else f"{prefix}_t{node}"
+
+        def term(shift, node):
+            return f"({reference(node)} <<< {shift})" if shift else reference(node)
+
+        lines = []
+        for node in range(1, len(self.nodes)):
+            left, right, distance, sign = self.nodes[node]
+            lines.append(f"    wire signed [{bits + abs(self.values[node]).bit_length() - 1}:0] {reference(node)};\n")
+            lines.append(f"    assign {reference(node)} = {reference(left)} {'+' if sign > 0 else '-'} "
+                         f"{term(distance, right)};\n")
+        for constant, digits in self.digits.items():
+            if len(digits) == 1:
+                continue
+            digits = sorted(digits, key=lambda digit: -digit[1])
+            total = ('-' if digits[0][1] < 0 else '') + term(digits[0][0], digits[0][2])
+            total += ''.join(f" {'+' if sign > 0 else '-'} {term(shift, node)}" for shift, sign, node in digits[1:])
+            lines.append(f"    wire signed [{bits + constant.bit_length() - 1}:0] {prefix}_m{constant};\n")
+            lines.append(f"    assign {prefix}_m{constant} = {total};\n")
+        return ''.join(lines)
+
+    def product(self, expression: str, constant: int) -> str:
+        """
+        :param expression: Verilog expression of the value, as passed to declarations
+        :param constant: One of the constants of the network
+        :return: Verilog expression of the value times the constant, made of the wires of declarations
+        """
+        if constant == 0:
+            return "0"
+        odd, shift = split_power(constant)
+        if odd == 1:
+            name = expression
+        elif len(self.digits[odd]) == 1:
+            # the constant is a subexpression times a power of two, possibly negated
+            digit_shift, digit_sign, node = self.digits[odd][0]
+            name, shift = f"{wire_prefix(expression)}_t{node}", shift + digit_shift
+            constant = constant * digit_sign
+        else:
+            name = f"{wire_prefix(expression)}_m{odd}"
+        shifted = f"({name} <<< {shift})" if shift else name
+        return f"-{shifted}" if constant < 0 else shifted
+
+
+def wire_prefix(expression: str) -> str:
+    """
+    :param expression: Verilog expression of a value, such as in3 or line0[2]
+    :return: Identifier the wires derived from the value are named after
+    """
+    return re.sub(r'\W+', '_', expression).strip('_')
+
+
+class ShiftAdd:
+    """
+    Shift-add networks replacing the constant multiplications of a layer, one network per input
+    shared by all outputs that multiply the input
+    """
+
+    def __init__(self, columns: Dict[Hashable, Iterable[int]]):
+        """
+        :param columns: For every input key, the integer constants the input is multiplied with
+        """
+        self.networks = {key: ShiftAddNetwork(constants) for key, constants in columns.items()}
+
+    @classmethod
+    def from_terms(cls, terms):
+        """
+        :param terms: For every output, the (input index, weight, weight expression) triples of its dot product
+        :return: The networks of the inputs of the dot products
+        """
+        columns = {}
+        for output_terms in terms:
+            for j, weight, _ in output_terms:
+                columns.setdefault(j, set()).add(int(weight))
+        return cls(columns)
+
+    def adders(self) -> int:
+        """
+        :return: Number of adders and subtractors of all networks
+        """
+        return sum(network.adders() for network in self.networks.values())
+
+    def declarations(self, sources: Iterable[Tuple[Hashable, str, int]]) -> str:
+        """
+        :param sources: (input key, Verilog expression, bit width) of every value the products are taken of
+        :return: Wires and assignments of the networks of all sources
+        """
+        return ''.join(self.networks[key].declarations(expression, bits) for key, expression, bits in sources)
+
+    def product(self, key: Hashable, expression: str, constant: int) -> str:
+        """
+        :param key: Input key of the network
+        :param expression: Verilog expression of the input, as passed to declarations
+        :param constant: Weight the input is multiplied with
+        :return: Verilog expression of the product
+        """
+        return self.networks[key].product(expression, int(constant))
+
+
+def multiply(shift_add, key: Hashable, expression: str, weight, literal: str) -> str:
+    """
+    :param shift_add: ShiftAdd networks of the layer, or None for multiplications
+    :param key: Input key of the network
+    :param expression: Verilog expression of the input
+    :param weight: Value of the weight
+    :param literal: Verilog expression of the weight
+    :return: Verilog expression of the product of the input and the weight
+    """
+    if shift_add is None:
+        return f"{expression} * {literal}"
+    return shift_add.product(key, expression, weight)
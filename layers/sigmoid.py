@@ -1,7 +1,8 @@
 import numpy as np
-from layers.utils import range_to_bits
+from layers.emitter import Emitter
+from layers.utils import ranges_to_bits, signed_ranges_to_bits, wrap_signed
 
-class Sigmoid:
+class Sigmoid(Emitter):
     def __init__(self, shape: int, index: int):
         self.shape = (shape,)
         self.name = f'layer_{index}_sigmoid_{shape}'
@@ -10,26 +11,49 @@ class Sigmoid:
     def __str__(self):
         return f'Sigmoid({self.shape})'
 
-    def forward_range(self, in_range: np.ndarray):
-        # Sigmoid output is always between 0 and 1
-        out_range = np.array([[0, 1] for _ in range(self.shape[0])])
+    def forward_range(self, in_range: np.ndarray, out_range: np.ndarray = None):
+        # Sigmoid output is always between 0 and 1, so observed output ranges are not needed
+        out_range = np.tile([0, 1], (self.shape[0], 1))
 
-        self.in_bits = [range_to_bits(*in_range[i]) for i in range(self.shape[0])]
-        self.out_bits = [range_to_bits(*out_range[i]) + 1 for i in range(self.shape[0])]
+        self.in_bits = signed_ranges_to_bits(in_range[:self.shape[0]])
+        self.out_bits = ranges_to_bits(out_range) + 1
 
         return out_range
 
-    def emit(self):
+    def simulate(self, batch: np.ndarray):
+        """
+        Bit-accurate model of the emitted Verilog, evaluated for a whole batch at once
+        :param batch: Integer array of shape (N, shape) holding the values on the input nets
+        :return: int64 array of the same shape holding the values on the output ports
+        """
+        values = wrap_signed(batch, self.in_bits)
+        out = np.where(values <= -4 << 8, 0, np.where(values >= 4 << 8, 1, (128 << 8) + (values >> 3)))
+
+        return wrap_signed(out, self.out_bits)
+
+    def emit_chunks(self):
         """
         Emit the Verilog code for this layer.
         Using a piece-wise linear approximation of sigmoid:
         if x < -4:     return 0
         if x > 4:      return 1
         if -4 ≤ x ≤ 4: return 0.5 + 0.125*x
+        :return: Iterator over the Verilog code
         """
+        in_params = [f"in{i}" for i in range(self.shape[0])]
+        out_params = [f"out{i}" for i in range(self.shape[0])]
+
+        yield f"""
+module {self.name}({",".join(in_params)}, {",".join(out_params)});
+"""
+        yield ''.join(f"    input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n" for i in range(self.shape[0]))
+        yield ''.join(f"    output reg signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
+                      for i in range(self.shape[0]))
+        yield "\n    always @(*)\n    begin\n"
+
         # Using fixed-point arithmetic with 8 fractional bits
-        sigmoid_code = [
-            f'''
+        for i in range(self.shape[0]):
+            yield f'''
             if (in{i} <= -4 << 8) begin
                 out{i} = 0;
             end else if (in{i} >= 4 << 8) begin
@@ -39,30 +63,5 @@ class Sigmoid:
                 // (128 + x/8) in fixed point arithmetic
                 out{i} = (128 << 8) + (in{i} >>> 3);
             end
-            ''' for i in range(self.shape[0])
-        ]
-
-        in_params = [f"in{i}" for i in range(self.shape[0])]
-        out_params = [f"out{i}" for i in range(self.shape[0])]
-
-        in_definitions = [
-            f"input signed [{self.in_bits[i] - 1}:0] {in_params[i]};\n"
-            for i in range(self.shape[0])
-        ]
-
-        out_definitions = [
-            f"output reg signed [{self.out_bits[i] - 1}:0] {out_params[i]};\n"
-            for i in range(self.shape[0])
-        ]
-
-        return f"""
-module {self.name}({",".join(in_params)}, {",".join(out_params)});
-    {'    '.join(in_definitions)}
-    {'    '.join(out_definitions)}
-                
-    always @(*) 
-    begin
-        {"        ".join(sigmoid_code)}
-    end
-endmodule
-""" 
\ No newline at end of file
+'''
+        yield "    end\nendmodule\n"
@@ -1,5 +1,6 @@
 import math
 
+import numpy as np
 
 
 def range_to_bits(low: float, high: float) -> int:
@@ -15,6 +16,65 @@ def range_to_bits(low: float, high: float) -> int:
     return int(math.ceil(math.log2(high - low + 1)))
 
 
+def ranges_to_bits(ranges) -> np.ndarray:
+    """
+    Array version of range_to_bits
+    :param ranges: Array of shape (N, 2) with a range per row, in either order
+    :return: int64 array of shape (N,) with the number of bits required for every range
+    """
+    ranges = np.asarray(ranges, dtype=np.float64).reshape(-1, 2)
+
+    return np.ceil(np.log2(np.abs(ranges[:, 1] - ranges[:, 0]) + 1)).astype(np.int64)
+
+
+def signed_range_to_bits(low: float, high: float) -> int:
+    """
+    Number of bits of a two's complement number that can hold every integer in a range
+    :param low: Lower bound, rounded down
+    :param high: Upper bound, rounded up
+    :return: Number of bits required
+    """
+
+    low, high = min(low, high), max(low, high)
+    low, high = int(math.floor(low)), int(math.ceil(high))
+
+    return max((-low - 1).bit_length() + 1 if low < 0 else 1, high.bit_length() + 1 if high > 0 else 1)
+
+
+def signed_ranges_to_bits(ranges) -> np.ndarray:
+    """
+    Array version of signed_range_to_bits
+    :param ranges: Array of shape (N, 2) with a range per row, in either order
+    :return: int64 array of shape (N,) with the two's complement width of every range
+    """
+    ranges = np.asarray(ranges, dtype=np.float64).reshape(-1, 2)
+    low, high = np.floor(ranges.min(axis=1)), np.ceil(ranges.max(axis=1))
+    # the exponent returned by frexp is the bit length of a non-negative integer
+    negative_bits = np.frexp(np.maximum(-low - 1, 0))[1] + 1
+    positive_bits = np.frexp(np.maximum(high, 0))[1] + 1
+
+    return np.maximum(negative_bits, positive_bits).astype(np.int64)
+
+
+def port_bounds(in_range, bits, scale: int = 1):
+    """
+    Integer bounds of the values an input port can carry. The range found by forward_range is used
+    when it fits into the port, otherwise the upstream value may have wrapped and any value the
+    port can represent is possible.
+    :param in_range: Array of shape (N, 2) with the range of every input
+    :param bits: Bit width of every input port
+    :param scale: Factor the range is multiplied with first, 2^FW for fixed-point inputs
+    :return: Two int64 arrays with the lower and upper bounds
+    """
+    in_range = np.asarray(in_range, dtype=np.float64) * scale
+    low, high = np.floor(in_range.min(axis=1)), np.ceil(in_range.max(axis=1))
+    bits = np.asarray(bits, dtype=np.int64)
+    port_low, port_high = -np.left_shift(1, bits - 1), np.left_shift(1, bits - 1) - 1
+    fits = (low >= port_low) & (high <= port_high)
+
+    return np.where(fits, low, port_low).astype(np.int64), np.where(fits, high, port_high).astype(np.int64)
+
+
 def ftfp(value, int_bits, frac_bits): # float to fixed point representation
     """
     Converts a float to a fixed-point binary representation.
@@ -76,4 +136,105 @@ def fixed_point_to_float_decimal(decimal_value, int_bits, frac_bits):
     scale_factor = 2 ** frac_bits
     float_value = decimal_value / scale_factor
     
-    return float_value
\ No newline at end of file
+    return float_value
+
+def wrap_signed(values, bits):
+    """
+    Reinterpret integers as two's complement numbers of the given width, the way Verilog
+    truncates an expression when it is assigned to a narrower signed net.
+    :param values: Integer array
+    :param bits: Width in bits, scalar or broadcastable against values
+    :return: int64 array of wrapped values
+    """
+    values = np.asarray(values, dtype=np.int64)
+    modulus = np.left_shift(np.int64(1), np.asarray(bits, dtype=np.int64))
+    wrapped = values & (modulus - 1)
+    return np.where(wrapped >= modulus >> 1, wrapped - modulus, wrapped)
+
+
+def wrap_unsigned(values, bits):
+    """
+    Keep the lowest bits of integers, the way Verilog assigns to an unsigned net
+    :param values: Integer array
+    :param bits: Width in bits, scalar or broadcastable against values
+    :return: int64 array of wrapped values
+    """
+    values = np.asarray(values, dtype=np.int64)
+    return values & (np.left_shift(np.int64(1), np.asarray(bits, dtype=np.int64)) - 1)
+
+
+def integral(values):
+    """
+    :param values: Array of weights
+    :return: The values as int64 if they are all integers, such as the weights of a quantized
+        model held in a float tensor, otherwise a copy of the values
+    """
+    values = np.array(values)
+    if values.dtype.kind == 'f' and np.all(np.isfinite(values)) and np.all(values == np.round(values)):
+        return values.astype(np.int64)
+    return values
+
+
+def to_fixed(values, frac_bits):
+    """
+    Vectorized counterpart of ftfp: scale floats by 2^frac_bits and truncate towards zero
+    :param values: Float array
+    :param frac_bits: Number of fractional bits
+    :return: int64 array of fixed-point integers
+    """
+    return np.trunc(np.asarray(values, dtype=np.float64) * (2 ** frac_bits)).astype(np.int64)
+
+
+def from_fixed(values, frac_bits):
+    """
+    Vectorized counterpart of fixed_point_to_float_decimal for already sign-extended integers
+    :param values: Integer array
+    :param frac_bits: Number of fractional bits
+    :return: float64 array
+    """
+    return np.asarray(values, dtype=np.int64) / (2 ** frac_bits)
+
+
+def write_hex(path: str, values, bits, chunk_size: int = 1 << 20) -> int:
+    """
+    Write integers as fixed-width hexadecimal lines readable by $readmemh, without formatting
+    each number in Python
+    :param path: Output file
+    :param values: Integer array, written in row-major order, one value per line
+    :param bits: Width in bits, scalar or broadcastable against values; negative values are written in two's complement
+    :param chunk_size: Number of values converted at once, bounds the temporary memory
+    :return: Number of hex digits per line
+    """
+    values = wrap_unsigned(values, np.broadcast_to(bits, np.shape(values))).ravel()
+    digits = max(1, (int(np.max(bits)) + 3) // 4)
+    shifts = np.arange(digits - 1, -1, -1, dtype=np.int64) * 4
+    alphabet = np.frombuffer(b'0123456789abcdef\n', dtype=np.uint8)
+
+    with open(path, 'wb') as f:
+        for start in range(0, len(values), chunk_size):
+            nibbles = (values[start:start + chunk_size, None] >> shifts) & 0xF
+            newline = np.full((len(nibbles), 1), 16)
+            f.write(alphabet[np.concatenate([nibbles, newline], axis=1)].tobytes())
+
+    return digits
+
+
+def read_hex(path: str):
+    """
+    Read a file written by write_hex back into integers
+    :param path: Input file
+    :return: Flat int64 array of the unsigned values
+    """
+    data = np.fromfile(path, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    digits = int(np.argmax(data == ord('\n')))
+    table = np.zeros(256, dtype=np.int64)
+    table[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+    table[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+    nibbles = table[data.reshape(-1, digits + 1)[:, :digits]]
+    shifts = np.arange(digits - 1, -1, -1, dtype=np.int64) * 4
+
+    return np.bitwise_or.reduce(nibbles << shifts, axis=1)
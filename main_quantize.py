@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+from torch import nn
+from main_transpile import generate_verilog
+from model.model import Model
+from model.quantize import quantize, quantization_report
+import sys
+
+BITS = 8
+
+
+def make_float_model(data: np.ndarray, labels: np.ndarray):
+    """
+    Train a small float classifier, standing in for a trained model
+    :param data: Training inputs of shape (N, 16)
+    :param labels: Class of every input
+    :return: Trained nn.Sequential
+    """
+    torch.manual_seed(0)
+    float_model = nn.Sequential(
+        nn.Linear(16, 32),
+        nn.ReLU(),
+        nn.Unflatten(1, (4, 8)),   # 4 channels of 8 samples
+        nn.Conv1d(4, 6, 3, padding=1),
+        nn.ReLU(),
+        nn.Flatten(1),
+        nn.Linear(48, 4),
+    )
+    optimizer = torch.optim.Adam(float_model.parameters(), lr=1e-2)
+    for _ in range(300):
+        optimizer.zero_grad()
+        loss = nn.functional.cross_entropy(float_model(torch.tensor(data)), torch.tensor(labels))
+        loss.backward()
+        optimizer.step()
+
+    return float_model.eval()
+
+
+def make_dataset(num_samples: int):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(num_samples, 16)).astype(np.float32)
+    labels = (data[:, :4].sum(axis=1) > 0).astype(np.int64) + 2 * (data[:, 4:8].sum(axis=1) > 0)
+    return data, labels
+
+
+if __name__ == '__main__':
+    data, labels = make_dataset(3000)
+    float_model = make_float_model(data[:2000], labels[:2000])
+    print(quantization_report(float_model, data[:2000], data[2000:], labels=labels[2000:]))
+
+    quantized = quantize(float_model, data[:2000], BITS, BITS)
+    model = Model(quantized.model)
+    model.forward_range(quantized.input_ranges())
+    generate_verilog(model, int(sys.argv[1]) if len(sys.argv) > 1 else None)
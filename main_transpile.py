@@ -1,10 +1,17 @@
 import torch
 from torch import nn
 from model.model import Model
+from model.cache import TranspileCache
 import random
+import sys
 
+STIMULUS_FILE = 'output_files/stimulus.mem'
+BATCH_OUTPUT_FILE = 'output_files/batch_values.txt'
+# transpiled designs by their weights and options, so the test scripts do not transpile again
+CACHE = TranspileCache()
 
-def make_model():
+
+def make_model(pipeline: bool = False, stages: int = 1, cache: TranspileCache = CACHE):
     simple_model = nn.Sequential(
         nn.Linear(5, 5),
         nn.Unflatten(1, (1, 5)),   # Add a channel dimension: (batch_size, 1, 5)
@@ -39,21 +46,35 @@ def make_model():
         except Exception as e:
             raise RuntimeError("Error when defining your PyTorch model: " + str(e))
     
-    model = Model(simple_model)
-    model.forward_range([[-100.0, 100.0] for _ in range(simple_model[0].in_features)])
+    ranges = [[-100.0, 100.0] for _ in range(simple_model[0].in_features)]
+    if cache is not None:
+        return cache.model(simple_model, ranges=ranges, pipeline=pipeline, stages=stages)
+
+    model = Model(simple_model, pipeline=pipeline, stages=stages)
+    model.forward_range(ranges)
     
 
     return model
 
-def generate_verilog(model: Model):
-    code = model.emit()
+def generate_verilog(model: Model, num_vectors: int = None, cache: TranspileCache = CACHE):
+    # stream the design to the file instead of building it in memory, or copy it from the cache
     with open('output_files/test.v', 'w') as f:
-        f.write(code)
+        if cache is not None:
+            cache.emit_to(model, f)
+        else:
+            model.emit_to(f)
+
+    if num_vectors is None:
+        with open('output_files/test_tb.v', 'w') as f:
+            f.write(model.emit_test_bench())
+        return
 
+    # batched mode: all vectors are read from a memory file by a single simulation run
+    model.write_stimulus(model.random_test_batch(num_vectors), STIMULUS_FILE)
     with open('output_files/test_tb.v', 'w') as f:
-        f.write(model.emit_test_bench())
+        f.write(model.emit_batch_test_bench(num_vectors, STIMULUS_FILE, BATCH_OUTPUT_FILE))
 
 
 if __name__ == '__main__':
     model = make_model()
-    generate_verilog(model)
+    generate_verilog(model, int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -0,0 +1,224 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+from torch import nn
+
+from layers.emitter import Emitter
+from model.model import Model
+
+DEFAULT_CACHE_DIR = '.transpile_cache'
+
+
+@lru_cache(maxsize=None)
+def transpiler_digest() -> str:
+    """
+    :return: Hash of the source of the layers and model packages, so a change to the transpiler
+        never serves designs it emitted before the change
+    """
+    digest = hashlib.sha256()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for path in sorted(glob.glob(os.path.join(root, 'layers', '*.py')) + glob.glob(os.path.join(root, 'model', '*.py'))):
+        digest.update(os.path.relpath(path, root).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def update_array(digest, values):
+    """
+    Add the dtype, shape and contents of an array to a hash
+    """
+    values = np.ascontiguousarray(values)
+    digest.update(f'{values.dtype.str}{values.shape}'.encode())
+    digest.update(values.tobytes())
+
+
+def model_key(torch_model: nn.Module, model_class: type, ranges=None, data=None, **options) -> str:
+    """
+    Content address of a transpiled design: it only changes when the design could
+    :param torch_model: PyTorch model to transpile
+    :param model_class: Model or the fixed-point Model of model_frac
+    :param ranges: Input ranges passed to forward_range
+    :param data: Representative inputs passed to forward_range instead of ranges
+    :param options: Keyword arguments of the model constructor and of TranspileCache.model
+    :return: Hex digest of the weights, biases and other arrays of every module, the structure of
+        the model, the input ranges, the options and the transpiler
+    """
+    digest = hashlib.sha256()
+    digest.update(transpiler_digest().encode())
+    digest.update(f'{model_class.__module__}.{model_class.__qualname__}'.encode())
+    digest.update(repr(torch_model).encode())
+    for name, tensor in torch_model.state_dict().items():
+        digest.update(name.encode())
+        update_array(digest, tensor.detach().cpu().numpy())
+    # constants that are not parameters, such as the multipliers of Requantize
+    for name, module in torch_model.named_modules():
+        for attribute, value in sorted(vars(module).items()):
+            if isinstance(value, (np.ndarray, int, float)):
+                digest.update(f'{name}.{attribute}'.encode())
+                update_array(digest, value)
+    for values in (ranges, data):
+        digest.update(b'-' if values is None else b'+')
+        if values is not None:
+            update_array(digest, np.asarray(values, dtype=np.float64))
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class TranspileCache:
+    """
+    On-disk cache of transpiled designs, keyed by model_key. Every entry is a directory holding the
+    sized model and the Verilog emit() produced for it, so a hit costs neither parse_layers,
+    forward_range nor the emission. Entries are written to a temporary directory and renamed into
+    place, so several processes can share one cache. When the cache grows beyond max_bytes, the
+    entries used least recently are removed.
+    The models are stored with pickle, only use a cache directory that nobody else can write to.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = 1 << 30):
+        """
+        :param directory: Directory of the cache, created when the first entry is stored
+        :param max_bytes: Largest total size of the entries
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        # the entry every model returned by model() was loaded from or stored to
+        self.keys = weakref.WeakKeyDictionary()
+
+    def entry(self, key: str) -> str:
+        """
+        :return: Directory of the entry of key
+        """
+        return os.path.join(self.directory, key)
+
+    def model(self, torch_model: nn.Module, model_class: type = Model, ranges: List[List[float]] = None, data=None,
+              formats: dict = None, **options) -> Emitter:
+        """
+        Transpile a PyTorch model and size it with forward_range, or load the result from the cache
+        :param torch_model: PyTorch model to transpile
+        :param model_class: Model or the fixed-point Model of model_frac
+        :param ranges: Lower and upper bound of every input, see forward_range
+        :param data: Representative inputs whose observed ranges are used instead, see forward_range
+        :param formats: Keyword arguments of set_fractional_bits of the fixed-point Model, applied before sizing
+        :param options: Keyword arguments of the model constructor
+        :return: The sized model, whose Verilog emit_to copies from the cache
+        """
+        key = model_key(torch_model, model_class, ranges, data, formats=formats, **options)
+        path = self.entry(key)
+        try:
+            with open(os.path.join(path, 'model.pkl'), 'rb') as f:
+                model = pickle.load(f)
+            # the modification time orders the entries for eviction
+            os.utime(path)
+            self.hits += 1
+        except (OSError, EOFError, pickle.UnpicklingError):
+            model = model_class(torch_model, **options)
+            if formats:
+                model.set_fractional_bits(**formats)
+            model.forward_range(ranges, data)
+            self.store(key, model)
+            self.misses += 1
+
+        self.keys[model] = key
+        return model
+
+    def store(self, key: str, model: Emitter):
+        """
+        Write the sized model and its Verilog to the entry of key, then evict old entries
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.staging_', dir=self.directory)
+        with open(os.path.join(staging, 'model.pkl'), 'wb') as f:
+            pickle.dump(model, f)
+        with open(os.path.join(staging, 'test.v'), 'w') as f:
+            model.emit_to(f)
+        with open(os.path.join(staging, 'layers.json'), 'w') as f:
+            json.dump(layer_metadata(model), f, indent=1)
+        try:
+            os.rename(staging, self.entry(key))
+        except OSError:
+            # another process stored the same design first
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict(keep=key)
+
+    def emit_to(self, model: Emitter, fp):
+        """
+        Write the Verilog of a model returned by model() to an open file, copied from the cache
+        together with the ROM files, or emitted if the entry is gone
+        :param model: Model returned by model()
+        :param fp: File object opened for writing text
+        """
+        key = self.keys.get(model)
+        path = os.path.join(self.entry(key), 'test.v') if key else None
+        if path is None or not os.path.exists(path):
+            model.emit_to(fp)
+            return
+        model.write_roms()
+        with open(path) as f:
+            shutil.copyfileobj(f, fp)
+
+    def size(self) -> int:
+        """
+        :return: Total size of the entries in bytes
+        """
+        return sum(entry_size(path) for path in self.entries())
+
+    def entries(self) -> List[str]:
+        """
+        :return: Paths of the entries, the least recently used first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if not name.startswith('.')]
+        return sorted(paths, key=os.path.getmtime)
+
+    def evict(self, keep: str = None):
+        """
+        Remove the least recently used entries until the cache fits into max_bytes
+        :param keep: Key of an entry that is never removed, such as the one just stored
+        """
+        paths = self.entries()
+        sizes = [entry_size(path) for path in paths]
+        total = sum(sizes)
+        for path, size in zip(paths, sizes):
+            if total <= self.max_bytes:
+                break
+            if os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        for path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def entry_size(path: str) -> int:
+    """
+    :return: Total size of the files of a cache entry in bytes
+    """
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def layer_metadata(model: Emitter) -> List[dict]:
+    """
+    :param model: Sized model
+    :return: Name, shape and port widths of every layer, as stored next to the Verilog of a cache entry
+    """
+    return [{'name': layer.name, 'shape': [int(size) for size in layer.shape],
+             'in_bits': [int(bits) for bits in layer.in_bits], 'out_bits': [int(bits) for bits in layer.out_bits]}
+            for layer in model.layers]
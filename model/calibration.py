@@ -0,0 +1,64 @@
+from typing import Iterable, Iterator, List, Union
+
+import numpy as np
+import torch
+from torch import nn
+
+
+def calibration_batches(data: Union[np.ndarray, torch.Tensor, Iterable], batch_size: int) -> Iterator[torch.Tensor]:
+    """
+    :param data: Array or tensor of shape (num_samples, num_in), or an iterable of batches such as a
+        DataLoader, where a batch is a tensor or array or a tuple whose first element is the inputs
+    :param batch_size: Number of samples per batch when data is a single array or tensor
+    :return: Iterator over the input batches as tensors
+    """
+    if isinstance(data, (np.ndarray, torch.Tensor)):
+        for start in range(0, len(data), batch_size):
+            yield torch.as_tensor(data[start:start + batch_size])
+        return
+
+    for batch in data:
+        if isinstance(batch, (tuple, list)):
+            batch = batch[0]
+        yield torch.as_tensor(batch)
+
+
+def observe_ranges(model: nn.Sequential, data, percentile: float = 100.0, batch_size: int = 1024) -> List[np.ndarray]:
+    """
+    Run the torch model over a calibration set batch by batch and record the range of every input and
+    of every neuron after each layer. Flatten and Unflatten only reshape, so they are skipped like in
+    Model.parse_layers and the outputs line up with Model.layers.
+    With a percentile below 100, the lower and upper percentiles are computed per batch and the most
+    extreme values over all batches are kept, so the memory needed does not grow with the data.
+    :param model: Torch model
+    :param data: Calibration inputs, see calibration_batches
+    :param percentile: Upper percentile taken as the maximum, 100 - percentile is taken as the minimum
+    :param batch_size: Number of samples per batch when data is a single array or tensor
+    :return: Array of shape (num_in, 2) with the input ranges, followed by one array of shape
+        (num_neurons, 2) per layer
+    """
+    dtype = next(model.parameters()).dtype
+    ranges = None
+
+    model.eval()
+    with torch.no_grad():
+        for batch in calibration_batches(data, batch_size):
+            values = batch.to(dtype)
+            observed = [values]
+            for module in model:
+                values = module(values)
+                if not isinstance(module, (nn.Flatten, nn.Unflatten)):
+                    observed.append(values)
+
+            bounds = [np.percentile(value.reshape(len(value), -1).double().numpy(), [100 - percentile, percentile], axis=0).T
+                      for value in observed]
+            if ranges is None:
+                ranges = bounds
+            else:
+                ranges = [np.stack([np.minimum(old[:, 0], new[:, 0]), np.maximum(old[:, 1], new[:, 1])], axis=1)
+                          for old, new in zip(ranges, bounds)]
+
+    if ranges is None:
+        raise ValueError('Calibration data is empty')
+
+    return ranges
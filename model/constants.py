@@ -81,14 +81,162 @@ module tb_top;
 endmodule
 """
 
+test_bench_batch_template = r"""`timescale 1ns / 1ps
+
+module tb_top;
+    {in_definitions}
+    {out_definitions}
+    reg [{word_bits} - 1:0] stimulus [0:{num_words} - 1];
+    integer file;
+    integer vector;
+
+    top dut(
+        {in_params},
+        {out_params}
+    );
+
+    initial begin
+        // Load every input vector, one input per line
+        $readmemh("{stimulus_file}", stimulus);
+        file = $fopen("{output_file}", "w");
+
+        for (vector = 0; vector < {num_vectors}; vector = vector + 1) begin
+{assignments}
+
+            // Let the combinational network settle
+            #10;
+
+            $fwrite(file, {file_out_str});
+            $fwrite(file, "\n");
+        end
+
+        $fclose(file);
+        $finish;
+    end
+endmodule
+"""
+
+test_bench_pipeline_template = r"""`timescale 1ns / 1ps
+
+module tb_top;
+    reg clk;
+    reg rst;
+    reg in_valid;
+    wire out_valid;
+    {in_definitions}
+    {out_definitions}
+    integer file;
+
+    top dut(
+        clk, rst, in_valid,
+        {in_params},
+        {out_params},
+        out_valid
+    );
+
+    always #5 clk = ~clk;
+
+    initial begin
+        // Open a file for writing test data
+        file = $fopen("output_files/test_values.txt", "w");
+
+        $dumpfile("output_files/tb_top.vcd");
+        $dumpvars(0, tb_top);
+
+        clk = 0;
+        rst = 1;
+        in_valid = 0;
+        @(negedge clk);
+        rst = 0;
+
+{assignments}
+        in_valid = 1;
+        @(negedge clk);
+        in_valid = 0;
+
+        // Wait until the vector has gone through every register stage
+        repeat ({latency} - 1) @(negedge clk);
+
+        // Display the values
+        $fwrite(file, {file_in_str});
+        $fwrite(file, "\n");
+        $display("out0: %0d, valid: %0d", out0, out_valid);
+
+        $fwrite(file, {file_out_str});
+
+        $fclose(file);
+        $finish;
+    end
+endmodule
+"""
+
+test_bench_batch_pipeline_template = r"""`timescale 1ns / 1ps
+
+module tb_top;
+    reg clk;
+    reg rst;
+    reg in_valid;
+    wire out_valid;
+    {in_definitions}
+    {out_definitions}
+    reg [{word_bits} - 1:0] stimulus [0:{num_words} - 1];
+    integer file;
+    integer vector;
+
+    top dut(
+        clk, rst, in_valid,
+        {in_params},
+        {out_params},
+        out_valid
+    );
+
+    always #5 clk = ~clk;
+
+    // Write every result in the cycle it leaves the pipeline
+    always @(posedge clk) begin
+        if (out_valid) begin
+            $fwrite(file, {file_out_str});
+            $fwrite(file, "\n");
+        end
+    end
+
+    initial begin
+        // Load every input vector, one input per line
+        $readmemh("{stimulus_file}", stimulus);
+        file = $fopen("{output_file}", "w");
+
+        clk = 0;
+        rst = 1;
+        in_valid = 0;
+        @(negedge clk);
+        rst = 0;
+
+        // Issue one vector every {interval} clock cycles
+        for (vector = 0; vector < {num_vectors}; vector = vector + 1) begin
+{assignments}
+            in_valid = 1;
+            @(negedge clk);
+            in_valid = 0;
+            repeat ({interval} - 1) @(negedge clk);
+        end
+        in_valid = 0;
+
+        // Drain the pipeline
+        repeat ({latency}) @(negedge clk);
+
+        $fclose(file);
+        $finish;
+    end
+endmodule
+"""
 
 
 multiplier_module = r"""
-module multiplier_module #(parameter IW = 4, FW = 4) (input signed [IW + FW - 1:0] in1, input signed [IW + FW - 1:0] in2, output signed [IW + FW - 1:0] out);
+module multiplier_module #(parameter IW = 4, FW = 4, SHIFT = FW) (input signed [IW + FW - 1:0] in1, input signed [IW + FW - 1:0] in2, output signed [IW + FW - 1:0] out);
     wire signed [2*(IW + FW) - 1:0] product_full; // Full product width before scaling
 
     assign product_full = in1 * in2; // Multiply inputs
-    assign out = product_full[2*IW + FW - 1:FW]; // Scale down by 16 (Q4.4 format)
+    assign out = product_full[IW + FW + SHIFT - 1:SHIFT]; // Drop the SHIFT extra fractional bits of the product
 endmodule
 """
 
@@ -97,3 +245,83 @@ module adder_module #(parameter IW = 4, FW = 4) (input signed [IW + FW - 1:0] in
     assign out = in1 + in2; // Direct addition for Q4.4
 endmodule
 """
+
+test_bench_stream_template = r"""`timescale 1ns / 1ps
+
+module tb_axis;
+    reg clk;
+    reg rst;
+    reg [{bus_width} - 1:0] s_axis_tdata;
+    reg s_axis_tvalid;
+    wire s_axis_tready;
+    wire [{bus_width} - 1:0] m_axis_tdata;
+    wire m_axis_tvalid;
+    reg m_axis_tready;
+    wire m_axis_tlast;
+    reg [{bus_width} - 1:0] stimulus [0:{num_in_words} - 1];
+    integer file;
+    integer sent;
+    integer received;
+    integer cycle;
+    integer first_cycle;
+    integer last_cycle;
+    integer seed;
+
+    axis_top dut(
+        clk, rst,
+        s_axis_tdata, s_axis_tvalid, s_axis_tready,
+        m_axis_tdata, m_axis_tvalid, m_axis_tready, m_axis_tlast
+    );
+
+    always #5 clk = ~clk;
+
+    // Count the cycles and the transfers on both interfaces, and write every output transfer
+    always @(posedge clk) begin
+        if (!rst) begin
+            cycle <= cycle + 1;
+            if (s_axis_tvalid && s_axis_tready) begin
+                if (sent == 0)
+                    first_cycle <= cycle;
+                sent <= sent + 1;
+            end
+            if (m_axis_tvalid && m_axis_tready) begin
+                $fwrite(file, "%h\n", m_axis_tdata);
+                last_cycle <= cycle;
+                received <= received + 1;
+            end
+        end
+    end
+
+    // Offer the next input transfer whenever there is one left, and stall the output
+    // {stall} percent of the cycles
+    always @(negedge clk) begin
+        s_axis_tvalid = !rst && sent < {num_in_words};
+        s_axis_tdata = stimulus[sent];
+        m_axis_tready = !rst && ($unsigned($random(seed)) % 100) >= {stall};
+    end
+
+    initial begin
+        // Load every input transfer, one per line
+        $readmemh("{stimulus_file}", stimulus);
+        file = $fopen("{output_file}", "w");
+
+        clk = 0;
+        rst = 1;
+        sent = 0;
+        received = 0;
+        cycle = 0;
+        seed = {seed};
+        @(negedge clk);
+        @(negedge clk);
+        rst = 0;
+
+        wait (received == {num_out_words});
+        @(negedge clk);
+
+        $display("%0d vectors in %0d cycles", {num_vectors}, last_cycle - first_cycle + 1);
+        $fwrite(file, "// cycles %0d\n", last_cycle - first_cycle + 1);
+        $fclose(file);
+        $finish;
+    end
+endmodule
+"""
@@ -1,18 +1,63 @@
-from typing import List
+from typing import Dict, List, Union
 
 import numpy as np
 import torch
 from torch import nn
+import os
 import random
 import layers
-from model.constants import test_bench_template
-from layers.utils import ftfp
+from model.constants import test_bench_template, test_bench_batch_template, test_bench_pipeline_template, \
+    test_bench_batch_pipeline_template, test_bench_stream_template
+from layers.emitter import Emitter
+from layers.intervals import data_range
+from model.calibration import observe_ranges
+from model.parallel import emit_layers
+from model.stream import emit_axis_top, pack_stream, read_stream, stream_words, unpack_stream, write_stream
+from layers.utils import ftfp, wrap_signed, wrap_unsigned, write_hex, read_hex
 
 
-class Model:
-    def __init__(self, model: nn.Sequential):
+def layer_latency(layer):
+    """
+    :return: Clock cycles the layer itself takes, 0 for combinational layers
+    """
+    return layer.latency() if hasattr(layer, 'latency') else 0
+
+
+class Model(Emitter):
+    def __init__(self, model: nn.Sequential, pipeline: bool = False, stages: int = 1, reduction: str = 'chain',
+                 parallelism: Union[int, Dict[int, int]] = None, rom_dir: str = None, streaming: bool = False,
+                 bus_width: int = None, shift_add: bool = False):
+        """
+        :param model: PyTorch model to transpile
+        :param pipeline: Register the output of every layer and give top clk, rst and valid ports
+        :param stages: Number of register stages the dot products of Linear and Conv1D layers are
+            split into when pipelining
+        :param reduction: How Linear and Conv1D layers sum their products, 'chain' for a linear
+            accumulation or 'tree' for a balanced adder tree of logarithmic depth
+        :param parallelism: Fold Linear layers onto this many MAC units each, or a dictionary from
+            layer index to the number of MAC units for the layers that should be folded. Needs pipeline.
+        :param rom_dir: Write the weights and biases to $readmemh files in this directory instead of
+            inlining them as literals. The emitted paths are relative to where the simulator is run.
+        :param streaming: Emit Conv1D layers as line buffers that consume one position per clock cycle
+            and reuse one set of MACs for every output position. Needs pipeline.
+        :param bus_width: Also emit axis_top, which wraps top in valid/ready stream interfaces that
+            carry the inputs and outputs in transfers of this many bits
+        :param shift_add: Build the constant multiplications of Linear and Conv1D layers from shifts
+            and adds of their canonical signed digits, sharing common subexpressions between the
+            outputs of a layer. Folded layers keep their MAC units.
+        """
+        if reduction not in ('chain', 'tree'):
+            raise ValueError(f'Unknown reduction {reduction}')
+        if parallelism and not pipeline:
+            raise ValueError('Folded layers are clocked, use pipeline=True')
+        if streaming and not pipeline:
+            raise ValueError('Streaming convolutions are clocked, use pipeline=True')
+        if shift_add and rom_dir:
+            raise ValueError('Shift-add multiplication needs the weights as constants, not in ROMs')
+
         self.model = model
         self.layers = []
+        self.pipeline = pipeline
         # make seed random
         self.seed = 50
         self.FW = 12
@@ -20,45 +65,173 @@ class Model:
         # first layer is always linear
         self.num_in = layers.Linear.layer_from(self.model[0], 0).shape[0]
         self.parse_layers()
+        for i, layer in enumerate(self.layers):
+            if isinstance(layer, (layers.Linear, layers.Conv1D)):
+                layer.reduction = reduction
+                layer.shift_add = shift_add
+                if self.pipeline:
+                    layer.stages = stages
+            if isinstance(layer, layers.Conv1D):
+                layer.streaming = streaming
+            if isinstance(layer, layers.Linear) and parallelism:
+                layer.parallelism = parallelism.get(i, 0) if isinstance(parallelism, dict) else parallelism
+        self.rom_dir = rom_dir
+        self.set_rom_prefixes()
+        self.bus_width = bus_width
         self.num_out = self.layers[-1].shape[-1]
         self.random_test_inputs = [random.random() for _ in range(self.num_in)]
         self.random_int_test_inputs = [random.randint(0, 5) for _ in range(self.num_in)]
 
     def __str__(self):
         return '\n'.join(str(layer) for layer in self.layers)
-    
-    def get_out_features(self, layer):
-        try:
-            return layer.out_features
-        except:
-            return 1
 
+    def set_rom_prefixes(self):
+        """
+        Point every layer with constants at its files in rom_dir, named after the layer
+        """
+        for layer in self.layers:
+            if hasattr(layer, 'rom_prefix'):
+                layer.rom_prefix = os.path.join(self.rom_dir, layer.name) if self.rom_dir else None
+
+    def write_roms(self):
+        """
+        Write the ROM files of every layer to rom_dir, nothing is written when the constants are inlined
+        """
+        if not self.rom_dir:
+            return
+        os.makedirs(self.rom_dir, exist_ok=True)
+        for layer in self.layers:
+            if getattr(layer, 'rom_prefix', None):
+                layer.write_roms()
+    
     def parse_layers(self):
         i=0
         for layer in self.model:
             if isinstance(layer, nn.Linear):
                 self.layers.append(layers.Linear.layer_from(layer, i))
             elif isinstance(layer, nn.ReLU):
-                self.layers.append(layers.ReLU(self.get_out_features(self.model[i - 1]), i))
+                self.layers.append(layers.ReLU(self.layers[-1].shape[-1], i))
             elif isinstance(layer, nn.MaxPool1d):
-                self.layers.append(layers.MaxPool(self.get_out_features(self.model[i - 1]), i, pool_size=layer.kernel_size))
+                self.layers.append(layers.MaxPool(self.layers[-1].shape[-1], i, pool_size=layer.kernel_size))
             elif isinstance(layer, nn.Conv1d):
-                num_inputs = self.get_out_features(self.layers[i - 1])
+                num_inputs = self.layers[-1].shape[-1]
                 self.layers.append(layers.Conv1D.layer_from(layer, i, num_inputs))
+            elif isinstance(layer, layers.Requantize):
+                self.layers.append(layers.Requant.layer_from(layer, i, self.layers[-1].shape[-1]))
             elif isinstance(layer, nn.Sigmoid):
-                self.layers.append(layers.Sigmoid(self.get_out_features(self.model[i - 1]), i))
+                self.layers.append(layers.Sigmoid(self.layers[-1].shape[-1], i))
             elif isinstance(layer, nn.Unflatten) or isinstance(layer, nn.Flatten):
                 i = i - 1
             else:
                 raise ValueError(f'Unknown layer type {layer}')
             i += 1
 
-    def forward_range(self, ranges: List[List[float]]):
-        start = np.array(ranges)
+    def forward_range(self, ranges: List[List[float]] = None, data=None):
+        """
+        Propagate the input ranges through every layer with interval arithmetic and size every wire
+        :param ranges: Lower and upper bound of every input
+        :param data: Representative inputs of shape (num_samples, num_in) whose observed minima and
+            maxima are used as the input ranges instead
+        """
+        if (ranges is None) == (data is None):
+            raise ValueError('Pass either ranges or data')
+        start = np.array(ranges, dtype=np.float64) if ranges is not None else data_range(data)
 
         for layer in self.layers:
             start = layer.forward_range(start)
 
+    def calibrate(self, data, percentile: float = 100.0, batch_size: int = 1024):
+        """
+        Size every wire from the ranges observed when running the torch model over a calibration
+        set, instead of the worst case of forward_range. The design only computes correct results
+        for inputs like the calibration set: values outside the observed ranges wrap around.
+        :param data: Inputs of shape (num_samples, num_in) as an array or tensor, or an iterable of
+            batches such as a DataLoader, which is streamed and never held in memory at once
+        :param percentile: Size every wire for this upper percentile of its values and 100 - percentile
+            as lower one, 100 to cover every observed value
+        :param batch_size: Number of samples per batch when data is a single array or tensor
+        :return: Array of shape (num_in, 2) with the observed input ranges, followed by one array per
+            layer with the observed range of every output
+        """
+        observed = observe_ranges(self.model, data, percentile, batch_size)
+        if len(observed) != len(self.layers) + 1:
+            raise ValueError(f'Expected outputs of {len(self.layers)} layers, observed {len(observed) - 1}')
+
+        start = observed[0]
+        for layer, out_range in zip(self.layers, observed[1:]):
+            start = layer.forward_range(start, out_range)
+
+        return observed
+
+    def bits_saved(self):
+        """
+        :return: For every layer name, the bits saved on every output wire by sizing it from the
+            propagated ranges instead of by word growth, 0 for layers without a dot product
+        """
+        return {layer.name: layer.growth_bits() - layer.out_bits if hasattr(layer, 'growth_bits')
+                else np.zeros_like(layer.out_bits) for layer in self.layers}
+
+    def bits_report(self):
+        """
+        Summarize the output wire widths of every layer against word growth sizing
+        :return: Printable table
+        """
+        saved = self.bits_saved()
+        lines = [f"{'layer':<32}{'wires':>7}{'bits':>8}{'growth':>8}{'saved':>8}{'max saved':>11}"]
+        for layer in self.layers:
+            bits = int(np.sum(layer.out_bits))
+            lines.append(f"{layer.name:<32}{len(layer.out_bits):>7}{bits:>8}{bits + int(saved[layer.name].sum()):>8}"
+                         f"{int(saved[layer.name].sum()):>8}{int(saved[layer.name].max()):>11}")
+        total = sum(int(layer_saved.sum()) for layer_saved in saved.values())
+        lines.append(f"total {sum(int(np.sum(layer.out_bits)) for layer in self.layers)} wire bits, {total} saved")
+        return '\n'.join(lines)
+
+    def latency(self):
+        """
+        Number of clock cycles between a vector entering top and its result leaving it.
+        Layers without register stages of their own are registered once in top.
+        :return: Latency in cycles, 0 for the combinational design
+        """
+        if not self.pipeline:
+            return 0
+        return sum(max(layer_latency(layer), 1) for layer in self.layers)
+
+    def interval(self):
+        """
+        :return: Minimum number of clock cycles between two vectors entering top, set by the slowest folded or streaming layer
+        """
+        return max(layer.interval() if hasattr(layer, 'interval') else 1 for layer in self.layers)
+
+    def report(self):
+        """
+        Summarize the cycles and the estimated resources of every layer
+        :return: Printable table
+        """
+        lines = [f"{'layer':<32}{'latency':>8}{'interval':>9}{'mults':>8}{'adders':>8}{'reg bits':>10}{'rom bits':>10}"]
+        for layer in self.layers:
+            usage = layer.resources() if hasattr(layer, 'resources') else {}
+            lines.append(f"{layer.name:<32}{layer_latency(layer):>8}"
+                         f"{layer.interval() if hasattr(layer, 'interval') else 1:>9}"
+                         + ''.join(f"{usage.get(key, '-'):>{width}}" for key, width in
+                                   (('multipliers', 8), ('adders', 8), ('register_bits', 10), ('rom_bits', 10))))
+        lines.append(f"total latency {self.latency()} cycles, one vector every {self.interval()} cycles")
+        return '\n'.join(lines)
+
+    def simulate(self, batch):
+        """
+        Bit-accurate NumPy model of the design produced by emit(), chaining every layer's simulate().
+        Layers are connected through the unsigned layer_{i}_out_{j} wires of top, so values are
+        truncated to out_bits between layers exactly like in the simulator.
+        :param batch: Integer array of shape (N, num_in)
+        :return: int64 array of shape (N, num_out) holding the signed values of top's outputs
+        """
+        values = wrap_signed(np.atleast_2d(batch), self.layers[0].in_bits)
+
+        for layer in self.layers:
+            values = wrap_unsigned(layer.simulate(values), layer.out_bits)
+
+        return wrap_signed(values, self.layers[-1].out_bits)
+
     def get_vars(self, test_bench=False):
         in_params = [f"in{i}" for i in range(self.layers[0].shape[0])]
         out_params = [f"out{i}" for i in range(self.layers[-1].shape[-1])]
@@ -84,37 +257,105 @@ class Model:
         return in_params, out_params, in_definitions, out_definitions
 
 
-    def emit(self):
-        out = ["`timescale 1ns / 1ps"]
+    def emit(self, workers: int = None) -> str:
+        """
+        :param workers: Number of processes emitting the layers, see emit_chunks
+        :return: Verilog code
+        """
+        return ''.join(self.emit_chunks(workers))
+
+    def emit_to(self, fp, workers: int = None):
+        """
+        Write the Verilog code to a file chunk by chunk
+        :param fp: Text file object
+        :param workers: Number of processes emitting the layers, see emit_chunks
+        """
+        fp.writelines(self.emit_chunks(workers))
+
+    def emit_chunks(self, workers: int = None):
+        """
+        Emit the modules of all layers followed by top, writing the ROM files first if there are any
+        :param workers: Emit the layers, and blocks of outputs of the wide ones, in a pool of this
+            many processes, see emit_layers. The code is the same as emitted by one process.
+        :return: Iterator over the Verilog code
+        """
+        self.write_roms()
+        yield "`timescale 1ns / 1ps\n"
+        yield from emit_layers(self.layers, workers)
+        yield from self.emit_pipelined_top() if self.pipeline else self.emit_top()
+        if self.bus_width:
+            yield "\n\n"
+            yield from emit_axis_top(self.layers[0].in_bits, self.layers[-1].out_bits, self.bus_width, self.latency(),
+                                     self.interval(), self.pipeline)
+
+    def emit_top(self):
+        """
+        Emit the top module that chains the layers
+        :return: Iterator over the lines of Verilog code
+        """
         in_params, out_params, in_definitions, out_definitions = self.get_vars()
-        top = [
-            f"module top({','.join(in_params)}, {','.join(out_params)});",
-            *in_definitions,
-            *out_definitions,
-        ]
+        yield f"module top({','.join(in_params)}, {','.join(out_params)});\n"
+        yield from (f"{line}\n" for line in in_definitions + out_definitions)
         in_wires = in_params
         out_wires = []
         for i, layer in enumerate(self.layers):
-            out.append(layer.emit())
             out_wires = []
             for j in range(layer.shape[-1]):
-                top.append(f"    wire [{layer.out_bits[j] - 1}:0] layer_{i}_out_{j};")
+                yield f"    wire [{layer.out_bits[j] - 1}:0] layer_{i}_out_{j};\n"
                 out_wires.append(f"layer_{i}_out_{j}")
-            top.append(f"    {layer.name} layer_{i}({','.join(in_wires)}, {','.join(out_wires)});")
+            yield f"    {layer.name} layer_{i}({','.join(in_wires)}, {','.join(out_wires)});\n"
             in_wires = out_wires
-        assigns = [f"    assign out{i} = {out_wire};" for i, out_wire in enumerate(out_wires)]
-        top.extend(assigns)
-        top.append("endmodule")
-        out.append('\n'.join(top))
+        yield from (f"    assign out{i} = {out_wire};\n" for i, out_wire in enumerate(out_wires))
+        yield "endmodule"
 
-        return '\n'.join(out)
+    def emit_pipelined_top(self):
+        """
+        Emit the top module with a register between every pair of layers. Layers with register
+        stages of their own are connected through their valid ports, the others are registered
+        in top together with a valid bit.
+        :return: Iterator over the lines of Verilog code
+        """
+        in_params, out_params, in_definitions, out_definitions = self.get_vars()
+        yield f"module top(clk, rst, in_valid, {','.join(in_params)}, {','.join(out_params)}, out_valid);\n"
+        yield "    input clk;\n"
+        yield "    input rst;\n"
+        yield "    input in_valid;\n"
+        yield "    output out_valid;\n"
+        yield from (f"{line}\n" for line in in_definitions + out_definitions)
+        in_wires = in_params
+        in_valid = "in_valid"
+        out_wires = []
+        for i, layer in enumerate(self.layers):
+            out_wires = [f"layer_{i}_out_{j}" for j in range(layer.shape[-1])]
+            if layer_latency(layer):
+                yield from (f"    wire [{layer.out_bits[j] - 1}:0] {wire};\n" for j, wire in enumerate(out_wires))
+                yield f"    wire layer_{i}_valid;\n"
+                yield (f"    {layer.name} layer_{i}(clk, rst, {in_valid}, {','.join(in_wires)}, "
+                       f"{','.join(out_wires)}, layer_{i}_valid);\n")
+            else:
+                comb_wires = [f"layer_{i}_comb_{j}" for j in range(layer.shape[-1])]
+                yield from (f"    wire [{layer.out_bits[j] - 1}:0] {wire};\n" for j, wire in enumerate(comb_wires))
+                yield from (f"    reg [{layer.out_bits[j] - 1}:0] {wire};\n" for j, wire in enumerate(out_wires))
+                yield f"    reg layer_{i}_valid;\n"
+                yield f"    {layer.name} layer_{i}({','.join(in_wires)}, {','.join(comb_wires)});\n"
+                yield "    always @(posedge clk)\n"
+                yield "    begin\n"
+                yield from (f"        {out_wire} <= {comb_wire};\n" for out_wire, comb_wire in zip(out_wires, comb_wires))
+                yield f"        layer_{i}_valid <= rst ? 1'b0 : {in_valid};\n"
+                yield "    end\n"
+            in_wires = out_wires
+            in_valid = f"layer_{i}_valid"
+        yield from (f"    assign out{i} = {out_wire};\n" for i, out_wire in enumerate(out_wires))
+        yield f"    assign out_valid = {in_valid};\n"
+        yield "endmodule"
 
     def emit_test_bench(self):
         in_params, out_params, in_definitions, out_definitions, file_in_str, file_out_str = self.get_vars(test_bench=True)
         # int_bits =  self.layers[0].integer_bits
         assigns = [f"        assign {in_params[i]} = {self.random_int_test_inputs[i]};" for i in range(len(in_params))]
 
-        return test_bench_template.format(
+        return (test_bench_pipeline_template if self.pipeline else test_bench_template).format(
+            latency=self.latency(),
             in_params=', '.join(in_params),
             out_params=', '.join(out_params),
             in_definitions='\n    '.join(in_definitions),
@@ -123,3 +364,103 @@ class Model:
             file_in_str=file_in_str,
             file_out_str=file_out_str,
         )
+
+    def random_test_batch(self, num_vectors: int):
+        """
+        Random test vectors drawn like random_int_test_inputs
+        :param num_vectors: Number of vectors
+        :return: int64 array of shape (num_vectors, num_in)
+        """
+        rng = np.random.default_rng(self.seed)
+        return rng.integers(0, 6, size=(num_vectors, self.num_in))
+
+    def write_stimulus(self, batch, path: str):
+        """
+        Write test vectors as a $readmemh file for emit_batch_test_bench, one input per line
+        :param batch: Integer array of shape (N, num_in)
+        :param path: Output file
+        """
+        write_hex(path, np.atleast_2d(batch), self.layers[0].in_bits)
+
+    def read_stimulus(self, path: str):
+        """
+        Read a file written by write_stimulus back, sign-extended to the input widths
+        :param path: Input file
+        :return: int64 array of shape (N, num_in)
+        """
+        return wrap_signed(read_hex(path).reshape(-1, self.num_in), self.layers[0].in_bits)
+
+    def emit_batch_test_bench(self, num_vectors: int, stimulus_file: str, output_file: str):
+        """
+        Emit a test bench that streams num_vectors vectors from stimulus_file through top and
+        writes one line of outputs per vector to output_file
+        :param num_vectors: Number of vectors in stimulus_file
+        :param stimulus_file: File written by write_stimulus
+        :param output_file: File the outputs are written to
+        :return: Verilog code
+        """
+        in_params, out_params, in_definitions, out_definitions, _, file_out_str = self.get_vars(test_bench=True)
+        in_bits = self.layers[0].in_bits
+        assigns = [f"            {in_params[i]} = stimulus[vector * {len(in_params)} + {i}][{in_bits[i] - 1}:0];"
+                   for i in range(len(in_params))]
+
+        return (test_bench_batch_pipeline_template if self.pipeline else test_bench_batch_template).format(
+            latency=self.latency(),
+            interval=self.interval(),
+            in_params=', '.join(in_params),
+            out_params=', '.join(out_params),
+            in_definitions='\n    '.join(in_definitions),
+            out_definitions='\n    '.join(out_definitions),
+            word_bits=max(in_bits),
+            num_words=num_vectors * len(in_params),
+            num_vectors=num_vectors,
+            stimulus_file=stimulus_file,
+            output_file=output_file,
+            assignments='\n'.join(assigns),
+            file_out_str=file_out_str,
+        )
+
+    def write_stream_stimulus(self, batch, path: str):
+        """
+        Write test vectors as a $readmemh file for emit_stream_test_bench, one transfer per line
+        :param batch: Integer array of shape (N, num_in)
+        :param path: Output file
+        """
+        write_stream(path, pack_stream(batch, self.layers[0].in_bits, self.bus_width), self.bus_width)
+
+    def read_stream_output(self, path: str):
+        """
+        Read the results written by the test bench of emit_stream_test_bench
+        :param path: File the test bench wrote
+        :return: int64 array of shape (N, num_out) with the outputs and the achieved throughput in
+            vectors per clock cycle, from the first input transfer to the last output transfer
+        """
+        transfers, cycles = read_stream(path)
+        outputs = unpack_stream(transfers, self.layers[-1].out_bits, self.bus_width)
+        return outputs, len(outputs) / cycles
+
+    def emit_stream_test_bench(self, num_vectors: int, stimulus_file: str, output_file: str, stall: int = 0,
+                               seed: int = 1):
+        """
+        Emit a test bench that pushes num_vectors vectors from stimulus_file through axis_top as fast
+        as it accepts them, writes every output transfer to output_file and measures the clock
+        cycles the stream takes
+        :param num_vectors: Number of vectors in stimulus_file
+        :param stimulus_file: File written by write_stream_stimulus
+        :param output_file: File the output transfers and the cycle count are written to
+        :param stall: Percentage of clock cycles in which m_axis_tready is low, to exercise back pressure
+        :param seed: Seed of the random stalls
+        :return: Verilog code
+        """
+        if not self.bus_width:
+            raise ValueError('The stream interface is only emitted with bus_width')
+        return test_bench_stream_template.format(
+            bus_width=self.bus_width,
+            num_in_words=num_vectors * stream_words(self.layers[0].in_bits, self.bus_width),
+            num_out_words=num_vectors * stream_words(self.layers[-1].out_bits, self.bus_width),
+            num_vectors=num_vectors,
+            stimulus_file=stimulus_file,
+            output_file=output_file,
+            stall=stall,
+            seed=seed,
+        )
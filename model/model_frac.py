@@ -3,14 +3,38 @@ from typing import List
 import numpy as np
 import torch
 from torch import nn
+import os
 import random
 import layers
-from model.constants import test_bench_template, test_bench_template_frac, multiplier_module, adder_module
-from layers.utils import ftfp
+from model.constants import test_bench_template, test_bench_template_frac, test_bench_batch_template, multiplier_module, adder_module, \
+    test_bench_stream_template
+from layers.emitter import Emitter
+from layers.intervals import data_range
+from model.calibration import observe_ranges
+from model.parallel import emit_layers
+from model.stream import emit_axis_top, pack_stream, read_stream, stream_words, unpack_stream, write_stream
+from layers.utils import ftfp, wrap_signed, wrap_unsigned, write_hex, read_hex, to_fixed
 
 
-class Model:
-    def __init__(self, model: nn.Sequential):
+class Model(Emitter):
+    def __init__(self, model: nn.Sequential, reduction: str = 'chain', rom_dir: str = None, bus_width: int = None,
+                 shift_add: bool = False):
+        """
+        :param model: PyTorch model to transpile
+        :param reduction: How LinearFrac and Conv1D layers sum their products, 'chain' for a linear
+            accumulation or 'tree' for a balanced adder tree of logarithmic depth
+        :param rom_dir: Write the weights and biases to $readmemh files in this directory instead of
+            inlining them as literals. The emitted paths are relative to where the simulator is run.
+        :param bus_width: Also emit axis_top, which wraps top in valid/ready stream interfaces that
+            carry the inputs and outputs in transfers of this many bits
+        :param shift_add: Build the constant multiplications of LinearFrac and Conv1D layers from
+            shifts and adds of their canonical signed digits instead of multiplier_module instances,
+            sharing common subexpressions between the outputs of a layer
+        """
+        if reduction not in ('chain', 'tree'):
+            raise ValueError(f'Unknown reduction {reduction}')
+        if shift_add and rom_dir:
+            raise ValueError('Shift-add multiplication needs the weights as constants, not in ROMs')
         self.model = model
         self.layers = []
         # make seed random
@@ -20,44 +44,187 @@ class Model:
         # first layer is always linear
         self.num_in = layers.Linear.layer_from(self.model[0], 0).shape[0]
         self.parse_layers()
+        for layer in self.layers:
+            if isinstance(layer, (layers.LinearFrac, layers.Conv1D)):
+                layer.reduction = reduction
+                layer.shift_add = shift_add
+        self.rom_dir = rom_dir
+        self.set_rom_prefixes()
+        self.bus_width = bus_width
         self.num_out = self.layers[-1].shape[-1]
         self.random_test_inputs = [random.random() for _ in range(self.num_in)]
         self.random_int_test_inputs = [random.randint(0, 5) for _ in range(self.num_in)]
 
     def __str__(self):
         return '\n'.join(str(layer) for layer in self.layers)
-    
-    def get_out_features(self, layer):
-        try:
-            return layer.out_features
-        except:
-            return 1
 
+    def set_rom_prefixes(self):
+        """
+        Point every layer with constants at its files in rom_dir, named after the layer
+        """
+        for layer in self.layers:
+            if hasattr(layer, 'rom_prefix'):
+                layer.rom_prefix = os.path.join(self.rom_dir, layer.name) if self.rom_dir else None
+
+    def write_roms(self):
+        """
+        Write the ROM files of every layer to rom_dir, nothing is written when the constants are inlined
+        """
+        if not self.rom_dir:
+            return
+        os.makedirs(self.rom_dir, exist_ok=True)
+        for layer in self.layers:
+            if getattr(layer, 'rom_prefix', None):
+                layer.write_roms()
+    
     def parse_layers(self):
         i=0
         for layer in self.model:
             if isinstance(layer, nn.Linear):
                 self.layers.append(layers.LinearFrac.layer_from(layer, i, self.FW))
             elif isinstance(layer, nn.ReLU):
-                self.layers.append(layers.ReLU(self.get_out_features(self.model[i - 1]), i))
+                self.layers.append(layers.ReLU(self.layers[-1].shape[-1], i))
             elif isinstance(layer, nn.MaxPool1d):
-                self.layers.append(layers.MaxPool(self.get_out_features(self.model[i - 1]), i, pool_size=layer.kernel_size))
+                self.layers.append(layers.MaxPool(self.layers[-1].shape[-1], i, pool_size=layer.kernel_size))
             elif isinstance(layer, nn.Conv1d):
-                num_inputs = self.get_out_features(self.layers[i - 1])
+                num_inputs = self.layers[-1].shape[-1]
                 self.layers.append(layers.Conv1D.layer_from(layer, i, num_inputs))
             elif isinstance(layer, nn.Sigmoid):
-                self.layers.append(layers.Sigmoid(self.get_out_features(self.model[i - 1]), i))
+                self.layers.append(layers.Sigmoid(self.layers[-1].shape[-1], i))
             elif isinstance(layer, nn.Unflatten) or isinstance(layer, nn.Flatten):
                 i = i - 1
             else:
                 raise ValueError(f'Unknown layer type {layer}')
             i += 1
 
-    def forward_range(self, ranges: List[List[float]]):
-        start = np.array(ranges)
+    def linear_layers(self) -> List[layers.LinearFrac]:
+        """
+        :return: The LinearFrac layers, whose fixed-point formats can be chosen with set_fractional_bits
+        """
+        return [layer for layer in self.layers if isinstance(layer, layers.LinearFrac)]
+
+    def set_fractional_bits(self, fractional_bits: List[int], weight_fractional_bits: List[int] = None,
+                            in_fractional_bits: int = None):
+        """
+        Give every LinearFrac layer its own fixed-point format instead of FW for all of them. The
+        other layers keep the format of their inputs, and every LinearFrac layer reads its inputs in
+        the format of the one before. forward_range has to be run again afterwards.
+        :param fractional_bits: Fractional bits of the outputs of every LinearFrac layer
+        :param weight_fractional_bits: Fractional bits of the weights of every LinearFrac layer, the
+            same as its outputs if None
+        :param in_fractional_bits: Fractional bits of the inputs of top, FW is kept if None
+        """
+        linear = self.linear_layers()
+        weight_fractional_bits = fractional_bits if weight_fractional_bits is None else weight_fractional_bits
+        if len(fractional_bits) != len(linear) or len(weight_fractional_bits) != len(linear):
+            raise ValueError(f'Expected fractional bits for {len(linear)} layers')
+
+        if in_fractional_bits is not None:
+            self.FW = in_fractional_bits
+        current = self.FW
+        for layer, bits, weight_bits in zip(linear, fractional_bits, weight_fractional_bits):
+            layer.set_fractional_bits(bits, weight_bits, current)
+            current = bits
+
+    def output_fractional_bits(self) -> int:
+        """
+        :return: Fractional bits of the outputs of top, those of the last LinearFrac layer
+        """
+        linear = self.linear_layers()
+        return linear[-1].fractional_bits if linear else self.FW
+
+    def forward_range(self, ranges: List[List[float]] = None, data=None):
+        """
+        Propagate the input ranges through every layer with interval arithmetic and size every wire
+        :param ranges: Lower and upper bound of every input
+        :param data: Representative inputs of shape (num_samples, num_in) whose observed minima and
+            maxima are used as the input ranges instead
+        """
+        if (ranges is None) == (data is None):
+            raise ValueError('Pass either ranges or data')
+        start = np.array(ranges, dtype=np.float64) if ranges is not None else data_range(data)
+
+        for layer in self.layers:
+            start = self.layer_range(layer, start)
+
+    def calibrate(self, data, percentile: float = 100.0, batch_size: int = 1024):
+        """
+        Size every wire from the ranges observed when running the torch model over a calibration
+        set, instead of the worst case of forward_range. The design only computes correct results
+        for inputs like the calibration set: values outside the observed ranges wrap around.
+        :param data: Inputs of shape (num_samples, num_in) as an array or tensor, or an iterable of
+            batches such as a DataLoader, which is streamed and never held in memory at once
+        :param percentile: Size every wire for this upper percentile of its values and 100 - percentile
+            as lower one, 100 to cover every observed value
+        :param batch_size: Number of samples per batch when data is a single array or tensor
+        :return: Array of shape (num_in, 2) with the observed input ranges, followed by one array per
+            layer with the observed range of every output
+        """
+        observed = observe_ranges(self.model, data, percentile, batch_size)
+        if len(observed) != len(self.layers) + 1:
+            raise ValueError(f'Expected outputs of {len(self.layers)} layers, observed {len(observed) - 1}')
+
+        start = observed[0]
+        for layer, out_range in zip(self.layers, observed[1:]):
+            start = self.layer_range(layer, start, out_range)
+
+        return observed
+
+    def layer_range(self, layer: Emitter, in_range: np.ndarray, out_range: np.ndarray = None):
+        """
+        Run forward_range of a layer with real-valued ranges. LinearFrac layers know their fixed-point
+        formats, the other layers pass fixed-point values on and are given their ranges in LSBs of
+        the format of the LinearFrac layer before them, or of the inputs of top.
+        :param layer: Layer of this model
+        :param in_range: Real-valued ranges of the inputs of the layer
+        :param out_range: Observed real-valued ranges of its outputs, or None
+        :return: Real-valued ranges of the outputs of the layer
+        """
+        if isinstance(layer, layers.LinearFrac):
+            return layer.forward_range(in_range, out_range)
+
+        before = [other for other in self.layers[:self.layers.index(layer)] if isinstance(other, layers.LinearFrac)]
+        scale = 2 ** (before[-1].fractional_bits if before else self.FW)
+        out_range = None if out_range is None else np.asarray(out_range, dtype=np.float64) * scale
+        return layer.forward_range(np.asarray(in_range, dtype=np.float64) * scale, out_range) / scale
+
+    def bits_saved(self):
+        """
+        :return: For every layer name, the bits saved on every output wire by sizing it from the
+            propagated ranges instead of by word growth, 0 for layers without a dot product
+        """
+        return {layer.name: layer.growth_bits() - layer.out_bits if hasattr(layer, 'growth_bits')
+                else np.zeros_like(layer.out_bits) for layer in self.layers}
+
+    def bits_report(self):
+        """
+        Summarize the output wire widths of every layer against word growth sizing
+        :return: Printable table
+        """
+        saved = self.bits_saved()
+        lines = [f"{'layer':<32}{'wires':>7}{'bits':>8}{'growth':>8}{'saved':>8}{'max saved':>11}"]
+        for layer in self.layers:
+            bits = int(np.sum(layer.out_bits))
+            lines.append(f"{layer.name:<32}{len(layer.out_bits):>7}{bits:>8}{bits + int(saved[layer.name].sum()):>8}"
+                         f"{int(saved[layer.name].sum()):>8}{int(saved[layer.name].max()):>11}")
+        total = sum(int(layer_saved.sum()) for layer_saved in saved.values())
+        lines.append(f"total {sum(int(np.sum(layer.out_bits)) for layer in self.layers)} wire bits, {total} saved")
+        return '\n'.join(lines)
+
+    def simulate(self, batch):
+        """
+        Bit-accurate NumPy model of the design produced by emit(), chaining every layer's simulate().
+        Layers are connected through the unsigned layer_{i}_out_{j} wires of top, so values are
+        truncated to out_bits between layers exactly like in the simulator.
+        :param batch: Fixed-point integer array of shape (N, num_in), see layers.utils.to_fixed
+        :return: int64 array of shape (N, num_out) holding the signed values of top's outputs
+        """
+        values = wrap_signed(np.atleast_2d(batch), self.layers[0].in_bits)
 
         for layer in self.layers:
-            start = layer.forward_range(start)
+            values = wrap_unsigned(layer.simulate(values), layer.out_bits)
+
+        return wrap_signed(values, self.layers[-1].out_bits)
 
     def get_vars(self, test_bench=False):
         in_params = [f"in{i}" for i in range(self.layers[0].shape[0])]
@@ -84,36 +251,63 @@ class Model:
         return in_params, out_params, in_definitions, out_definitions
 
 
-    def emit(self):
-        out = ["`timescale 1ns / 1ps"]
-        out.append(multiplier_module) # adding the multiplier module
-        out.append(adder_module) # adding the adder module
+    def emit(self, workers: int = None) -> str:
+        """
+        :param workers: Number of processes emitting the layers, see emit_chunks
+        :return: Verilog code
+        """
+        return ''.join(self.emit_chunks(workers))
+
+    def emit_to(self, fp, workers: int = None):
+        """
+        Write the Verilog code to a file chunk by chunk
+        :param fp: Text file object
+        :param workers: Number of processes emitting the layers, see emit_chunks
+        """
+        fp.writelines(self.emit_chunks(workers))
+
+    def emit_chunks(self, workers: int = None):
+        """
+        Emit the fixed-point arithmetic modules and the modules of all layers followed by top,
+        writing the ROM files first if there are any
+        :param workers: Emit the layers, and blocks of outputs of the wide ones, in a pool of this
+            many processes, see emit_layers. The code is the same as emitted by one process.
+        :return: Iterator over the Verilog code
+        """
+        self.write_roms()
+        yield "`timescale 1ns / 1ps\n"
+        yield multiplier_module + "\n" # adding the multiplier module
+        yield adder_module + "\n" # adding the adder module
+        yield from emit_layers(self.layers, workers)
+        yield from self.emit_top()
+        if self.bus_width:
+            # top is combinational, so every vector is issued and finished in the same cycle
+            yield "\n\n"
+            yield from emit_axis_top(self.layers[0].in_bits, self.layers[-1].out_bits, self.bus_width, 0, 1, False)
+
+    def emit_top(self):
+        """
+        Emit the top module that chains the layers
+        :return: Iterator over the lines of Verilog code
+        """
         in_params, out_params, in_definitions, out_definitions = self.get_vars()
-        top = [
-            f"module top({','.join(in_params)}, {','.join(out_params)});",
-            *in_definitions,
-            *out_definitions,
-        ]
+        yield f"module top({','.join(in_params)}, {','.join(out_params)});\n"
+        yield from (f"{line}\n" for line in in_definitions + out_definitions)
         in_wires = in_params
         out_wires = []
         for i, layer in enumerate(self.layers):
-            out.append(layer.emit())
             out_wires = []
             for j in range(layer.shape[-1]):
-                top.append(f"    wire [{layer.out_bits[j] - 1}:0] layer_{i}_out_{j};")
+                yield f"    wire [{layer.out_bits[j] - 1}:0] layer_{i}_out_{j};\n"
                 out_wires.append(f"layer_{i}_out_{j}")
-            top.append(f"    {layer.name} layer_{i}({','.join(in_wires)}, {','.join(out_wires)});")
+            yield f"    {layer.name} layer_{i}({','.join(in_wires)}, {','.join(out_wires)});\n"
             in_wires = out_wires
-        assigns = [f"    assign out{i} = {out_wire};" for i, out_wire in enumerate(out_wires)]
-        top.extend(assigns)
-        top.append("endmodule")
-        out.append('\n'.join(top))
-
-        return '\n'.join(out)
+        yield from (f"    assign out{i} = {out_wire};\n" for i, out_wire in enumerate(out_wires))
+        yield "endmodule"
 
     def emit_test_bench(self):
         in_params, out_params, in_definitions, out_definitions, file_in_str, file_out_str = self.get_vars(test_bench=True)
-        int_bits =  self.layers[0].integer_bits
+        int_bits =  self.layers[0].in_bits - self.FW
         assigns = [f"        assign {in_params[i]} = {ftfp(self.random_test_inputs[i], int_bits[i], self.FW)};" for i in range(len(in_params))]
 
         return test_bench_template_frac.format(
@@ -124,5 +318,103 @@ class Model:
             assignments='\n'.join(assigns),
             file_in_str=file_in_str,
             file_out_str=file_out_str,
-            FW=self.FW
+            FW=self.output_fractional_bits()
+        )
+
+    def random_test_batch(self, num_vectors: int):
+        """
+        Random test vectors drawn like random_test_inputs, already converted to fixed point
+        :param num_vectors: Number of vectors
+        :return: int64 array of shape (num_vectors, num_in)
+        """
+        rng = np.random.default_rng(self.seed)
+        return to_fixed(rng.random((num_vectors, self.num_in)), self.FW)
+
+    def write_stimulus(self, batch, path: str):
+        """
+        Write test vectors as a $readmemh file for emit_batch_test_bench, one input per line
+        :param batch: Integer array of shape (N, num_in)
+        :param path: Output file
+        """
+        write_hex(path, np.atleast_2d(batch), self.layers[0].in_bits)
+
+    def read_stimulus(self, path: str):
+        """
+        Read a file written by write_stimulus back, sign-extended to the input widths
+        :param path: Input file
+        :return: int64 array of shape (N, num_in)
+        """
+        return wrap_signed(read_hex(path).reshape(-1, self.num_in), self.layers[0].in_bits)
+
+    def emit_batch_test_bench(self, num_vectors: int, stimulus_file: str, output_file: str):
+        """
+        Emit a test bench that streams num_vectors vectors from stimulus_file through top and
+        writes one line of outputs per vector to output_file
+        :param num_vectors: Number of vectors in stimulus_file
+        :param stimulus_file: File written by write_stimulus
+        :param output_file: File the outputs are written to
+        :return: Verilog code
+        """
+        in_params, out_params, in_definitions, out_definitions, _, file_out_str = self.get_vars(test_bench=True)
+        in_bits = self.layers[0].in_bits
+        assigns = [f"            {in_params[i]} = stimulus[vector * {len(in_params)} + {i}][{in_bits[i] - 1}:0];"
+                   for i in range(len(in_params))]
+
+        return test_bench_batch_template.format(
+            in_params=', '.join(in_params),
+            out_params=', '.join(out_params),
+            in_definitions='\n    '.join(in_definitions),
+            out_definitions='\n    '.join(out_definitions),
+            word_bits=max(in_bits),
+            num_words=num_vectors * len(in_params),
+            num_vectors=num_vectors,
+            stimulus_file=stimulus_file,
+            output_file=output_file,
+            assignments='\n'.join(assigns),
+            file_out_str=file_out_str,
+        )
+
+    def write_stream_stimulus(self, batch, path: str):
+        """
+        Write test vectors as a $readmemh file for emit_stream_test_bench, one transfer per line
+        :param batch: Integer array of shape (N, num_in)
+        :param path: Output file
+        """
+        write_stream(path, pack_stream(batch, self.layers[0].in_bits, self.bus_width), self.bus_width)
+
+    def read_stream_output(self, path: str):
+        """
+        Read the results written by the test bench of emit_stream_test_bench
+        :param path: File the test bench wrote
+        :return: int64 array of shape (N, num_out) with the outputs and the achieved throughput in
+            vectors per clock cycle, from the first input transfer to the last output transfer
+        """
+        transfers, cycles = read_stream(path)
+        outputs = unpack_stream(transfers, self.layers[-1].out_bits, self.bus_width)
+        return outputs, len(outputs) / cycles
+
+    def emit_stream_test_bench(self, num_vectors: int, stimulus_file: str, output_file: str, stall: int = 0,
+                               seed: int = 1):
+        """
+        Emit a test bench that pushes num_vectors vectors from stimulus_file through axis_top as fast
+        as it accepts them, writes every output transfer to output_file and measures the clock
+        cycles the stream takes
+        :param num_vectors: Number of vectors in stimulus_file
+        :param stimulus_file: File written by write_stream_stimulus
+        :param output_file: File the output transfers and the cycle count are written to
+        :param stall: Percentage of clock cycles in which m_axis_tready is low, to exercise back pressure
+        :param seed: Seed of the random stalls
+        :return: Verilog code
+        """
+        if not self.bus_width:
+            raise ValueError('The stream interface is only emitted with bus_width')
+        return test_bench_stream_template.format(
+            bus_width=self.bus_width,
+            num_in_words=num_vectors * stream_words(self.layers[0].in_bits, self.bus_width),
+            num_out_words=num_vectors * stream_words(self.layers[-1].out_bits, self.bus_width),
+            num_vectors=num_vectors,
+            stimulus_file=stimulus_file,
+            output_file=output_file,
+            stall=stall,
+            seed=seed,
         )
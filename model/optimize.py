@@ -0,0 +1,166 @@
+from typing import Dict
+
+import numpy as np
+
+import layers
+from layers.emitter import Emitter
+from layers.utils import integral
+
+# layers whose outputs are sliced by keep_inputs and keep_outputs
+DOT_PRODUCTS = (layers.Linear, layers.LinearFrac)
+# layers that compute every output from the input of the same index
+ELEMENTWISE = (layers.ReLU, layers.Requant)
+
+
+def prune(model: Emitter) -> Dict[int, int]:
+    """
+    Remove the dead neurons of a sized Model or FracModel. An input of a Linear layer is dead if its
+    range from forward_range is constant, such as a ReLU whose input never exceeds zero, or if all
+    of its weights are zero. When the input is computed by an earlier Linear layer, possibly through
+    ReLU and Requant layers, the neuron and the values derived from it are removed and the constant
+    is added to the biases of the reading layer. Removing neurons can leave inputs of the earlier
+    layer without weights, so the layers are visited from the last to the first and the removals
+    cascade. The widths found by forward_range are kept, and the outputs of top do not change.
+    Zero weights of the remaining neurons are skipped when the layers are emitted.
+    After calibrate the ranges are the observed ones, so a neuron that was constant on the
+    calibration data is treated as constant.
+    :param model: Model after forward_range or calibrate, whose layers are pruned in place
+    :return: Dictionary with the number of removed neurons by the index of every Linear layer that lost any
+    """
+    removed = {}
+    for m in range(len(model.layers) - 1, 0, -1):
+        consumer = model.layers[m]
+        if not isinstance(consumer, DOT_PRODUCTS):
+            continue
+        if consumer.in_range is None:
+            raise ValueError('Run forward_range before pruning')
+
+        p = m - 1
+        while p > 0 and isinstance(model.layers[p], ELEMENTWISE):
+            p -= 1
+        producer = model.layers[p]
+        if not isinstance(producer, DOT_PRODUCTS):
+            continue
+
+        keep = np.flatnonzero(~consumer.dead_inputs())
+        if len(keep) == consumer.in_features:
+            continue
+        if len(keep) == 0:
+            # every module needs a port
+            keep = np.array([0])
+
+        removed[producer.index] = consumer.in_features - len(keep)
+        consumer.keep_inputs(keep, consumer.in_range[:, 0])
+        for layer in model.layers[p:m]:
+            layer.keep_outputs(keep)
+
+    model.set_rom_prefixes()
+    return removed
+
+
+def dense(layer):
+    """
+    :param layer: Linear, LinearFrac or Conv1D layer
+    :return: Weight of shape (inputs, outputs) and bias of the layer as a fully connected layer
+    """
+    if isinstance(layer, layers.Conv1D):
+        bias = np.repeat(layer.bias, layer.out_length) if layer.bias is not None else None
+        return layer.dense_weight(), bias
+    return layer.weight, layer.bias
+
+
+def fold(first: Emitter, second: Emitter):
+    """
+    Fold two consecutive layers without a nonlinearity between them into one Linear layer with the
+    product of their matrices. Integer layers fold exactly and keep the widths of the pair. The
+    products of a LinearFrac layer are truncated, so the folded layer computes a slightly different
+    fixed-point function and is sized by its own forward_range.
+    :param first: Linear, Conv1D or LinearFrac layer
+    :param second: Linear or LinearFrac layer reading the outputs of first
+    :return: The folded layer, or None if the pair can not be folded or the folded layer would need
+        more products than the pair
+    """
+    if not isinstance(second, DOT_PRODUCTS) or getattr(second, 'parallelism', 0):
+        return None
+    if first.relu or getattr(first, 'parallelism', 0) or getattr(first, 'streaming', False):
+        return None
+    if isinstance(second, layers.LinearFrac) != isinstance(first, layers.LinearFrac):
+        return None
+
+    first_weight, first_bias = dense(first)
+    weight = first_weight @ second.weight
+    if np.count_nonzero(weight) > np.count_nonzero(first_weight) + np.count_nonzero(second.weight):
+        return None
+    bias = first_bias @ second.weight if first_bias is not None else None
+    if second.bias is not None:
+        bias = second.bias if bias is None else bias + second.bias
+    num_in = first_weight.shape[0]
+
+    if isinstance(second, layers.LinearFrac):
+        folded = layers.LinearFrac(num_in, second.out_features, weight, bias, first.index, second.fractional_bits)
+        folded.reduction, folded.shift_add, folded.relu = second.reduction, second.shift_add, second.relu
+        try:
+            folded.set_fractional_bits(second.fractional_bits, second.weight_fractional_bits,
+                                       first.in_fractional_bits)
+        except ValueError:
+            return None
+        folded.forward_range(first.in_range)
+        # the layers after the pair are sized for the outputs of second
+        if np.any(folded.mac_bits > second.mac_bits) or np.any(folded.out_bits > second.out_bits):
+            return None
+        folded.mac_bits, folded.out_bits = second.mac_bits, second.out_bits
+        folded.neuron_bits = np.maximum(folded.neuron_bits, folded.mac_bits)
+        folded.set_integer_bits()
+        return folded
+
+    folded = layers.Linear(num_in, second.out_features, integral(weight),
+                           integral(bias) if bias is not None else None, first.index)
+    folded.stages, folded.reduction, folded.shift_add = second.stages, second.reduction, second.shift_add
+    folded.relu = second.relu
+    folded.in_range, folded.in_bits = first.in_range, first.in_bits
+    folded.mac_bits, folded.out_bits = second.mac_bits, second.out_bits
+    return folded
+
+
+def fuse(model: Emitter) -> Dict[str, int]:
+    """
+    Merge the layers of a sized Model or FracModel into fewer modules, so top has fewer instances
+    and wires between them. First every Linear or Conv1D layer followed directly by a Linear layer,
+    such as Conv1d -> Flatten -> Linear, is folded into one Linear layer with the product of their
+    matrices, as long as that needs no more products than the pair (see fold). Then every ReLU is
+    fused into the Linear or Conv1D layer before it, which applies it to its results instead of
+    driving a module of its own. Folded layers and streaming convolutions keep their ReLU layers.
+    The widths found by forward_range are kept, and forward_range can be run again afterwards, but
+    calibrate can not, since the layers no longer line up with the torch modules.
+    :param model: Model after forward_range or calibrate, whose layers are fused in place
+    :return: Dictionary with the number of 'folded' layer pairs and of 'relu' layers fused
+    """
+    fused = {'folded': 0, 'relu': 0}
+    k = 0
+    while k + 1 < len(model.layers):
+        if model.layers[k].out_bits is None:
+            raise ValueError('Run forward_range before fusing')
+        folded = fold(model.layers[k], model.layers[k + 1]) \
+            if isinstance(model.layers[k], DOT_PRODUCTS + (layers.Conv1D,)) else None
+        if folded is None:
+            k += 1
+            continue
+        # the folded layer can be folded with the one after it again
+        model.layers[k:k + 2] = [folded]
+        fused['folded'] += 1
+
+    k = 1
+    while k < len(model.layers):
+        layer, before = model.layers[k], model.layers[k - 1]
+        if isinstance(layer, layers.ReLU) and isinstance(before, DOT_PRODUCTS + (layers.Conv1D,)) \
+                and not before.relu and not getattr(before, 'parallelism', 0) \
+                and not getattr(before, 'streaming', False):
+            before.relu = True
+            before.out_bits = layer.out_bits
+            del model.layers[k]
+            fused['relu'] += 1
+        else:
+            k += 1
+
+    model.set_rom_prefixes()
+    return fused
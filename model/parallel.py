@@ -0,0 +1,76 @@
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List
+
+from layers.emitter import Emitter
+
+# the layers being emitted, handed to every worker process once instead of with every block
+worker_layers = None
+
+
+def init_worker(layers: List[Emitter]):
+    global worker_layers
+    worker_layers = layers
+
+
+def emit_block(index: int, outputs: range) -> str:
+    """
+    :param index: Index of the layer in the layers given to init_worker
+    :param outputs: Outputs of the layer to emit, None for the whole layer
+    :return: Verilog code of the block
+    """
+    layer = worker_layers[index]
+    return ''.join(layer.emit_chunks() if outputs is None else layer.emit_chunks(outputs))
+
+
+def output_blocks(layer: Emitter, workers: int, min_outputs: int = 16) -> List[range]:
+    """
+    Split the outputs of a layer into blocks that are emitted separately, about four per worker so
+    the blocks of a wide layer keep every worker busy
+    :param layer: Layer
+    :param workers: Number of worker processes
+    :param min_outputs: Fewest outputs of a block, so a block is worth sending to a process
+    :return: Consecutive ranges of outputs, or [None] if the layer is emitted as a whole
+    """
+    num_outputs = layer.split_outputs()
+    if not num_outputs:
+        return [None]
+    size = max(min_outputs, math.ceil(num_outputs / (4 * workers)))
+    return [range(start, min(start + size, num_outputs)) for start in range(0, num_outputs, size)]
+
+
+def emit_layers(layers: List[Emitter], workers: int = None) -> Iterator[str]:
+    """
+    Emit the modules of all layers, every module followed by an empty line. With several workers,
+    the layers, and blocks of outputs of the wide ones, are emitted by a pool of processes, and the
+    blocks are yielded in the order of the serial emission as soon as they are done. At most two
+    blocks per worker are waiting to be written, so the memory needed does not grow with the design.
+    :param layers: Layers after forward_range
+    :param workers: Number of worker processes, None or 1 to emit in this process
+    :return: Iterator over the Verilog code, the same as emitted serially
+    """
+    if not workers or workers == 1:
+        for layer in layers:
+            yield from layer.emit_chunks()
+            yield "\n"
+        return
+
+    tasks = [(index, outputs) for index, layer in enumerate(layers) for outputs in output_blocks(layer, workers)]
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(layers,)) as pool:
+        pending = deque()
+        for index, outputs in tasks:
+            pending.append((index, outputs, pool.submit(emit_block, index, outputs)))
+            while len(pending) >= 2 * workers or (pending and pending[0][2].done()):
+                yield from finish_block(layers, *pending.popleft())
+        while pending:
+            yield from finish_block(layers, *pending.popleft())
+
+
+def finish_block(layers: List[Emitter], index: int, outputs: range, future) -> Iterator[str]:
+    """
+    :return: Iterator over the code of a block, and the empty line after the module if the block ends it
+    """
+    yield future.result()
+    if outputs is None or outputs.stop == layers[index].split_outputs():
+        yield "\n"
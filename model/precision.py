@@ -0,0 +1,168 @@
+import copy
+from typing import List
+
+import numpy as np
+import torch
+
+from layers.intervals import data_range
+from layers.utils import from_fixed, to_fixed
+from model.model_frac import Model
+
+
+def design_bits(model: Model) -> int:
+    """
+    Cost the fractional widths are traded against: the bits of every wire between the layers of top
+    and of the operands of every multiplier, which grow with both the activation and the weight formats
+    :param model: Model after forward_range
+    :return: Total number of bits
+    """
+    bits = int(np.sum(model.layers[0].in_bits)) + sum(int(np.sum(layer.out_bits)) for layer in model.layers)
+    for layer in model.linear_layers():
+        bits += int(np.sum(layer.neuron_bits)) * layer.in_features
+
+    return bits
+
+
+def output_error(outputs: np.ndarray, reference: np.ndarray, metric: str) -> float:
+    """
+    :param outputs: Real-valued outputs of the design
+    :param reference: Outputs of the float model
+    :param metric: 'max' for the largest absolute error, 'rms' for the root mean square error
+    :return: Error of the outputs
+    """
+    error = np.abs(outputs - reference)
+    if metric == 'max':
+        return float(error.max())
+    if metric == 'rms':
+        return float(np.sqrt(np.mean(error ** 2)))
+    raise ValueError(f'Unknown metric {metric}')
+
+
+class PrecisionSearch:
+    """
+    Evaluates fixed-point formats of a Model with its bit-accurate simulate() against the float
+    model on a fixed set of inputs
+    """
+
+    def __init__(self, model: Model, data, ranges: List[List[float]] = None, metric: str = 'max'):
+        """
+        :param model: Model whose formats are searched, it is left with the last evaluated ones
+        :param data: Real-valued inputs of shape (N, num_in) the error is measured on
+        :param ranges: Input ranges the wires are sized for, the ranges observed in data if None
+        :param metric: Error metric, see output_error
+        """
+        self.model = model
+        self.data = np.asarray(data, dtype=np.float64).reshape(len(data), -1)
+        self.ranges = np.array(ranges, dtype=np.float64) if ranges is not None else data_range(self.data)
+        self.metric = metric
+        with torch.no_grad():
+            reference = copy.deepcopy(model.model).double().eval()(torch.from_numpy(self.data)).numpy()
+        self.reference = reference.reshape(len(reference), -1)
+        self.evaluations = 0
+
+    def evaluate(self, in_bits: int, fractional_bits: List[int], weight_fractional_bits: List[int]):
+        """
+        Apply formats to the model, size its wires and simulate it
+        :param in_bits: Fractional bits of the inputs of top
+        :param fractional_bits: Fractional bits of the outputs of every LinearFrac layer
+        :param weight_fractional_bits: Fractional bits of the weights of every LinearFrac layer
+        :return: Error against the float model and the design_bits of the formats, or None if a
+            layer cannot use them
+        """
+        try:
+            self.model.set_fractional_bits(fractional_bits, weight_fractional_bits, in_bits)
+        except ValueError:
+            return None
+        self.model.forward_range(self.ranges)
+        self.evaluations += 1
+
+        outputs = self.model.simulate(to_fixed(self.data, in_bits))
+        outputs = from_fixed(outputs, self.model.output_fractional_bits())
+
+        return output_error(outputs, self.reference, self.metric), design_bits(self.model)
+
+
+def search_fractional_bits(model: Model, data, error_budget: float, ranges: List[List[float]] = None,
+                           metric: str = 'max', max_bits: int = 16, min_bits: int = 0, per_tensor: bool = True):
+    """
+    Mixed-precision search: choose the fractional bits of the inputs and of the outputs and weights
+    of every LinearFrac layer so the design stays within an error budget against the float model
+    with as few bits as possible. The search greedily drops the fractional bit that saves the most
+    bits while the error stays within the budget, until no bit can be dropped. It descends once
+    from max_bits everywhere and once from the fewest bits that are within the budget when every
+    value uses them, and keeps the cheaper result, which is never worse than one format for all. Every step runs the bit-accurate simulate() over data, so the error is the
+    one of the emitted design. The model is left with the chosen formats and sized for ranges.
+    :param model: Model to search the formats of
+    :param data: Real-valued inputs of shape (N, num_in) the error is measured on
+    :param error_budget: Largest error of the outputs, in real units
+    :param ranges: Input ranges the wires are sized for, the ranges observed in data if None
+    :param metric: 'max' to bound the largest absolute error of any output, 'rms' to bound the
+        root mean square error
+    :param max_bits: Most fractional bits of any value; the products of the simulation are held in
+        int64, so the widest neurons must stay below 32 bits
+    :param min_bits: Fewest fractional bits of any value
+    :param per_tensor: Search the weights of every layer separately from its outputs, otherwise
+        both share one format
+    :return: Dict with the fractional bits of the inputs ('input'), of the outputs ('fractional')
+        and of the weights ('weight') of every LinearFrac layer, the 'error', the design 'bits'
+        and the number of 'evaluations'
+    """
+    search = PrecisionSearch(model, data, ranges, metric)
+    num_layers = len(model.linear_layers())
+
+    # one entry per searched format: the inputs, the outputs of every layer, then its weights
+    size = 1 + num_layers * (2 if per_tensor else 1)
+
+    def split(candidate):
+        fractional = candidate[1:1 + num_layers]
+        weight = candidate[1 + num_layers:] if per_tensor else fractional
+        return candidate[0], list(fractional), list(weight)
+
+    def descend(formats, result):
+        while True:
+            best = None
+            for k in range(len(formats)):
+                if formats[k] <= min_bits:
+                    continue
+                candidate = formats[:k] + [formats[k] - 1] + formats[k + 1:]
+                candidate_result = search.evaluate(*split(candidate))
+                if candidate_result is None or candidate_result[0] > error_budget:
+                    continue
+                # the largest saving first, and the smaller error of equal savings
+                if best is None or candidate_result[::-1] < best[1][::-1]:
+                    best = (candidate, candidate_result)
+            if best is None:
+                return formats, result
+            formats, result = best
+
+    starts = []
+    for uniform in range(max_bits, min_bits - 1, -1):
+        result = search.evaluate(*split([uniform] * size))
+        if result is None or result[0] > error_budget:
+            break
+        starts = starts[:1] + [([uniform] * size, result)]
+    if not starts:
+        error = 'unusable' if result is None else f'{result[0]:.4g}'
+        raise ValueError(f'The error with {max_bits} fractional bits is {error}, above the budget of {error_budget}')
+
+    formats, (error, bits) = min((descend(*start) for start in starts), key=lambda found: found[1][::-1])
+
+    in_bits, fractional, weight = split(formats)
+    search.evaluate(in_bits, fractional, weight)
+
+    return {'input': in_bits, 'fractional': fractional, 'weight': weight, 'error': error, 'bits': bits,
+            'evaluations': search.evaluations}
+
+
+def precision_report(model: Model) -> str:
+    """
+    Summarize the fixed-point format and the widths of every LinearFrac layer
+    :param model: Model after forward_range
+    :return: Printable table
+    """
+    lines = [f"{'layer':<32}{'in FW':>7}{'weight FW':>11}{'out FW':>8}{'out bits':>10}{'neuron bits':>13}"]
+    for layer in model.linear_layers():
+        lines.append(f"{layer.name:<32}{layer.in_fractional_bits:>7}{layer.weight_fractional_bits:>11}"
+                     f"{layer.fractional_bits:>8}{int(np.sum(layer.out_bits)):>10}{int(np.sum(layer.neuron_bits)):>13}")
+    lines.append(f"total {design_bits(model)} bits")
+    return '\n'.join(lines)
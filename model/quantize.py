@@ -0,0 +1,191 @@
+import copy
+import math
+from typing import List, Sequence
+
+import numpy as np
+import torch
+from torch import nn
+
+from layers.requant import Requantize
+from model.calibration import observe_ranges
+from model.model import Model
+
+# layers that only move or select values, so their outputs keep the scale of their inputs
+SCALE_PRESERVING = (nn.ReLU, nn.MaxPool1d, nn.Flatten, nn.Unflatten)
+
+
+def symmetric_scale(magnitude, bits: int):
+    """
+    :param magnitude: Largest absolute value to represent, scalar or array
+    :param bits: Bit width of the signed integers
+    :return: Real value of one integer step, so magnitude maps onto the largest integer
+    """
+    return np.maximum(np.asarray(magnitude, dtype=np.float64), 1e-12) / ((1 << (bits - 1)) - 1)
+
+
+def fixed_multiplier(factor, multiplier_bits: int):
+    """
+    Approximate real factors by integer multipliers and one shared right shift
+    :param factor: Positive real factors
+    :param multiplier_bits: Bit width of the unsigned multipliers
+    :return: int64 multipliers and the shift, factor ~ multiplier / 2^shift
+    """
+    factor = np.asarray(factor, dtype=np.float64)
+    shift = max(0, math.floor(math.log2(((1 << multiplier_bits) - 1) / factor.max())))
+    multiplier = np.maximum(np.round(factor * 2 ** shift), 1).astype(np.int64)
+
+    return multiplier, shift
+
+
+class QuantizedModel:
+    """
+    Integer version of a float nn.Sequential: Linear and Conv1d layers with integer weights and
+    biases, each followed by a Requantize back to activation_bits, and the scales that map the
+    integers back to real values
+    """
+
+    def __init__(self, model: nn.Sequential, input_scale: float, output_scale: np.ndarray, activation_bits: int,
+                 weight_bits: int):
+        """
+        :param model: Integer model, with integer values in float64 tensors
+        :param input_scale: Real value of one step of the quantized inputs
+        :param output_scale: Real value of one step of every output
+        :param activation_bits: Bit width of the inputs and of every requantized activation
+        :param weight_bits: Bit width of the weights
+        """
+        self.model = model
+        self.input_scale = input_scale
+        self.output_scale = output_scale
+        self.activation_bits = activation_bits
+        self.weight_bits = weight_bits
+
+    def input_ranges(self) -> List[List[float]]:
+        """
+        :return: Range of every quantized input, to be passed to Model.forward_range
+        """
+        num_in = self.model[0].in_features
+        return [[-(1 << (self.activation_bits - 1)), (1 << (self.activation_bits - 1)) - 1]] * num_in
+
+    def quantize_input(self, x) -> np.ndarray:
+        """
+        :param x: Real inputs of shape (N, num_in)
+        :return: int64 array of the quantized inputs, rounded and saturated
+        """
+        x = np.asarray(x, dtype=np.float64) / self.input_scale
+        limit = (1 << (self.activation_bits - 1)) - 1
+        return np.clip(np.round(x), -limit - 1, limit).astype(np.int64)
+
+    def dequantize_output(self, y) -> np.ndarray:
+        """
+        :param y: Integer outputs of shape (N, num_out), e.g. from Model.simulate
+        :return: Real outputs
+        """
+        return np.asarray(y, dtype=np.float64) * self.output_scale
+
+
+def quantize(model: nn.Sequential, data, activation_bits: int = 8, weight_bits: int = 8, per_channel: bool = True,
+             percentile: float = 100.0, multiplier_bits: int = 16, batch_size: int = 1024) -> QuantizedModel:
+    """
+    Post-training quantization with symmetric scales. The activation scales come from the ranges
+    observed on a calibration set, and the weights are scaled per layer or per output channel.
+    A layer computes integer dot products at scale input_scale * weight_scale, which a
+    Requantize maps onto the scale of its output with an integer multiplier and a right shift.
+    :param model: Trained float model of Linear, Conv1d, ReLU, MaxPool1d, Flatten and Unflatten layers
+    :param data: Calibration inputs, see model.calibration.calibration_batches
+    :param activation_bits: Bit width of the inputs and of every activation
+    :param weight_bits: Bit width of the weights
+    :param per_channel: Give every output channel its own weight scale instead of one per layer
+    :param percentile: Percentile of the observed activations mapped onto the largest integer,
+        larger values saturate
+    :param multiplier_bits: Bit width of the requantization multipliers
+    :param batch_size: Number of samples per batch when data is a single array or tensor
+    :return: The quantized model
+    """
+    model = copy.deepcopy(model).double().eval()
+    observed = observe_ranges(model, data, percentile, batch_size)
+    magnitudes = [np.abs(ranges).max() for ranges in observed]
+
+    modules = list(model)
+    scale = symmetric_scale(magnitudes[0], activation_bits)
+    input_scale = scale
+    quantized = []
+    position = 0
+    for k, module in enumerate(modules):
+        if not isinstance(module, (nn.Flatten, nn.Unflatten)):
+            position += 1
+        if isinstance(module, SCALE_PRESERVING):
+            quantized.append(module)
+            continue
+        if not isinstance(module, (nn.Linear, nn.Conv1d)):
+            raise ValueError(f'Quantization of {module} is not supported')
+
+        weight = module.weight.detach().numpy()
+        axes = tuple(range(1, weight.ndim))
+        weight_scale = symmetric_scale(np.abs(weight).max(axis=axes) if per_channel else np.abs(weight).max(),
+                                       weight_bits)
+        weight_scale = np.broadcast_to(weight_scale, (weight.shape[0],))
+        limit = (1 << (weight_bits - 1)) - 1
+        integer = copy.deepcopy(module)
+        integer.weight = nn.Parameter(torch.from_numpy(np.clip(np.round(
+            weight / weight_scale.reshape((-1,) + (1,) * (weight.ndim - 1))), -limit, limit)), requires_grad=False)
+        accumulator_scale = scale * weight_scale
+        if module.bias is not None:
+            bias = np.round(module.bias.detach().numpy() / accumulator_scale)
+            integer.bias = nn.Parameter(torch.from_numpy(bias), requires_grad=False)
+        quantized.append(integer)
+
+        # the scale of the output is set by the values after the activations that follow
+        following = position
+        for module_after in modules[k + 1:]:
+            if not isinstance(module_after, SCALE_PRESERVING):
+                break
+            if not isinstance(module_after, (nn.Flatten, nn.Unflatten)):
+                following += 1
+        out_scale = symmetric_scale(magnitudes[following], activation_bits)
+
+        multiplier, shift = fixed_multiplier(accumulator_scale / out_scale, multiplier_bits)
+        quantized.append(Requantize(multiplier, shift, activation_bits))
+        scale = out_scale
+
+    return QuantizedModel(nn.Sequential(*quantized), input_scale, scale, activation_bits, weight_bits)
+
+
+def quantization_report(model: nn.Sequential, calibration_data, test_data, bits: Sequence[int] = (16, 12, 8, 6, 4),
+                        labels=None, per_channel: bool = True, percentile: float = 100.0):
+    """
+    Quantize a model to every bit width and compare the bit-accurate simulation of the design
+    with the float model on test data
+    :param model: Trained float model, see quantize
+    :param calibration_data: Inputs the scales are chosen from, see quantize
+    :param test_data: Inputs of shape (N, num_in) the accuracy is measured on
+    :param bits: Bit widths of the weights and activations to try
+    :param labels: Class of every test input, to report the accuracy of the argmax of the outputs
+    :param per_channel: Give every output channel its own weight scale
+    :param percentile: Percentile of the observed activations mapped onto the largest integer
+    :return: Printable table with the errors against the float model, the agreement of the argmax
+        with the float model, the accuracy, and the bits of all weights and of all output wires
+    """
+    test_data = np.asarray(test_data, dtype=np.float64)
+    with torch.no_grad():
+        reference = copy.deepcopy(model).double().eval()(torch.from_numpy(test_data)).numpy()
+    reference = reference.reshape(len(reference), -1)
+    signal = np.sqrt(np.mean(reference ** 2))
+
+    lines = [f"{'bits':>5}{'max error':>11}{'rms error':>11}{'SQNR [dB]':>11}{'argmax':>8}{'accuracy':>10}"
+             f"{'weight bits':>13}{'wire bits':>11}"]
+    for width in bits:
+        quantized = quantize(model, calibration_data, width, width, per_channel, percentile)
+        design = Model(quantized.model)
+        design.forward_range(quantized.input_ranges())
+        outputs = quantized.dequantize_output(design.simulate(quantized.quantize_input(test_data)))
+
+        error = outputs - reference
+        rms = np.sqrt(np.mean(error ** 2))
+        agreement = np.mean(outputs.argmax(axis=1) == reference.argmax(axis=1))
+        accuracy = f"{np.mean(outputs.argmax(axis=1) == np.asarray(labels)):>10.3f}" if labels is not None else f"{'-':>10}"
+        weight_bits = sum(layer.weight.size for layer in design.layers if hasattr(layer, 'weight')) * width
+        wire_bits = sum(int(np.sum(layer.out_bits)) for layer in design.layers)
+        lines.append(f"{width:>5}{np.abs(error).max():>11.4g}{rms:>11.4g}{20 * np.log10(signal / max(rms, 1e-300)):>11.1f}"
+                     f"{agreement:>8.3f}{accuracy}{weight_bits:>13}{wire_bits:>11}")
+
+    return '\n'.join(lines)
@@ -0,0 +1,206 @@
+import math
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from layers.folded import counter_bits
+from layers.utils import wrap_signed
+
+
+def stream_words(bits, bus_width: int) -> int:
+    """
+    :param bits: Bit width of every value of a vector
+    :param bus_width: Number of data bits per transfer
+    :return: Number of transfers a vector is serialized into
+    """
+    return max(1, math.ceil(int(np.sum(bits)) / bus_width))
+
+
+def fifo_depth(latency: int, interval: int) -> int:
+    """
+    :param latency: Clock cycles between a vector entering the network and its result
+    :param interval: Minimum number of clock cycles between two vectors entering the network
+    :return: Number of result slots needed to keep issuing vectors while earlier results are in
+        flight, so the output buffer never limits the throughput of an unstalled stream
+    """
+    return math.ceil((latency + 2) / interval) + 1
+
+
+def pack_stream(batch, bits, bus_width: int) -> List[int]:
+    """
+    Serialize vectors like the stream interface: the values are concatenated in two's complement
+    starting with value 0 in the least significant bits, and the result is sent in transfers of
+    bus_width bits starting with the least significant ones
+    :param batch: Integer array of shape (N, len(bits))
+    :param bits: Bit width of every value
+    :param bus_width: Number of data bits per transfer
+    :return: The N * stream_words(bits, bus_width) transfers
+    """
+    offsets = np.concatenate([[0], np.cumsum(bits)]).tolist()
+    words = stream_words(bits, bus_width)
+    mask = (1 << bus_width) - 1
+    transfers = []
+    for row in np.atleast_2d(batch).tolist():
+        packed = 0
+        for value, offset, width in zip(row, offsets, bits):
+            packed |= (int(value) & ((1 << int(width)) - 1)) << offset
+        transfers.extend((packed >> (w * bus_width)) & mask for w in range(words))
+
+    return transfers
+
+
+def unpack_stream(transfers, bits, bus_width: int) -> np.ndarray:
+    """
+    Inverse of pack_stream
+    :param transfers: Transfers of bus_width bits
+    :param bits: Bit width of every value
+    :param bus_width: Number of data bits per transfer
+    :return: int64 array of shape (N, len(bits)) with the signed values
+    """
+    offsets = np.concatenate([[0], np.cumsum(bits)]).tolist()
+    words = stream_words(bits, bus_width)
+    rows = []
+    for start in range(0, len(transfers) - words + 1, words):
+        packed = sum(int(word) << (w * bus_width) for w, word in enumerate(transfers[start:start + words]))
+        rows.append([(packed >> offset) & ((1 << int(width)) - 1) for offset, width in zip(offsets, bits)])
+
+    return wrap_signed(np.array(rows, dtype=np.int64).reshape(-1, len(bits)), bits)
+
+
+def write_stream(path: str, transfers, bus_width: int):
+    """
+    Write transfers as a $readmemh file, one transfer per line
+    :param path: Output file
+    :param transfers: Transfers of bus_width bits
+    :param bus_width: Number of data bits per transfer
+    """
+    digits = math.ceil(bus_width / 4)
+    with open(path, 'w') as f:
+        f.writelines(f"{word:0{digits}x}\n" for word in transfers)
+
+
+def read_stream(path: str) -> Tuple[List[int], int]:
+    """
+    Read the file written by the stream test bench
+    :param path: Input file
+    :return: The received transfers and the number of clock cycles from the first input transfer
+        to the last output transfer
+    """
+    transfers, cycles = [], None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('// cycles'):
+                cycles = int(line.split()[-1])
+            elif line:
+                transfers.append(int(line, 16))
+
+    return transfers, cycles
+
+
+def emit_axis_top(in_bits, out_bits, bus_width: int, latency: int, interval: int, clocked: bool) -> Iterator[str]:
+    """
+    Emit axis_top, which connects top to valid/ready stream interfaces. Input transfers are
+    collected into a vector buffer, which is issued to top as soon as top can take a new vector
+    and the output buffer has a free slot for its result. Every slot is reserved from the issue
+    until its last output transfer, so back pressure on the output stalls the input instead of
+    losing results.
+    :param in_bits: Bit width of every input of top
+    :param out_bits: Bit width of every output of top
+    :param bus_width: Number of data bits per transfer
+    :param latency: Clock cycles between in_valid and out_valid of top
+    :param interval: Minimum number of clock cycles between two vectors entering top
+    :param clocked: top has clk, rst, in_valid and out_valid ports, otherwise it is combinational
+    :return: Iterator over the lines of Verilog code
+    """
+    in_words, out_words = stream_words(in_bits, bus_width), stream_words(out_bits, bus_width)
+    depth = fifo_depth(latency, interval)
+    in_offsets = np.concatenate([[0], np.cumsum(in_bits)]).tolist()
+    out_fields = ', '.join(f"core_out{i}" for i in reversed(range(len(out_bits))))
+    out_padding = out_words * bus_width - int(np.sum(out_bits))
+
+    yield ("module axis_top(clk, rst, s_axis_tdata, s_axis_tvalid, s_axis_tready, "
+           "m_axis_tdata, m_axis_tvalid, m_axis_tready, m_axis_tlast);\n")
+    yield "    input clk;\n"
+    yield "    input rst;\n"
+    yield f"    input [{bus_width - 1}:0] s_axis_tdata;\n"
+    yield "    input s_axis_tvalid;\n"
+    yield "    output s_axis_tready;\n"
+    yield f"    output [{bus_width - 1}:0] m_axis_tdata;\n"
+    yield "    output m_axis_tvalid;\n"
+    yield "    input m_axis_tready;\n"
+    yield "    output m_axis_tlast;\n"
+
+    # input side: the first transfer ends up in the least significant bits once the vector is complete
+    yield f"    reg [{in_words * bus_width - 1}:0] in_buffer;\n"
+    yield f"    reg [{counter_bits(in_words) - 1}:0] in_word;\n"
+    yield "    reg in_full;\n"
+    yield f"    reg [{counter_bits(depth + 1) - 1}:0] reserved;\n"
+    if interval > 1:
+        yield f"    reg [{counter_bits(interval) - 1}:0] spacing;\n"
+    yield f"    wire issue = in_full && reserved != {depth}{' && spacing == 0' if interval > 1 else ''};\n"
+    yield "    wire in_accept = s_axis_tvalid && s_axis_tready;\n"
+    yield "    assign s_axis_tready = !in_full || issue;\n"
+
+    for i, bits in enumerate(in_bits):
+        yield f"    wire signed [{bits - 1}:0] core_in{i} = in_buffer[{in_offsets[i] + bits - 1}:{in_offsets[i]}];\n"
+    yield from (f"    wire signed [{bits - 1}:0] core_out{i};\n" for i, bits in enumerate(out_bits))
+    core_in = ','.join(f"core_in{i}" for i in range(len(in_bits)))
+    core_out = ','.join(f"core_out{i}" for i in range(len(out_bits)))
+    if clocked:
+        yield "    wire core_valid;\n"
+        yield f"    top core(clk, rst, issue, {core_in}, {core_out}, core_valid);\n"
+    else:
+        yield "    wire core_valid = issue;\n"
+        yield f"    top core({core_in}, {core_out});\n"
+
+    # output side: a ring of result slots sent one transfer after the other
+    yield f"    reg [{out_words * bus_width - 1}:0] fifo [0:{depth - 1}];\n"
+    yield f"    reg [{counter_bits(depth) - 1}:0] write_slot;\n"
+    yield f"    reg [{counter_bits(depth) - 1}:0] read_slot;\n"
+    yield f"    reg [{counter_bits(depth + 1) - 1}:0] count;\n"
+    yield f"    reg [{counter_bits(out_words) - 1}:0] out_word;\n"
+    yield f"    wire [{out_words * bus_width - 1}:0] head = fifo[read_slot];\n"
+    yield "    wire out_accept = m_axis_tvalid && m_axis_tready;\n"
+    yield "    wire out_done = out_accept && m_axis_tlast;\n"
+    yield "    assign m_axis_tvalid = count != 0;\n"
+    yield f"    assign m_axis_tdata = head[out_word * {bus_width} +: {bus_width}];\n"
+    yield f"    assign m_axis_tlast = out_word == {out_words - 1};\n"
+
+    yield "    always @(posedge clk)\n"
+    yield "    begin\n"
+    yield "        if (rst) begin\n"
+    yield "            in_word <= 0;\n"
+    yield "            in_full <= 1'b0;\n"
+    yield "            reserved <= 0;\n"
+    if interval > 1:
+        yield "            spacing <= 0;\n"
+    yield "            write_slot <= 0;\n"
+    yield "            read_slot <= 0;\n"
+    yield "            count <= 0;\n"
+    yield "            out_word <= 0;\n"
+    yield "        end else begin\n"
+    yield "            if (in_accept) begin\n"
+    if in_words > 1:
+        yield f"                in_buffer <= {{s_axis_tdata, in_buffer[{in_words * bus_width - 1}:{bus_width}]}};\n"
+    else:
+        yield "                in_buffer <= s_axis_tdata;\n"
+    yield f"                in_word <= in_word == {in_words - 1} ? 0 : in_word + 1;\n"
+    yield "            end\n"
+    yield f"            in_full <= (in_accept && in_word == {in_words - 1}) || (in_full && !issue);\n"
+    yield "            reserved <= reserved + issue - out_done;\n"
+    if interval > 1:
+        yield f"            spacing <= issue ? {interval - 1} : spacing == 0 ? 0 : spacing - 1;\n"
+    yield "            if (core_valid) begin\n"
+    padding = f"{out_padding}'b0, " if out_padding else ''
+    yield f"                fifo[write_slot] <= {{{padding}{out_fields}}};\n"
+    yield f"                write_slot <= write_slot == {depth - 1} ? 0 : write_slot + 1;\n"
+    yield "            end\n"
+    yield "            if (out_accept)\n"
+    yield "                out_word <= m_axis_tlast ? 0 : out_word + 1;\n"
+    yield "            if (out_done)\n"
+    yield f"                read_slot <= read_slot == {depth - 1} ? 0 : read_slot + 1;\n"
+    yield "            count <= count + core_valid - out_done;\n"
+    yield "        end\n"
+    yield "    end\n"
+    yield "endmodule\n"
@@ -1,9 +1,12 @@
 #! /bin/bash
+# Number of random vectors simulated in one run, leave empty for the single-vector test bench
+NUM_VECTORS=1000
+
 # INTEGER
 
 echo "SIMULATING ON INTEGERS\n"
 
-python main_transpile.py
+python main_transpile.py $NUM_VECTORS
 
 iverilog -o output_files/out.vvp output_files/test_tb.v output_files/test.v
 
@@ -12,7 +15,7 @@ vvp output_files/out.vvp
 # gtkwave output_files/tb_top.vcd # uncomment to view waveform
 
 
-python testing/test1.py
+python testing/test1.py $NUM_VECTORS
 
 echo "\n"
 
@@ -20,7 +23,7 @@ echo "\n"
 
 echo "SIMULATING ON FRACTIONALS \n"
 
-python main_transpile_frac.py
+python main_transpile_frac.py $NUM_VECTORS
 
 iverilog -o output_files_frac/out.vvp output_files_frac/test_tb.v output_files_frac/test.v
 
@@ -28,7 +31,7 @@ vvp output_files_frac/out.vvp
 
 # gtkwave output_files/tb_top.vcd # uncomment to view waveform
 
-python testing/test1_frac.py
+python testing/test1_frac.py $NUM_VECTORS
 
 
 # #  EXPERIMENTING WITH FP
@@ -0,0 +1,93 @@
+"""
+Peak memory and wall time of transpiling one Linear layer of growing size, comparing Model.emit(),
+which builds the whole design as a single string, with Model.emit_to(), which streams it to a file,
+and with Model.emit_to() using one worker process per CPU. The peak memory of the parallel mode
+only covers this process.
+
+Usage: python -m testing.benchmark_emit [size ...]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import torch
+from torch import nn
+
+from model.model import Model
+from model.model_frac import Model as ModelFrac
+
+DEFAULT_SIZES = [100, 200, 400, 800]
+
+
+def make_linear(size: int, frac: bool):
+    """
+    :param size: Number of inputs and outputs of the layer
+    :param frac: Build a fixed-point model instead of an integer one
+    :return: Transpiler model of a single size x size Linear layer with random weights
+    """
+    torch.manual_seed(0)
+    layer = nn.Linear(size, size)
+    if frac:
+        layer.weight = nn.Parameter(torch.rand((size, size)), requires_grad=False)
+        layer.bias = nn.Parameter(torch.rand((size,)), requires_grad=False)
+        model = ModelFrac(nn.Sequential(layer))
+    else:
+        layer.weight = nn.Parameter(torch.randint(-10, 10, (size, size), dtype=torch.int32), requires_grad=False)
+        layer.bias = nn.Parameter(torch.randint(-10, 10, (size,), dtype=torch.int32), requires_grad=False)
+        model = Model(nn.Sequential(layer))
+    model.forward_range([[-100.0, 100.0] for _ in range(size)])
+    return model
+
+
+def measure(run):
+    """
+    Run a function twice, once for the wall time and once under tracemalloc for the peak memory,
+    so the tracing overhead does not end up in the time
+    :param run: Function to measure
+    :return: Wall time in seconds and peak of the traced allocations in bytes
+    """
+    start = time.perf_counter()
+    run()
+    wall = time.perf_counter() - start
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return wall, peak
+
+
+def emit_string(model, path: str):
+    with open(path, 'w') as f:
+        f.write(model.emit())
+
+
+def emit_stream(model, path: str):
+    with open(path, 'w') as f:
+        model.emit_to(f)
+
+
+def emit_parallel(model, path: str):
+    with open(path, 'w') as f:
+        model.emit_to(f, workers=os.cpu_count())
+
+
+def main(sizes):
+    print(f"{'size':>6} {'model':>6} {'mode':>8} {'time [s]':>9} {'peak [MiB]':>11} {'file [MiB]':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.v')
+        for size in sizes:
+            for frac in (False, True):
+                model = make_linear(size, frac)
+                for mode, emit in (('string', emit_string), ('stream', emit_stream),
+                                   ('parallel', emit_parallel)):
+                    wall, peak = measure(lambda: emit(model, path))
+                    print(f"{size:>6} {'frac' if frac else 'int':>6} {mode:>8} {wall:>9.2f} {peak / 2 ** 20:>11.1f} "
+                          f"{os.path.getsize(path) / 2 ** 20:>11.1f}")
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
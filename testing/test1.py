@@ -1,4 +1,6 @@
-from main_transpile import make_model
+from main_transpile import make_model, STIMULUS_FILE, BATCH_OUTPUT_FILE
+import numpy as np
+import sys
 import torch
 
 def calculate_expected_output(model):
@@ -39,6 +41,34 @@ def verify_results(model):
             print(f"Input line: {inputs_line!r}")
             print(f"Output line: {output_line!r}")
 
+def verify_batch_results(model):
+    inputs = model.read_stimulus(STIMULUS_FILE)
+    actual = np.loadtxt(BATCH_OUTPUT_FILE, delimiter=',', dtype=np.int64, ndmin=2)
+
+    torch_model = model.model
+    torch_model.eval()
+    with torch.no_grad():
+        expected = torch_model(torch.tensor(inputs, dtype=torch.int32)).numpy().astype(np.int64)
+    simulated = model.simulate(inputs)
+
+    failed = np.nonzero((expected != actual).any(axis=1))[0]
+    diverged = np.nonzero((simulated != actual).any(axis=1))[0]
+
+    if len(failed) == 0:
+        print(f"✅ Test passed! {len(actual)} vectors match the PyTorch model")
+    else:
+        print(f"❌ Test failed! {len(failed)} of {len(actual)} vectors differ from the PyTorch model")
+        for k in failed[:5]:
+            print(f"Inputs: {inputs[k].tolist()}")
+            print(f"Expected: {expected[k].tolist()}, Got: {actual[k].tolist()}")
+
+    if len(diverged) != 0:
+        print(f"❌ {len(diverged)} vectors differ from Model.simulate(), the emitted design is not what the transpiler expects")
+
 if __name__ == "__main__":
     model = make_model()
-    verify_results(model) 
+    if len(sys.argv) > 1:
+        verify_batch_results(model)
+    else:
+        verify_results(model)
+
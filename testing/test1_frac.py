@@ -1,5 +1,7 @@
-from main_transpile_frac import make_model_frac
-from layers.utils import fixed_point_to_float_decimal
+from main_transpile_frac import make_model_frac, STIMULUS_FILE, BATCH_OUTPUT_FILE
+from layers.utils import fixed_point_to_float_decimal, from_fixed
+import numpy as np
+import sys
 import torch
 
 def calculate_expected_output(model):
@@ -41,10 +43,40 @@ def verify_results(model, int_bits, frac_bits):
             print(f"Input line: {inputs_line!r}")
             print(f"Output line: {output_line!r}")
 
+def verify_batch_results(model, frac_bits):
+    inputs = model.read_stimulus(STIMULUS_FILE)
+    raw = np.loadtxt(BATCH_OUTPUT_FILE, delimiter=',', dtype=np.int64, ndmin=2)
+    # the test bench prints signed values, so they only need to be scaled
+    actual = from_fixed(raw, model.output_fractional_bits())
+
+    torch_model = model.model
+    torch_model.eval()
+    with torch.no_grad():
+        expected = torch_model(torch.tensor(from_fixed(inputs, frac_bits), dtype=torch.float32)).numpy()
+    simulated = model.simulate(inputs)
+
+    error = np.abs(expected - actual)
+    failed = np.nonzero((error >= 1e-2).any(axis=1))[0]
+    diverged = np.nonzero((simulated != raw).any(axis=1))[0]
+
+    if len(failed) == 0:
+        print(f"✅ Test passed! {len(actual)} vectors within 1e-2 of the PyTorch model, max error {error.max()}")
+    else:
+        print(f"❌ Test failed! {len(failed)} of {len(actual)} vectors differ from the PyTorch model, max error {error.max()}")
+        for k in failed[:5]:
+            print(f"Inputs: {from_fixed(inputs[k], frac_bits).tolist()}")
+            print(f"Expected: {expected[k].tolist()}, Got: {actual[k].tolist()}")
+
+    if len(diverged) != 0:
+        print(f"❌ {len(diverged)} vectors differ from Model.simulate(), the emitted design is not what the transpiler expects")
+
 if __name__ == "__main__":
     model = make_model_frac()
     FW = model.FW
-    tot_bits = model.layers[-1].out_bits[0]
-    int_bits = tot_bits - FW
-    verify_results(model, int_bits, FW) 
+    if len(sys.argv) > 1:
+        verify_batch_results(model, FW)
+    else:
+        tot_bits = model.layers[-1].out_bits[0]
+        int_bits = tot_bits - model.output_fractional_bits()
+        verify_results(model, int_bits, model.output_fractional_bits())
 
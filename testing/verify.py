@@ -0,0 +1,250 @@
+"""
+Randomized equivalence check of the emitted design. The stimulus is split into shards of the same
+size, the design and the batch test bench are compiled once, and the shards are simulated by
+parallel simulator processes, each in a directory of its own. All results are then compared with
+the PyTorch model and with the bit-accurate Model.simulate() in one batch. Icarus Verilog is used
+when iverilog and vvp are installed, otherwise Verilator. Without either, only Model.simulate()
+is checked against the PyTorch model.
+
+Usage: python -m testing.verify [--frac] [--pipeline] [--stages S] [--shards K] [--vectors N]
+                                [--workers W] [--simulator iverilog|verilator|python] [--tolerance T]
+                                [--directory D] [--seed S]
+"""
+import argparse
+import copy
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from layers.emitter import Emitter
+from layers.utils import from_fixed, to_fixed
+
+# file names in the directory of every shard, relative so one compiled test bench serves all shards
+STIMULUS_FILE = 'stimulus.mem'
+OUTPUT_FILE = 'batch_values.txt'
+SIMULATORS = ('iverilog', 'verilator', 'python')
+
+
+def find_simulator() -> str:
+    """
+    :return: The first installed simulator of SIMULATORS, 'python' if there is none
+    """
+    if shutil.which('iverilog') and shutil.which('vvp'):
+        return 'iverilog'
+    if shutil.which('verilator'):
+        return 'verilator'
+    return 'python'
+
+
+def is_fixed_point(model: Emitter) -> bool:
+    return hasattr(model, 'output_fractional_bits')
+
+
+def random_stimulus(model: Emitter, num_vectors: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Draw test vectors uniformly from the input ranges the model was sized for, so no value
+    overflows the widths of the design
+    :param model: Model or fixed-point Model after forward_range
+    :param num_vectors: Number of vectors
+    :param rng: Random generator
+    :return: int64 array of shape (num_vectors, num_in) with the values on the input ports
+    """
+    in_range = model.layers[0].in_range
+    if is_fixed_point(model):
+        values = rng.uniform(in_range[:, 0], in_range[:, 1], size=(num_vectors, model.num_in))
+        return to_fixed(values, model.FW)
+    low, high = np.ceil(in_range[:, 0]).astype(np.int64), np.floor(in_range[:, 1]).astype(np.int64)
+    return rng.integers(low, high + 1, size=(num_vectors, model.num_in))
+
+
+def compile_design(model: Emitter, directory: str, num_vectors: int, simulator: str) -> list:
+    """
+    Write the design and a batch test bench for shards of num_vectors vectors, and compile them
+    :param model: Model after forward_range
+    :param directory: Directory the sources and the compiled simulation are written to
+    :param num_vectors: Number of vectors of every shard
+    :param simulator: 'iverilog' or 'verilator'
+    :return: Command that simulates the shard in the current directory
+    """
+    with open(os.path.join(directory, 'test.v'), 'w') as f:
+        model.emit_to(f)
+    with open(os.path.join(directory, 'test_tb.v'), 'w') as f:
+        f.write(model.emit_batch_test_bench(num_vectors, STIMULUS_FILE, OUTPUT_FILE))
+
+    if simulator == 'iverilog':
+        subprocess.run(['iverilog', '-o', 'out.vvp', 'test_tb.v', 'test.v'], cwd=directory, check=True, stdin=subprocess.DEVNULL,
+                       capture_output=True, text=True)
+        return ['vvp', '-n', os.path.abspath(os.path.join(directory, 'out.vvp'))]
+
+    subprocess.run(['verilator', '--binary', '--timing', '-Wno-fatal', '-Wno-lint', '-Wno-style',
+                    '--top-module', 'tb_top', '-Mdir', 'obj', '-o', 'sim', 'test_tb.v', 'test.v'],
+                   cwd=directory, check=True, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    return [os.path.abspath(os.path.join(directory, 'obj', 'sim'))]
+
+
+def simulate_shard(command: list, directory: str) -> np.ndarray:
+    """
+    Run the compiled test bench on the stimulus of one shard
+    :param command: Command returned by compile_design
+    :param directory: Directory of the shard, holding its stimulus and receiving its outputs
+    :return: int64 array of shape (N, num_out) with the outputs the simulator wrote
+    """
+    subprocess.run(command, cwd=directory, check=True, stdin=subprocess.DEVNULL, capture_output=True)
+    return np.loadtxt(os.path.join(directory, OUTPUT_FILE), delimiter=',', dtype=np.int64, ndmin=2)
+
+
+def reference_shard(model: Emitter, inputs: np.ndarray) -> np.ndarray:
+    """
+    :return: Outputs of Model.simulate(), used in place of a simulator
+    """
+    return model.simulate(inputs)
+
+
+def torch_outputs(model: Emitter, inputs: np.ndarray) -> np.ndarray:
+    """
+    :param model: Model or fixed-point Model
+    :param inputs: Values on the input ports
+    :return: Outputs of the PyTorch model in float64, scaled like the outputs of the design for
+        the fixed-point Model
+    """
+    torch_model = copy.deepcopy(model.model).eval()
+    for parameter in torch_model.parameters():
+        # the integer Model can hold integer tensors, which double() leaves unchanged
+        parameter.data = parameter.data.double()
+    values = from_fixed(inputs, model.FW) if is_fixed_point(model) else inputs
+    with torch.no_grad():
+        return torch_model(torch.tensor(values, dtype=torch.float64)).numpy()
+
+
+def verify(model: Emitter, shards: int = 4, vectors: int = 1000, workers: int = None, simulator: str = None,
+           directory: str = None, tolerance: float = None, seed: int = 0) -> dict:
+    """
+    Check the design of a sized model on shards * vectors random vectors
+    :param model: Model or fixed-point Model after forward_range. A design with ROMs needs an
+        absolute rom_dir, since every shard is simulated in its own directory.
+    :param shards: Number of shards, which are simulated in parallel
+    :param vectors: Number of vectors of every shard
+    :param workers: Number of simulator processes, os.cpu_count() if None
+    :param simulator: 'iverilog', 'verilator' or 'python', see find_simulator if None
+    :param directory: Directory of the design and the shards, a temporary one that is removed if None
+    :param tolerance: Largest absolute error against the PyTorch model that passes. If None, 0 for
+        the integer Model, and for the fixed-point one 1e-2 times the largest magnitude of the
+        inputs, at least 1e-2, since the truncated weights scale the error with the inputs
+    :param seed: Seed of the stimulus
+    :return: Dictionary with the simulator, the number of vectors, the seconds spent compiling and
+        simulating, the vectors simulated per second, the indices of the vectors that differ from
+        the PyTorch model ('failed') and from Model.simulate() ('diverged'), and the maximum and
+        mean absolute error against the PyTorch model
+    """
+    simulator = simulator or find_simulator()
+    if simulator not in SIMULATORS:
+        raise ValueError(f'Unknown simulator {simulator}')
+    rom_dir = getattr(model, 'rom_dir', None)
+    if simulator != 'python' and rom_dir and not os.path.isabs(rom_dir):
+        raise ValueError('The shards are simulated in their own directories, use an absolute rom_dir')
+    if tolerance is None:
+        tolerance = 1e-2 * max(1.0, np.abs(model.layers[0].in_range).max()) if is_fixed_point(model) else 0
+
+    rng = np.random.default_rng(seed)
+    stimulus = [random_stimulus(model, vectors, rng) for _ in range(shards)]
+
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = directory or scratch
+        os.makedirs(directory, exist_ok=True)
+        shard_directories = [os.path.join(directory, f'shard_{k}') for k in range(shards)]
+
+        start = time.perf_counter()
+        if simulator != 'python':
+            command = compile_design(model, directory, vectors, simulator)
+            for shard_directory, inputs in zip(shard_directories, stimulus):
+                os.makedirs(shard_directory, exist_ok=True)
+                model.write_stimulus(inputs, os.path.join(shard_directory, STIMULUS_FILE))
+        compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(workers) as pool:
+            if simulator == 'python':
+                results = list(pool.map(reference_shard, [model] * shards, stimulus))
+            else:
+                results = list(pool.map(simulate_shard, [command] * shards, shard_directories))
+        simulation_time = time.perf_counter() - start
+
+    inputs, raw = np.concatenate(stimulus), np.concatenate(results)
+    simulated = model.simulate(inputs)
+    expected = torch_outputs(model, inputs)
+    actual = from_fixed(raw, model.output_fractional_bits()) if is_fixed_point(model) else raw
+    error = np.abs(expected - actual)
+
+    return {
+        'simulator': simulator,
+        'vectors': len(inputs),
+        'compile_s': compile_time,
+        'simulation_s': simulation_time,
+        'vectors_per_s': len(inputs) / simulation_time,
+        'tolerance': tolerance,
+        'inputs': inputs,
+        'expected': expected,
+        'actual': actual,
+        'failed': np.nonzero((error > tolerance).any(axis=1))[0],
+        'diverged': np.nonzero((simulated != raw).any(axis=1))[0],
+        'max_error': float(error.max()),
+        'mean_error': float(error.mean()),
+    }
+
+
+def print_report(report: dict):
+    if report['simulator'] == 'python':
+        print('No simulator found, checking Model.simulate() against the PyTorch model only')
+    print(f"{report['vectors']} vectors with {report['simulator']}: compiled in {report['compile_s']:.2f} s, "
+          f"simulated in {report['simulation_s']:.2f} s, {report['vectors_per_s']:.0f} vectors/s")
+    print(f"max error {report['max_error']:.3g}, mean error {report['mean_error']:.3g}")
+
+    failed, diverged = report['failed'], report['diverged']
+    if len(failed) == 0:
+        print(f"✅ Test passed! {report['vectors']} vectors within {report['tolerance']:g} of the PyTorch model")
+    else:
+        print(f"❌ Test failed! {len(failed)} of {report['vectors']} vectors differ from the PyTorch model "
+              f"by more than {report['tolerance']:g}")
+        for k in failed[:5]:
+            print(f"Inputs: {report['inputs'][k].tolist()}")
+            print(f"Expected: {report['expected'][k].tolist()}, Got: {report['actual'][k].tolist()}")
+    if len(diverged) != 0:
+        print(f"❌ {len(diverged)} vectors differ from Model.simulate(), the emitted design is not what the transpiler expects")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Check the emitted design against the PyTorch model on random vectors')
+    parser.add_argument('--frac', action='store_true', help='Check the fixed-point model of main_transpile_frac')
+    parser.add_argument('--pipeline', action='store_true', help='Emit the integer model as a pipelined design')
+    parser.add_argument('--stages', type=int, default=1, help='Register stages of the pipelined dot products')
+    parser.add_argument('--shards', type=int, default=4, help='Number of shards simulated in parallel')
+    parser.add_argument('--vectors', type=int, default=1000, help='Number of vectors of every shard')
+    parser.add_argument('--workers', type=int, help='Number of simulator processes, one per CPU by default')
+    parser.add_argument('--simulator', choices=SIMULATORS, help='Simulator, the first installed one by default')
+    parser.add_argument('--tolerance', type=float, help='Largest error against the PyTorch model that passes')
+    parser.add_argument('--directory', help='Keep the design and the shards in this directory')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the stimulus')
+    args = parser.parse_args(argv)
+
+    if args.frac:
+        from main_transpile_frac import make_model_frac
+        model = make_model_frac(cache=None)
+    else:
+        from main_transpile import make_model
+        model = make_model(pipeline=args.pipeline, stages=args.stages, cache=None)
+
+    report = verify(model, args.shards, args.vectors, args.workers, args.simulator, args.directory, args.tolerance,
+                    args.seed)
+    print_report(report)
+    return 1 if len(report['failed']) or len(report['diverged']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())